@@ -21,11 +21,8 @@ for key in ${required_params}; do
         && exit 255
 done
 
-type jq >/dev/null 2>&1
-[ $? -ne 0 ] && echo "command 'jq' is required." && exit 255
-
-# max number of events to fetch at once in loop.
-LIMIT_ATONCE=100
+# number of pages fetched at once. (empty for MISP_FETCH_WORKERS, or 4)
+FETCH_WORKERS=
 
 
 progname=`basename $0`
@@ -49,51 +46,18 @@ trap "rm -f '${pidfile}'" EXIT QUIT TERM INT HUP
 mkdir -p "${JSON_DUMPDIR}" || exit 255
 JSON_DUMPDIR=`cd ${JSON_DUMPDIR} && pwd`
 
-function dump_mispobjects() {
-    cd "${workdir}" || exit 255
-    source venv/bin/activate || exit 255
-    [ -f "${stampfile}" ] && source "${stampfile}"
-    if [ -n "${lasttimestamp}" ]; then
-        strdate=`date -R --date=@${lasttimestamp}`
-        echo >&2 "fetching MISP events which timestamp is newer than ${lasttimestamp} (${strdate})"
-        basequery="search timestamp=${lasttimestamp}"
-    else
-        echo >&2 "fetching all MISP events."
-        basequery="search"
-    fi
-    baseargs="--url '${MISP_URL}' --key '${AUTH_KEY}' --ssl ${SSL_CERT}"
-    baseargs+=" --dump '${JSON_DUMPDIR}' --force --pretty"
-
-    page=1
-    newest=0
-    while [ 1 ]; do
-        query="${basequery} limit=${LIMIT_ATONCE} page=${page}"
-        args="${baseargs} --query '${query}'"
-
-        cmd="python3 src/misp_client.py ${args}"
-        echo >&2 $cmd
-        candidate=`eval $cmd \
-            | grep "^dumped to " \
-            | cut -d\  -f3 \
-            | xargs jq -r .Event.timestamp \
-            | sort -n \
-            | tail -1 \
-            ; exit ${PIPESTATUS[0]} `
-        [ $? -ne 0 ] && echo >&2 "error occurred." && exit 255
-
-        [ -z ${candidate} ] && break ## nothing fetched, end of loop.
-        [ ${candidate} -gt ${newest} ] && newest=${candidate}
-        page=`expr ${page} + 1`
-    done
-
-    echo ${newest}
-}
-
-lasttimestamp=`dump_mispobjects`
-[ $? -ne 0 ] && exit 255
-[ -n "${lasttimestamp}" ] \
-    && [ ${lasttimestamp} -gt 0 ] \
-    && savetimestamp=`expr ${lasttimestamp} + 1` \
-    && echo "lasttimestamp=${savetimestamp}" > "${stampfile}"
+cd "${workdir}" || exit 255
+source venv/bin/activate || exit 255
+
+# events changed since the timestamp in stampfile are fetched,
+# and the stampfile is updated when succeeded.
+args="--url '${MISP_URL}' --key '${AUTH_KEY}' --ssl ${SSL_CERT}"
+args+=" --fetch --dump '${JSON_DUMPDIR}' --pretty"
+args+=" --watermark '${stampfile}'"
+[ -n "${FETCH_WORKERS}" ] && args+=" --workers ${FETCH_WORKERS}"
+cmd="python3 src/misp_client.py ${args}"
+echo >&2 $cmd
+eval $cmd
+[ $? -ne 0 ] && echo >&2 "error occurred." && exit 255
 
 echo "successfully finished."
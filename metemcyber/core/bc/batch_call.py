@@ -0,0 +1,102 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import json
+from typing import Any, Dict, List
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.contract import ContractFunction
+from web3.providers.rpc import HTTPProvider
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from ..logger import get_logger
+
+LOGGER = get_logger(name='core.bc', app_dir='', file_prefix='core.bc')
+
+# max number of eth_call packed into one JSON-RPC batch request.
+BATCH_CALL_SIZE = 256
+
+
+class BatchCall():
+    # Resolves read-only contract function calls with JSON-RPC batch
+    # requests. Falls back to one by one call unless HTTPProvider.
+
+    def __init__(self, web3: Web3, batch_size: int = BATCH_CALL_SIZE) -> None:
+        assert batch_size > 0
+        self.web3: Web3 = web3
+        self.batch_size: int = batch_size
+        self.functions: List[ContractFunction] = []
+
+    def add(self, func: ContractFunction) -> 'BatchCall':
+        self.functions.append(func)
+        return self
+
+    def execute(self) -> List[Any]:
+        functions, self.functions = self.functions, []
+        if not isinstance(self.web3.provider, HTTPProvider):
+            return [func.call() for func in functions]
+        results: List[Any] = []
+        for offset in range(0, len(functions), self.batch_size):
+            results.extend(
+                self._batch_request(
+                    functions[offset:offset+self.batch_size]))
+        return results
+
+    def _batch_request(self, functions: List[ContractFunction]) -> List[Any]:
+        payload = [
+            {'jsonrpc': '2.0', 'id': idx, 'method': 'eth_call',
+             'params': [self._call_params(func), 'latest']}
+            for idx, func in enumerate(functions)]
+        provider = self.web3.provider
+        response = requests.post(
+            provider.endpoint_uri, data=json.dumps(payload),
+            **provider.get_request_kwargs())
+        response.raise_for_status()
+        replies = response.json()
+        if not isinstance(replies, list):
+            LOGGER.warning('batch request refused: %s', replies)
+            return [func.call() for func in functions]
+
+        results: List[Any] = [None] * len(functions)
+        for reply in replies:
+            idx = reply['id']
+            if 'error' in reply:
+                raise ValueError(reply['error'])
+            results[idx] = self._decode(
+                functions[idx], HexBytes(reply['result']))
+        LOGGER.debug('batch request resolved %d calls', len(functions))
+        return results
+
+    def _call_params(self, func: ContractFunction) -> Dict[str, str]:
+        params = {
+            'to': func.address,
+            # pylint: disable=protected-access
+            'data': func._encode_transaction_data(),
+            }
+        if self.web3.eth.defaultAccount:
+            params['from'] = self.web3.eth.defaultAccount
+        return params
+
+    def _decode(self, func: ContractFunction, data: HexBytes) -> Any:
+        # same as web3.contract.call_contract_function() does.
+        output_types = get_abi_output_types(func.abi)
+        decoded = self.web3.codec.decode_abi(output_types, data)
+        normalized = map_abi_data(
+            BASE_RETURN_NORMALIZERS, output_types, decoded)
+        if len(normalized) == 1:
+            return normalized[0]
+        return normalized
@@ -111,10 +111,11 @@ class Catalog():
             cti_catalog = CTICatalog(self.web3).get(self.address)
             cinfo.owner = cti_catalog.get_owner()
             cinfo.private = cti_catalog.is_private()
-            for taddr in cti_catalog.list_token_uris():
+            taddrs = cti_catalog.list_token_uris()
+            for taddr, info in zip(taddrs,
+                                   cti_catalog.get_cti_info_list(taddrs)):
                 tinfo = TokenInfo()
-                tid, owner, uuid, title, price, operator, lcount = \
-                    cti_catalog.get_cti_info(taddr)
+                tid, owner, uuid, title, price, operator, lcount = info
                 tinfo.address = taddr
                 tinfo.token_id = tid
                 tinfo.owner = owner
@@ -21,6 +21,7 @@ from typing import Optional, Dict
 from eth_typing import ChecksumAddress
 from web3 import Web3
 from ..logger import get_logger
+from .tx_pipeline import TransactionPipeline
 
 LOGGER = get_logger(name='core.bc', app_dir='', file_prefix='core.bc')
 
@@ -162,8 +163,7 @@ class Contract():
                 bytecode=cls.contract_interface['bin']).\
                 constructor()
 
-        tx_hash = func.transact()
-        tx_receipt = web3.eth.waitForTransactionReceipt(tx_hash)
+        tx_receipt = TransactionPipeline.of(web3).submit(func).result()
         cls.gaslog('deploy', tx_receipt)
         if tx_receipt['status'] != 1:
             raise ValueError(
@@ -177,6 +177,21 @@ class Contract():
         event = getattr(self.contract.events, event_name)
         return event.createFilter(**kwargs)
 
+    def transact(self, func, name, tx_params=None, wait=True):
+        # send transaction via pipeline of the account, not to wait for
+        # receipts one by one.
+        # returns receipt, or TransactionHandle (awaitable) if not wait.
+        def check(tx_receipt):
+            self.gaslog(name, tx_receipt)
+            if tx_receipt['status'] != 1:
+                raise ValueError('Transaction failed: {}'.format(name))
+            LOGGER.debug('%s(%s).%s: succeeded',
+                         self.__class__.__name__, self.address, name)
+
+        handle = TransactionPipeline.of(self.web3).submit(
+            func, tx_params, check)
+        return handle.result() if wait else handle
+
     @classmethod
     def gaslog(cls, func, tx_receipt):
         LOGGER.debug(
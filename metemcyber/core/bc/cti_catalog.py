@@ -15,6 +15,7 @@
 #
 
 from typing import Dict
+from .batch_call import BatchCall
 from .contract import Contract
 
 
@@ -26,48 +27,30 @@ class CTICatalog(Contract):
         func = self.contract.functions.getOwner()
         return func.call()
 
-    def publish_cti(self, producer_address, token_address):
+    def publish_cti(self, producer_address, token_address, wait=True):
         self.log_trace()
         func = self.contract.functions.publishCti(
             producer_address, token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('publishCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: publishCti')
-        self.log_success()
-
-    def register_cti(self, token_address, uuid, title, price, operator):
+        return self.transact(func, 'publishCti', wait=wait)
+
+    def register_cti(
+            self, token_address, uuid, title, price, operator, wait=True):
         self.log_trace()
         func = self.contract.functions.registerCti(
             token_address, uuid, title, price, operator)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('registerCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: registerCti')
-        self.log_success()
-
-    def modify_cti(self, token_address, uuid, title, price, operator):
+        return self.transact(func, 'registerCti', wait=wait)
+
+    def modify_cti(
+            self, token_address, uuid, title, price, operator, wait=True):
         self.log_trace()
         func = self.contract.functions.modifyCti(
             token_address, uuid, title, price, operator)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('modifyCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: modifyCti')
-        self.log_success()
-
-    def unregister_cti(self, token_address):
+        return self.transact(func, 'modifyCti', wait=wait)
+
+    def unregister_cti(self, token_address, wait=True):
         self.log_trace()
         func = self.contract.functions.unregisterCti(token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('unregisterCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: unregisterCti')
-        self.log_success()
+        return self.transact(func, 'unregisterCti', wait=wait)
 
     def list_token_uris(self):
         self.log_trace()
@@ -81,15 +64,17 @@ class CTICatalog(Contract):
         token_id, owner, uuid, title, price, operator, likecount = func.call()
         return token_id, owner, uuid, title, price, operator, likecount
 
-    def like_cti(self, token_address):
+    def get_cti_info_list(self, token_addresses):
+        self.log_trace()
+        batch = BatchCall(self.web3)
+        for token_address in token_addresses:
+            batch.add(self.contract.functions.getCtiInfo(token_address))
+        return [tuple(info) for info in batch.execute()]
+
+    def like_cti(self, token_address, wait=True):
         self.log_trace()
         func = self.contract.functions.likeCti(token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('likeCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: likeCti')
-        self.log_success()
+        return self.transact(func, 'likeCti', wait=wait)
 
     def get_like_event(self, search_blocks=1000):
         self.log_trace()
@@ -107,45 +92,25 @@ class CTICatalog(Contract):
         func = self.contract.functions.isPrivate()
         return func.call()
 
-    def set_private(self):
+    def set_private(self, wait=True):
         self.log_trace()
         func = self.contract.functions.setPrivate()
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('setPrivate', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: setPrivate')
-        self.log_success()
-
-    def set_public(self):
+        return self.transact(func, 'setPrivate', wait=wait)
+
+    def set_public(self, wait=True):
         self.log_trace()
         func = self.contract.functions.setPublic()
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('setPublic', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: setPublic')
-        self.log_success()
-
-    def authorize_user(self, eoa_address):
+        return self.transact(func, 'setPublic', wait=wait)
+
+    def authorize_user(self, eoa_address, wait=True):
         self.log_trace()
         func = self.contract.functions.authorizeUser(eoa_address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('authorizeUser', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: authorizeUser')
-        self.log_success()
-
-    def revoke_user(self, eoa_address):
+        return self.transact(func, 'authorizeUser', wait=wait)
+
+    def revoke_user(self, eoa_address, wait=True):
         self.log_trace()
         func = self.contract.functions.revokeUser(eoa_address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('revokeUser', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: revokeUser')
-        self.log_success()
+        return self.transact(func, 'revokeUser', wait=wait)
 
     def show_authorized_users(self):
         self.log_trace()
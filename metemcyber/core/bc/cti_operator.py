@@ -27,85 +27,45 @@ class CTIOperator(Contract):
         func = self.contract.functions.history(token_address, limit, offset)
         return func.call()
 
-    def set_recipient(self):
+    def set_recipient(self, wait=True):
         self.log_trace()
         func = self.contract.functions.recipientFor(self.address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('recipientFor', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: recipientFor')
-        self.log_success()
+        return self.transact(func, 'recipientFor', wait=wait)
 
-    def register_recipient(self):
+    def register_recipient(self, wait=True):
         self.log_trace()
         func = self.contract.functions.registerRecipient(self.address)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('registerRecipient', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: registerRecipient')
-        self.log_success()
+        return self.transact(func, 'registerRecipient', wait=wait)
 
-    def register_tokens(self, token_addresses):
+    def register_tokens(self, token_addresses, wait=True):
         self.log_trace()
         func = self.contract.functions.register(token_addresses)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('register', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: register')
-        self.log_success()
+        return self.transact(func, 'register', wait=wait)
 
-    def unregister_tokens(self, token_addresses):
+    def unregister_tokens(self, token_addresses, wait=True):
         self.log_trace()
         func = self.contract.functions.unregister(token_addresses)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('unregister', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: unregister')
-        self.log_success()
+        return self.transact(func, 'unregister', wait=wait)
 
-    def accept_task(self, task_id):
+    def accept_task(self, task_id, wait=True):
         self.log_trace()
         func = self.contract.functions.accepted(task_id)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('accepted', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: accepted')
-        self.log_success()
+        return self.transact(func, 'accepted', wait=wait)
 
-    def finish_task(self, task_id, data=''):
+    def finish_task(self, task_id, data='', wait=True):
         self.log_trace()
         func = self.contract.functions.finish(task_id, data)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('finish', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: finish')
-        self.log_success()
+        return self.transact(func, 'finish', wait=wait)
 
-    def cancel_challenge(self, task_id):
+    def cancel_challenge(self, task_id, wait=True):
         self.log_trace()
         func = self.contract.functions.cancelTask(task_id)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('cancelTask', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: cancelTask')
-        self.log_success()
+        return self.transact(func, 'cancelTask', wait=wait)
 
-    def reemit_pending_tasks(self, tokens):
+    def reemit_pending_tasks(self, tokens, wait=True):
         self.log_trace()
         func = self.contract.functions.reemitPendingTasks(tokens)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('reemitPendingTasks', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: reemitPendingTasks')
-        self.log_success()
+        return self.transact(func, 'reemitPendingTasks', wait=wait)
 
     def check_registered(self, token_addresses):
         self.log_trace()
@@ -28,44 +28,24 @@ class CTIToken(Contract):
         func = self.contract.functions.balanceOf(account_id)
         return func.call()
 
-    def send_token(self, dest, amount=1, data=''):
+    def send_token(self, dest, amount=1, data='', wait=True):
         self.log_trace()
         bdata = Web3.toBytes(text=data)
         func = self.contract.functions.send(dest, amount, bdata)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('send', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: send')
-        self.log_success()
+        return self.transact(func, 'send', wait=wait)
 
-    def burn_token(self, amount, data=''):
+    def burn_token(self, amount, data='', wait=True):
         self.log_trace()
         bdata = Web3.toBytes(text=data)
         func = self.contract.functions.burn(amount, bdata)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('burn', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: burn')
-        self.log_success()
+        return self.transact(func, 'burn', wait=wait)
 
-    def authorize_operator(self, operator):
+    def authorize_operator(self, operator, wait=True):
         self.log_trace()
         func = self.contract.functions.authorizeOperator(operator)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('authorizeOperator', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: authorizeOperator')
-        self.log_success()
+        return self.transact(func, 'authorizeOperator', wait=wait)
 
-    def revoke_operator(self, operator):
+    def revoke_operator(self, operator, wait=True):
         self.log_trace()
         func = self.contract.functions.revokeOperator(operator)
-        tx_hash = func.transact()
-        tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('revokeOperator', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: revokeOperator')
-        self.log_success()
+        return self.transact(func, 'revokeOperator', wait=wait)
@@ -0,0 +1,143 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+from weakref import WeakKeyDictionary
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from ..logger import get_logger
+
+LOGGER = get_logger(name='core.bc', app_dir='', file_prefix='core.bc')
+
+# number of threads waiting for transaction receipts, per account.
+TX_RECEIPT_WORKERS = int(os.getenv('TX_RECEIPT_WORKERS', '8'))
+TX_RECEIPT_TIMEOUT_SEC = 120
+
+
+class TransactionHandle():
+    # Result of a submitted transaction.
+    # result() blocks until mined, and the handle is awaitable in asyncio.
+
+    def __init__(self, tx_hash: HexBytes, future: Future) -> None:
+        self.tx_hash: HexBytes = tx_hash
+        self.future: Future = future
+
+    def result(self, timeout: Optional[float] = None) -> AttributeDict:
+        # returns the receipt, or raises if the transaction failed.
+        return self.future.result(timeout=timeout)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def add_done_callback(
+            self, callback: Callable[['TransactionHandle'], Any]) -> None:
+        self.future.add_done_callback(lambda _: callback(self))
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+
+def gather(handles: List[TransactionHandle]) -> List[Any]:
+    # wait for all the handles. results are receipts, or exceptions raised.
+    results: List[Any] = []
+    for handle in handles:
+        try:
+            results.append(handle.result())
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+class TransactionPipeline():
+    # Sends transactions of an account back-to-back, with nonces assigned
+    # locally, and resolves the receipts concurrently.
+    # Use TransactionPipeline.of(web3) to share one pipeline per account.
+
+    __pipelines: WeakKeyDictionary = WeakKeyDictionary()
+    __pipelines_lock = Lock()
+
+    @classmethod
+    def of(cls, web3: Web3) -> 'TransactionPipeline':
+        account = web3.eth.defaultAccount
+        cls.__pipelines_lock.acquire()
+        try:
+            pipelines = cls.__pipelines.setdefault(web3, dict())
+            if account not in pipelines:
+                pipelines[account] = cls(web3, account)
+            return pipelines[account]
+        finally:
+            cls.__pipelines_lock.release()
+
+    def __init__(self, web3: Web3, account: str,
+                 num_workers: int = TX_RECEIPT_WORKERS) -> None:
+        self.web3: Web3 = web3
+        self.account: str = account
+        self.__nonce: Optional[int] = None  # next nonce to use
+        self.__lock = Lock()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='tx_receipt')
+
+    def submit(self, func: Any, tx_params: Optional[Dict[str, Any]] = None,
+               check: Optional[Callable[[AttributeDict], None]] = None
+               ) -> TransactionHandle:
+        # func: bound ContractFunction or ContractConstructor.
+        # check: called with the receipt in the worker, and may raise.
+        self.__lock.acquire()
+        try:
+            tx_hash = self.__send(func, tx_params)
+        finally:
+            self.__lock.release()
+        future = self.__executor.submit(self.__wait, tx_hash, check)
+        return TransactionHandle(tx_hash, future)
+
+    def resync(self) -> None:
+        # forget local nonce. call if the account is used out of pipeline.
+        self.__lock.acquire()
+        self.__nonce = None
+        self.__lock.release()
+
+    def __send(self, func: Any, tx_params: Optional[Dict[str, Any]],
+               retry: bool = True) -> HexBytes:
+        if self.__nonce is None:
+            self.__nonce = self.web3.eth.getTransactionCount(
+                self.account, 'pending')
+        params = dict(tx_params or {})
+        params['nonce'] = self.__nonce
+        try:
+            tx_hash = func.transact(params)
+        except ValueError as err:
+            # nonce was not consumed, or is out of sync with the node.
+            self.__nonce = None
+            if retry and 'nonce' in str(err).lower():
+                LOGGER.warning('resync nonce and retry: %s', err)
+                return self.__send(func, tx_params, retry=False)
+            raise
+        self.__nonce += 1
+        return tx_hash
+
+    def __wait(self, tx_hash: HexBytes,
+               check: Optional[Callable[[AttributeDict], None]]
+               ) -> AttributeDict:
+        tx_receipt = self.web3.eth.waitForTransactionReceipt(
+            tx_hash, timeout=TX_RECEIPT_TIMEOUT_SEC)
+        if check:
+            check(tx_receipt)
+        return tx_receipt
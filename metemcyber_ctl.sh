@@ -407,6 +407,9 @@ function cleanup_client_datafiles() {
     tgts="\
         trusted_users.tsv \
         registered_token.tsv \
+        registered_token.db \
+        registered_token.db-wal \
+        registered_token.db-shm \
         dissemination \
         gasUsed.*.log \
         tx-shelf.db \
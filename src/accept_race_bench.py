@@ -0,0 +1,174 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+# Benchmark of wasted accepted() transactions with N competing solvers,
+# on a local eth-tester chain.
+#
+#   % python3 src/accept_race_bench.py --solvers 8 --processes 2
+#
+# Solvers registered for one token race for each task. They notice the
+# task at random blocks within --spread, and the transactions sent in the
+# same block are mined together. Every reverted transaction is wasted.
+# Strategies compared:
+#   naive     send accepted() always.
+#   precheck  skip if eth_call of accepted() reverts.
+#   claims    claim in TaskClaims shared in the process, then precheck.
+#             (as BaseSolver.accept_task does)
+
+import argparse
+import os
+import random
+from web3 import Web3
+from web3.providers.eth_tester import EthereumTesterProvider
+from eth_tester import PyEVMBackend, EthereumTester
+from contract import Contracts
+from ctioperator import CTIOperator
+from ctitoken import CTIToken
+from solver import TaskClaims
+
+STRATEGIES = ('naive', 'precheck', 'claims')
+ERC1820_DEPLOYER = '0xa990077c3205cbDf861e17Fa532eeB069cE9fF96'
+ERC1820_RAW_TX_FILEPATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'erc1820.tx.raw')
+# fixed gas of accepted(), as estimating gas rejects one to revert.
+ACCEPT_GAS = 200000
+GAS_LIMIT = 4500000
+
+
+def new_chain(num_accounts):
+    tester = EthereumTester(
+        backend=PyEVMBackend(
+            genesis_parameters=PyEVMBackend._generate_genesis_params(
+                overrides={'gas_limit': GAS_LIMIT})))
+    web3 = Web3(EthereumTesterProvider(ethereum_tester=tester))
+    funder = web3.eth.accounts[0]
+    for idx in range(len(web3.eth.accounts), num_accounts):
+        account = tester.add_account('0x{:064x}'.format(idx + 1000))
+        web3.eth.sendTransaction({
+            'from': funder, 'to': account,
+            'value': web3.toWei(1, 'ether')})
+    # ERC777 needs ERC1820. see Player.deploy_erc1820.
+    web3.eth.sendTransaction({
+        'from': funder, 'to': ERC1820_DEPLOYER,
+        'value': web3.toWei('0.1', 'ether')})
+    with open(ERC1820_RAW_TX_FILEPATH, 'r') as fin:
+        web3.eth.sendRawTransaction(fin.read().strip())
+    return tester, web3
+
+
+def contracts_of(web3, account):
+    # web3 of each solver, as MCSolver does.
+    solver_web3 = Web3(web3.provider)
+    solver_web3.eth.defaultAccount = account
+    return Contracts(solver_web3)
+
+
+def run(strategy, num_solvers, num_processes, num_tasks, spread, seed):
+    # contracts of the previous chain may have the same addresses.
+    CTIOperator.pool.clear()
+    CTIToken.pool.clear()
+    tester, web3 = new_chain(num_solvers + 1)
+    seeker = web3.eth.accounts[0]
+    solvers = web3.eth.accounts[1:num_solvers + 1]
+    web3.eth.defaultAccount = seeker
+    contracts = Contracts(web3)
+    ctioperator = contracts.accept(CTIOperator()).new()
+    ctioperator.set_recipient()
+    ctitoken = contracts.accept(CTIToken()).new(num_tasks, [])
+    operators = dict()  # {solver: CTIOperator}
+    for solver in solvers:
+        operators[solver] = contracts_of(web3, solver).accept(
+            CTIOperator()).get(ctioperator.contract_address)
+        operators[solver].contract.functions.register(
+            [ctitoken.contract_address]).transact({'from': solver})
+    # solvers in the same process share the claims.
+    claims = [TaskClaims() for _ in range(num_processes)]
+    process_of = {
+        solver: claims[idx % num_processes]
+        for idx, solver in enumerate(solvers)}
+
+    rand = random.Random(seed)
+    result = {
+        'sent': 0, 'accepted': 0, 'wasted': 0,
+        'claimed_by_other': 0, 'precheck_failed': 0}
+    for task_id in range(num_tasks):
+        ctitoken.send_token(ctioperator.contract_address)
+        arrivals = [(rand.randrange(spread), solver) for solver in solvers]
+        tx_hashes = []
+        tester.disable_auto_mine_transactions()
+        for block in range(spread):
+            targets = [solver for at, solver in arrivals if at == block]
+            rand.shuffle(targets)
+            for solver in targets:
+                if strategy == 'claims' and not process_of[solver].claim(
+                        ctioperator.contract_address, task_id, solver):
+                    result['claimed_by_other'] += 1
+                    continue
+                if strategy != 'naive' and \
+                        not operators[solver].can_accept_task(task_id):
+                    if strategy == 'claims':
+                        process_of[solver].release(
+                            ctioperator.contract_address, task_id, solver)
+                    result['precheck_failed'] += 1
+                    continue
+                tx_hashes.append(
+                    operators[solver].contract.functions.accepted(
+                        task_id).transact(
+                            {'from': solver, 'gas': ACCEPT_GAS}))
+            tester.mine_blocks(1)
+        tester.enable_auto_mine_transactions()
+        for tx_hash in tx_hashes:
+            receipt = web3.eth.getTransactionReceipt(tx_hash)
+            result['sent'] += 1
+            result['accepted' if receipt['status'] == 1 else 'wasted'] += 1
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--solvers', type=int, default=4,
+        help='Number of solvers competing for a task')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help='Number of MCSolver processes the solvers are spread over')
+    parser.add_argument(
+        '-t', '--tasks', type=int, default=20, help='Number of tasks')
+    parser.add_argument(
+        '-s', '--spread', type=int, default=3,
+        help='Number of blocks in which solvers notice a task')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    assert args.solvers > 0 and args.tasks > 0 and args.spread > 0
+    assert 0 < args.processes <= args.solvers
+
+    print('solvers={} processes={} tasks={} spread={}'.format(
+        args.solvers, args.processes, args.tasks, args.spread))
+    print('{:10} {:>6} {:>8} {:>6} {:>10} {:>8} {:>8}'.format(
+        'strategy', 'sent', 'accepted', 'wasted', 'wasted/task',
+        'claimed', 'skipped'))
+    for strategy in STRATEGIES:
+        result = run(
+            strategy, args.solvers, args.processes, args.tasks,
+            args.spread, args.seed)
+        print('{:10} {:>6} {:>8} {:>6} {:>10.2f} {:>8} {:>8}'.format(
+            strategy, result['sent'], result['accepted'], result['wasted'],
+            result['wasted'] / args.tasks, result['claimed_by_other'],
+            result['precheck_failed']))
+
+
+if __name__ == '__main__':
+    main()
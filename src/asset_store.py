@@ -0,0 +1,389 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from threading import Lock, get_ident
+
+LOGGER = logging.getLogger('common')
+
+BLOBS_DIRNAME = '.blobs'
+INDEX_FILENAME = '.index.jsonl'
+GZIP_SUFFIX = '.gz'
+# files in root which are not tokens. (gzip variants, partial writes)
+NON_TOKEN_SUFFIXES = (GZIP_SUFFIX, '.tmp')
+## assets larger than this get gzip variant ahead.
+ASSET_GZIP_MIN_SIZE = int(os.getenv('ASSET_GZIP_MIN_SIZE', str(64 * 1024)))
+HASH_CHUNK_SIZE = 1024 * 1024
+## the index journal is compacted when it has this many lines per entry.
+INDEX_COMPACT_RATIO = 2
+
+
+def sha256_file(path):
+    # returns (hexdigest, size) of the file.
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+class AssetStore:
+    # Content-addressed store of CTI assets, served by solvers.
+    # Contents are kept once as read-only blobs named by sha256 under
+    # .blobs, with gzip variant for large ones. Each token is a hard link
+    # to its blob, named by token address, so that a file server can serve
+    # the root directory as is.
+    # Entries of tokens are journaled in .index.jsonl, and looked up
+    # without touching the files.
+    # Use AssetStore.of(root) to share one store per directory.
+
+    __stores = dict()  # {abspath: store}
+    __stores_lock = Lock()
+
+    @classmethod
+    def of(cls, root):
+        root = os.path.abspath(root)
+        cls.__stores_lock.acquire()
+        try:
+            if root not in cls.__stores:
+                cls.__stores[root] = cls(root)
+            return cls.__stores[root]
+        finally:
+            cls.__stores_lock.release()
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.blobs_dir = os.path.join(self.root, BLOBS_DIRNAME)
+        self.index_path = os.path.join(self.root, INDEX_FILENAME)
+        self.__entries = dict()  # {token_address: entry}
+        self.__gzips = dict()  # {sha256: gzip info} of known blobs
+        self.__lines = 0  # lines in the journal
+        self.__offset = 0  # journal read so far
+        self.__inode = None  # of the journal read
+        self.__lock = Lock()
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            self.__lock.acquire()
+            try:
+                self.__refresh()
+            finally:
+                self.__lock.release()
+        else:  # first time. migrate existing token files.
+            self.rebuild()
+
+    def blob_path(self, digest, encoding=None):
+        return os.path.join(
+            self.blobs_dir, digest[:2],
+            digest + (GZIP_SUFFIX if encoding == 'gzip' else ''))
+
+    def token_path(self, token_address):
+        return os.path.join(self.root, token_address)
+
+    def get(self, token_address):
+        # entry of the token, or None.
+        # entry: {token, sha256, size, uuid, gzip: {sha256, size} or None}
+        entry = self.__entries.get(token_address)
+        if entry:
+            return entry
+        self.__lock.acquire()
+        try:  # may be added by another process.
+            self.__refresh()
+            return self.__entries.get(token_address)
+        finally:
+            self.__lock.release()
+
+    def path(self, token_address, encoding=None):
+        # path of the content to serve, or None.
+        entry = self.get(token_address)
+        if not entry:
+            return None
+        if encoding == 'gzip' and not entry['gzip']:
+            return None
+        return self.blob_path(entry['sha256'], encoding)
+
+    def tokens(self):
+        return list(self.__entries.keys())
+
+    def put(self, token_address, source_path, uuid=None):
+        # store content of source_path as the asset of the token.
+        digest, size = self.__ingest(source_path)
+        gzip_info = self.__precompress(digest, size)
+        self.__link(token_address, digest)
+        entry = {
+            'token': token_address,
+            'sha256': digest,
+            'size': size,
+            'uuid': uuid,
+            'gzip': gzip_info,
+            }
+        self.__lock.acquire()
+        try:
+            self.__add(entry)
+            self.__append(entry)
+        finally:
+            self.__lock.release()
+        return entry
+
+    def remove(self, token_address):
+        # blob is left for other tokens. see prune().
+        self.__lock.acquire()
+        try:
+            if self.__entries.pop(token_address, None) is None:
+                return False
+            self.__append({'token': token_address, 'removed': True})
+        finally:
+            self.__lock.release()
+        try:
+            os.remove(self.token_path(token_address))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def verify(self, token_address):
+        # True if the blob of the token is not broken.
+        entry = self.get(token_address)
+        if not entry:
+            return False
+        try:
+            digest, size = sha256_file(self.blob_path(entry['sha256']))
+        except OSError as err:
+            LOGGER.warning('cannot verify %s: %s', token_address, err)
+            return False
+        return digest == entry['sha256'] and size == entry['size']
+
+    def prune(self):
+        # remove blobs no token refers to. returns number of removed.
+        self.__lock.acquire()
+        try:
+            used = {entry['sha256'] for entry in self.__entries.values()}
+            removed = 0
+            for digest, path in self.__scan_blobs():
+                if digest in used:
+                    continue
+                for target in (path, path + GZIP_SUFFIX):
+                    try:
+                        os.remove(target)
+                    except FileNotFoundError:
+                        pass
+                self.__gzips.pop(digest, None)
+                removed += 1
+            return removed
+        finally:
+            self.__lock.release()
+
+    def rebuild(self):
+        # rebuild the index from token files in root.
+        # hard links to blobs are recognized by inode without hashing,
+        # and others (e.g. legacy symlinks) are stored into blobs.
+        self.__lock.acquire()
+        try:
+            self.__refresh()
+            known = dict(self.__entries)
+            inodes = dict()  # {(dev, ino): (digest, size)}
+            for digest, path in self.__scan_blobs():
+                stat = os.stat(path)
+                inodes[(stat.st_dev, stat.st_ino)] = (digest, stat.st_size)
+            self.__entries = dict()
+            legacy = []
+            for dent in os.scandir(self.root):
+                if dent.name.startswith('.') or dent.is_dir() or \
+                        dent.name.endswith(NON_TOKEN_SUFFIXES):
+                    continue
+                blob = None
+                if not dent.is_symlink():
+                    stat = dent.stat()
+                    blob = inodes.get((stat.st_dev, stat.st_ino))
+                if not blob:
+                    legacy.append(dent)
+                    continue
+                old = known.get(dent.name) or {}
+                self.__add({
+                    'token': dent.name,
+                    'sha256': blob[0],
+                    'size': blob[1],
+                    'uuid': old.get('uuid'),
+                    'gzip': self.__precompress(blob[0], blob[1]),
+                    })
+            self.__compact()
+        finally:
+            self.__lock.release()
+        for dent in legacy:
+            uuid = (known.get(dent.name) or {}).get('uuid')
+            if dent.is_symlink():
+                target = os.path.realpath(dent.path)
+                uuid = uuid or os.path.splitext(os.path.basename(target))[0]
+            try:
+                self.put(dent.name, dent.path, uuid)
+            except OSError as err:
+                LOGGER.warning('cannot store asset %s: %s', dent.path, err)
+        if legacy:
+            LOGGER.info('stored %d assets into %s', len(legacy), self.root)
+        return len(self.__entries)
+
+    def __scan_blobs(self):
+        # (digest, path) of blobs, except gzip variants.
+        for subdir in os.scandir(self.blobs_dir):
+            if not subdir.is_dir():
+                continue
+            for dent in os.scandir(subdir.path):
+                if dent.name.startswith('.') or \
+                        dent.name.endswith(GZIP_SUFFIX):
+                    continue
+                yield dent.name, dent.path
+
+    def __ingest(self, source_path):
+        # copy into blobs while hashing. same content is stored once.
+        fd, tmp_path = self.__mkstemp()
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(source_path, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    fout.write(chunk)
+            digest = sha256.hexdigest()
+            self.__publish(tmp_path, self.blob_path(digest))
+            return digest, size
+        finally:
+            os.remove(tmp_path)
+
+    def __precompress(self, digest, size):
+        # gzip variant of the blob, created if missing.
+        if size < ASSET_GZIP_MIN_SIZE:
+            return None
+        if digest in self.__gzips:
+            return self.__gzips[digest]
+        gz_path = self.blob_path(digest, 'gzip')
+        if not os.path.exists(gz_path):
+            fd, tmp_path = self.__mkstemp()
+            try:
+                with open(self.blob_path(digest), 'rb') as fin, \
+                        os.fdopen(fd, 'wb') as fout, \
+                        gzip.GzipFile(  # mtime=0 for same output
+                            fileobj=fout, mode='wb', mtime=0) as gzout:
+                    for chunk in iter(
+                            lambda: fin.read(HASH_CHUNK_SIZE), b''):
+                        gzout.write(chunk)
+                self.__publish(tmp_path, gz_path)
+            finally:
+                os.remove(tmp_path)
+        gz_digest, gz_size = sha256_file(gz_path)
+        gzip_info = {'sha256': gz_digest, 'size': gz_size}
+        self.__gzips[digest] = gzip_info
+        return gzip_info
+
+    def __link(self, token_address, digest):
+        # make the token file a hard link to the blob, atomically.
+        blob_path = self.blob_path(digest)
+        token_path = self.token_path(token_address)
+        try:
+            if not os.path.islink(token_path) and \
+                    os.path.samefile(blob_path, token_path):
+                return
+        except FileNotFoundError:
+            pass
+        tmp_path = os.path.join(
+            self.root, '.{}.{}.{}.tmp'.format(
+                token_address, os.getpid(), get_ident()))
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.link(blob_path, tmp_path)
+        try:
+            os.replace(tmp_path, token_path)
+        finally:
+            # left if token_path has been linked to the blob meanwhile.
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    def __mkstemp(self):
+        return tempfile.mkstemp(
+            dir=self.blobs_dir, prefix='.', suffix='.tmp')
+
+    @staticmethod
+    def __publish(tmp_path, path):
+        # link tmp_path as path, unless it exists. blobs are immutable.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(tmp_path, 0o444)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+
+    def __add(self, entry):
+        self.__entries[entry['token']] = entry
+        if entry['gzip']:
+            self.__gzips[entry['sha256']] = entry['gzip']
+
+    def __append(self, record):
+        with open(self.index_path, 'a') as fout:
+            read_all = fout.tell() == self.__offset
+            fout.write(json.dumps(record) + '\n')
+            if read_all:  # otherwise, lines of others are read later.
+                self.__offset = fout.tell()
+        self.__lines += 1
+        if self.__lines > \
+                INDEX_COMPACT_RATIO * len(self.__entries) + 100:
+            self.__compact()
+
+    def __compact(self):
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(tmp_path, 'w') as fout:
+            for entry in self.__entries.values():
+                fout.write(json.dumps(entry) + '\n')
+            offset = fout.tell()
+        os.replace(tmp_path, self.index_path)
+        self.__inode = os.stat(self.index_path).st_ino
+        self.__offset = offset
+        self.__lines = len(self.__entries)
+
+    def __refresh(self):
+        # read the journal appended since the last read.
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self.__inode or stat.st_size < self.__offset:
+            # compacted by another process. read all over again.
+            self.__entries = dict()
+            self.__inode = stat.st_ino
+            self.__offset = 0
+            self.__lines = 0
+        if stat.st_size == self.__offset:
+            return
+        with open(self.index_path) as fin:
+            fin.seek(self.__offset)
+            for line in iter(fin.readline, ''):
+                if not line.endswith('\n'):  # being written
+                    break
+                self.__offset += len(line.encode())
+                self.__lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    LOGGER.warning('ignored broken line in %s', fin.name)
+                    continue
+                if record.get('removed'):
+                    self.__entries.pop(record['token'], None)
+                else:
+                    self.__add(record)
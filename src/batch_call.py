@@ -0,0 +1,104 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import json
+import logging
+import requests
+from hexbytes import HexBytes
+from web3.providers.rpc import HTTPProvider
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+
+LOGGER = logging.getLogger('common')
+
+## max number of eth_call packed into one JSON-RPC batch request.
+BATCH_CALL_SIZE = 256
+
+
+class BatchCall:
+    # Collects read-only contract function calls and resolves them with
+    # JSON-RPC batch requests, instead of one round trip per call.
+    # Providers other than HTTPProvider (e.g. EthereumTesterProvider) do not
+    # accept batch requests, so calls are resolved one by one in that case.
+
+    def __init__(self, web3, batch_size=BATCH_CALL_SIZE):
+        assert batch_size > 0
+        self.web3 = web3
+        self.batch_size = batch_size
+        self.functions = []
+
+    def add(self, func):
+        # func should be a bound ContractFunction,
+        # e.g. contract.functions.balanceOf(account_id).
+        self.functions.append(func)
+        return self
+
+    def execute(self):
+        functions, self.functions = self.functions, []
+        if not isinstance(self.web3.provider, HTTPProvider):
+            return [func.call() for func in functions]
+        results = []
+        for offset in range(0, len(functions), self.batch_size):
+            results.extend(
+                self._batch_request(
+                    functions[offset:offset+self.batch_size]))
+        return results
+
+    def _batch_request(self, functions):
+        payload = [
+            {'jsonrpc': '2.0', 'id': idx, 'method': 'eth_call',
+             'params': [self._call_params(func), 'latest']}
+            for idx, func in enumerate(functions)]
+        provider = self.web3.provider
+        response = requests.post(
+            provider.endpoint_uri, data=json.dumps(payload),
+            **provider.get_request_kwargs())
+        response.raise_for_status()
+        replies = response.json()
+        if not isinstance(replies, list):
+            # the node does not support batch request.
+            LOGGER.warning('batch request refused: %s', replies)
+            return [func.call() for func in functions]
+
+        results = [None] * len(functions)
+        for reply in replies:
+            idx = reply['id']
+            if 'error' in reply:
+                raise ValueError(reply['error'])
+            results[idx] = self._decode(
+                functions[idx], HexBytes(reply['result']))
+        LOGGER.debug('batch request resolved %d calls', len(functions))
+        return results
+
+    def _call_params(self, func):
+        params = {
+            'to': func.address,
+            # pylint: disable=protected-access
+            'data': func._encode_transaction_data(),
+            }
+        if self.web3.eth.defaultAccount:
+            params['from'] = self.web3.eth.defaultAccount
+        return params
+
+    def _decode(self, func, data):
+        # same as web3.contract.call_contract_function() does.
+        output_types = get_abi_output_types(func.abi)
+        decoded = self.web3.codec.decode_abi(output_types, data)
+        normalized = map_abi_data(
+            BASE_RETURN_NORMALIZERS, output_types, decoded)
+        if len(normalized) == 1:
+            return normalized[0]
+        return normalized
@@ -589,7 +589,8 @@ class Controller():
         if not self.model.inventory.catalog_addresses:
             self.view.missing_screen('カタログ')
             return
-        callback = self.model.create_asset_content
+        self.model.asset_store.rebuild()
+        callback = self.model.restore_asset_content
         self.model.inventory.restore_disseminate(
             self.model.account_id, callback, view=self.view)
 
@@ -19,7 +19,6 @@ import json
 import logging
 import os
 from pathlib import Path
-from urllib.request import Request, urlopen
 import configparser
 
 from requests.exceptions import HTTPError
@@ -41,6 +40,11 @@ from inventory import Inventory
 from plugin import PluginManager
 from eventlistener import BasicEventListener
 from solver_wrapper import SolverWrapper
+from disseminator import BulkDisseminator
+from token_registry import TokenRegistry
+from tx_pipeline import TransactionPipeline
+from cti_downloader import download_cti, DownloadRetryQueue
+from asset_store import AssetStore
 
 LOGGER = logging.getLogger('common')
 GASLOG = logging.getLogger('gaslog')
@@ -63,7 +67,7 @@ ERC1820_RAW_TX_FILEPATH = './src/erc1820.tx.raw'
 CONFIG_INI_FILEPATH = './workspace/config.ini'
 MISP_INI_FILEPATH = './workspace/misp.ini'
 TRUSTED_USERS_TSV = './workspace/trusted_users.tsv'
-REGISTERED_TOKEN_TSV = './workspace/registered_token.tsv'
+EVENT_CHECKPOINT_FILEPATH_FORMAT = './workspace/checkpoint.{user}.json'
 MAX_HISTORY_NUM = 5
 
 
@@ -118,8 +122,14 @@ class Player():
         self.deploy_metemcyberutil()
 
         self.fetch_trusted_users()
-
-        self.event_listener = BasicEventListener('')
+        # 登録済みトークンの管理
+        self.token_registry = TokenRegistry()
+        # 配布するCTIの実体
+        self.asset_store = AssetStore.of(FILESERVER_ASSETS_PATH)
+
+        self.event_listener = BasicEventListener(
+            '', checkpoint_file=EVENT_CHECKPOINT_FILEPATH_FORMAT.format(
+                user=self.account_id))
         self.event_listener.start()
 
         # inventory (トークン・カタログの管理)のインスタンス生成
@@ -165,13 +175,23 @@ class Player():
         self.default_auto_accept = False
         self.load_misp_config()
 
+        # 保存されたダウンロードURLの自動再取得
+        self.download_retry = DownloadRetryQueue(
+            DOWNLOADED_CTI_PATH, callback=lambda token, filepath, title:
+            LOGGER.info('re-downloaded %s (%s): %s', token, title, filepath))
+        self.download_retry.start()
+
     def destroy(self):
+        if self.download_retry:
+            self.download_retry.stop()
         if self.solver:
             self.solver.destroy()
         if self.inventory:
             self.inventory.destroy()
         if self.event_listener:
             self.event_listener.destroy()
+        TransactionPipeline.close_of(self.web3)
+        self.token_registry.close()
 
     def deploy_erc1820(self):
         # ERC777を利用するにはERC1820が必要
@@ -447,39 +467,12 @@ class Player():
             self, catalog_address, default_pirce, default_quantity,
             default_num_consign, default_auto_accept, view):
         # mispオブジェクトファイルの一覧をtokenとして公開する
-
-        # 登録済みのtokenを取得
-        registered_token = self.fetch_registered_token()
-        registered_uuid = [token.get('uuid') for token in registered_token]
-        for obj_path in Path(MISP_DATAFILE_PATH).glob("./*.json"):
-            # UUID (ファイル名から拡張子を省いた部分) を取得
-            uuid = obj_path.stem
-            if uuid in registered_uuid:
-                continue
-            metadata = {}
-            with open(obj_path) as fin:
-                misp = json.load(fin)
-            try:
-                if view:
-                    view.vio.print(
-                        'disseminating CTI: \n'
-                        '  UUID: ' + uuid + '\n'
-                        '  TITLE: ' + misp['Event']['info'] + '\n'
-                        )
-                metadata['uuid'] = uuid
-                metadata['title'] = misp['Event']['info']
-                metadata['price'] = default_pirce
-                metadata['operator'] = self.operator_address
-                metadata['quantity'] = default_quantity
-
-                token_address = self.disseminate_new_token(
-                    catalog_address, metadata, default_num_consign)
-                if default_auto_accept:
-                    msg = self.accept_challenges([token_address])
-                    if view and msg:
-                        view.vio.print(msg)
-            except KeyError:
-                LOGGER.warning('There is no Event info in %s', misp)
+        # 登録済みのtoken (token_registry) はスキップする
+        disseminator = BulkDisseminator(
+            self, catalog_address, default_pirce, default_quantity,
+            default_num_consign, default_auto_accept, view)
+        return disseminator.run(
+            sorted(Path(MISP_DATAFILE_PATH).glob("./*.json")))
 
     def disseminate_new_token(
             self, catalog_address, cti_metadata, num_consign=0):
@@ -519,17 +512,27 @@ class Player():
                 json.dump(j, fout, indent=2, ensure_ascii=False)
             LOGGER.warning(
                 'created a simple placeholder. '
-                'please overwrite the file above.')
-
-        dist_dir = os.path.dirname(dist_linkpath)
-        if not os.path.isdir(dist_dir):
-            os.makedirs(dist_dir)
-            LOGGER.warning(
-                'created missing directory for disseminate: %s', dist_dir)
+                'please overwrite the file above, and restore disseminate.')
+
+        entry = self.asset_store.put(
+            cti_metadata['tokenAddress'], misp_filepath,
+            cti_metadata['uuid'])
+        LOGGER.info(
+            'disseminate asset: %s (sha256:%s)',
+            dist_linkpath, entry['sha256'])
+
+    def restore_asset_content(self, cti_metadata):
+        # skip tokens already in the asset store, unless MISP file has
+        # been modified since stored (e.g. placeholder overwritten).
+        asset_path = self.asset_store.path(cti_metadata['tokenAddress'])
+        misp_filepath = self.uuid_to_filepath(cti_metadata['uuid'])
         try:
-            os.symlink(misp_filepath, dist_linkpath)
-        except FileExistsError:
-            LOGGER.error('disseminate link already exists: %s', dist_linkpath)
+            if asset_path and os.path.getmtime(misp_filepath) <= \
+                    os.path.getmtime(asset_path):
+                return
+        except FileNotFoundError:
+            pass
+        self.create_asset_content(cti_metadata)
 
     def register_catalog(self, catalog_address, token_address, cti_metadata):
         self.inventory.register_token(
@@ -542,37 +545,21 @@ class Player():
         self.inventory.modify_token(
             catalog_address, token_address, cti_metadata)
 
-    @staticmethod
-    def save_registered_token(cti_metadata):
+    def save_registered_token(self, cti_metadata, stage=None):
         # cticatalog コントラクトに登録したtokenのmetadataを保存する
-        fieldnames = [
-            'uuid', 'tokenAddress', 'title', 'price', 'operator', 'quantity']
+        # stage: 配布途中のtokenが最後に完了した段階 (完了済みならNone)
+        self.token_registry.add(cti_metadata, stage)
 
-        is_empty = not os.path.isfile(REGISTERED_TOKEN_TSV)
+    def fetch_registered_token(self):
+        # 登録済みトークンのfetch
+        return self.token_registry.list()
 
-        with open(REGISTERED_TOKEN_TSV, 'a', newline='') as tsvfile:
-            writer = csv.DictWriter(
-                tsvfile, fieldnames=fieldnames, extrasaction='ignore',
-                delimiter='\t')
-            if is_empty:
-                writer.writeheader()
-            writer.writerow(cti_metadata)
+    def fetch_pending_token(self):
+        # 配布途中で中断したトークンのfetch
+        return self.token_registry.pending()
 
-    @staticmethod
-    def fetch_registered_token():
-        # 登録済みトークンのfetch
-        registered_tokens = []
-        try:
-            with open(REGISTERED_TOKEN_TSV, newline='') as tsvfile:
-                tsv = csv.DictReader(tsvfile, delimiter='\t')
-                for row in tsv:
-                    registered_tokens.append(row)
-                return registered_tokens
-        except FileNotFoundError:
-            pass
-        except Exception as err:
-            LOGGER.error(err)
-        return registered_tokens
+    def is_registered_token(self, uuid):
+        return self.token_registry.contains(uuid)
 
     def consign(self, catalog_address, token_address, amount):
         self.inventory.consign(catalog_address, token_address, amount)
@@ -617,38 +604,23 @@ class Player():
         msg += 'トークン: ' + token_address + '\n'
 
         try:
-            request = Request(download_url, method="GET")
-            with urlopen(request) as response:
-                rdata = response.read()
+            # streamed into a temporary file, renamed when completed.
+            filepath, title = download_cti(
+                download_url, DOWNLOADED_CTI_PATH, token_address)
         except Exception as err:
             LOGGER.error(err)
             msg += \
                 'チャレンジ結果を受信しましたが、受信URLからの' + \
                 'ダウンロードに失敗しました: ' + str(err) + '\n'
-            msg += '手動でダウンロードしてください\n'
+            msg += 'バックグラウンドで再取得します\n'
             msg += '\n'
             msg += self._save_download_url(token_address, download_url)
             return True, msg
 
-        try:
-            jdata = json.loads(rdata)
-            title = jdata['Event']['info']
-        except:
+        if title is None:
             title = '（解析できませんでした）'
         msg += '取得データタイトル: ' + title + '\n'
-
-        try:
-            if not os.path.isdir(DOWNLOADED_CTI_PATH):
-                os.makedirs(DOWNLOADED_CTI_PATH)
-            filepath = '{}/{}.json'.format(DOWNLOADED_CTI_PATH, token_address)
-            with open(filepath, 'wb') as fout:
-                fout.write(rdata)
-            msg += '取得データを保存しました: ' + filepath + '\n'
-        except Exception as err:
-            msg += '取得データの保存に失敗しました: ' + str(err) + '\n'
-            msg += '手動で再取得してください\n'
-            msg += '\n'
-            msg += self._save_download_url(token_address, download_url)
+        msg += '取得データを保存しました: ' + filepath + '\n'
         return True, msg
 
     @staticmethod
@@ -699,12 +671,7 @@ class Player():
     def interest_assets(self):
         if not self.interest:
             return self.inventory.catalog_tokens
-
-        filtered_assets = filter(
-            lambda x: self.interest in x[1]['title'],
-            self.inventory.catalog_tokens.items())
-
-        return dict(filtered_assets)
+        return self.inventory.search(self.interest)
 
     def accept_challenges(self, token_addresses):
         LOGGER.info('accept_challenge tokens: %s', token_addresses)
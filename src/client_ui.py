@@ -215,12 +215,9 @@ class SimpleCUI():
             self.vio.print('入力値が不正です')
 
     def account_info(self):
-        num_own = len([v for v \
-            in self.model.inventory.catalog_tokens.values() \
-                if v['balanceOfUser'] > 0])
-        num_published = len([v for v \
-            in self.model.inventory.catalog_tokens.values() \
-                if v['owner'] == self.model.account_id])
+        catalog_tokens = self.model.inventory.catalog_tokens
+        num_own = len(catalog_tokens.holding())
+        num_published = len(catalog_tokens.by_owner(self.model.account_id))
         catalog_addresses = self.model.inventory.catalog_addresses
         broker_address = self.model.inventory.broker_address
         operator_address = self.model.operator_address \
@@ -245,24 +242,22 @@ class SimpleCUI():
         pout(' - 所持ユニークCTIトークン数: {}'.format(num_own))
         pout(' - CTIトークン発行回数: {}'.format(num_published))
         pout('■ CTIトークン')
-        for asset in self.model.inventory.catalog_tokens.values():
-            if asset['balanceOfUser'] > 0:
-                pout('ID:{tokenId} 数量:{balance} - {uri}'.format(
-                    tokenId=asset['tokenId'],
-                    balance=asset['balanceOfUser'],
-                    uri=asset['token_address']))
+        for asset in self.model.inventory.catalog_tokens.holding().values():
+            pout('ID:{tokenId} 数量:{balance} - {uri}'.format(
+                tokenId=asset['tokenId'],
+                balance=asset['balanceOfUser'],
+                uri=asset['token_address']))
 
     def _token_selector_list(self, mode='catalog'):
         self.display_assets = []
 
+        catalog_tokens = self.model.inventory.catalog_tokens
         if self.model.interest:
-            base_assets = dict(filter(
-                lambda x: self.model.interest in x[1]['title'],
-                self.model.inventory.catalog_tokens.items()))
+            base_assets = self.model.inventory.search(self.model.interest)
             self.vio.pager_print(
                 '(検索中のキーワード:', self.model.interest, ')')
         else:
-            base_assets = self.model.inventory.catalog_tokens
+            base_assets = catalog_tokens
 
         acception = None  # neither True nor False
         if mode in {'catalog', 'like'}: ## shopping catalog
@@ -275,8 +270,8 @@ class SimpleCUI():
                 'token_publisher', 'solver_accepting', 'solver_refusing'}:
             # tokens which owner is me - published by me.
             assets = {
-                k: v for k, v in base_assets.items() \
-                    if v['owner'] == self.model.account_id}
+                k: v for k, v in catalog_tokens.by_owner(
+                    self.model.account_id).items() if k in base_assets}
             balance_key = 'balanceOfUser'
             min_balance = 0
             if mode in {'solver_accepting', 'solver_refusing'}:
@@ -284,7 +279,9 @@ class SimpleCUI():
 
         elif mode == 'token_holder': ## challengeable
             # tokens i have.
-            assets = base_assets
+            assets = {
+                k: v for k, v in catalog_tokens.holding().items()
+                if k in base_assets}
             balance_key = 'balanceOfUser'
             min_balance = 1
 
@@ -22,6 +22,7 @@ import json
 import os
 from solcx import compile_files #, link_code
 from web3 import Web3
+from tx_pipeline import TransactionPipeline
 
 LOGGER = logging.getLogger('common')
 GASLOG = logging.getLogger('gaslog')
@@ -187,11 +188,17 @@ class ContractVisitor(Visitor):
         raise Exception('Contract build failed: {}'.format(self.contract_src))
 
     def __deploy(self, *args, **kwargs):
+        tx_receipt = self.deploy(*args, **kwargs).result()
+        return tx_receipt['contractAddress']
+
+    def deploy(self, *args, **kwargs):
         # コントラクトのチェーンへのデプロイ
+        # returns TransactionHandle without waiting for the receipt.
+        # contractAddress in the receipt is the address to get().
         if not self.contracts.web3:
             raise Exception('not yet initialized with web3')
         if not self.__class__.contract_interface:
-            raise Exception('not yet built')
+            self.__load()
 
         # constructorに引数が必要な場合は指定
         if args or kwargs:
@@ -205,19 +212,34 @@ class ContractVisitor(Visitor):
                 bytecode=self.__class__.contract_interface['bin']).\
                     constructor()
 
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('deploy', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Contract deploy failed: {}'.format(
-                self.contract_src))
+        def check(tx_receipt):
+            self.gaslog('deploy', tx_receipt)
+            if tx_receipt['status'] != 1:
+                raise ValueError('Contract deploy failed: {}'.format(
+                    self.contract_src))
 
-        return tx_receipt['contractAddress']
+        return TransactionPipeline.of(self.contracts.web3).submit(
+            func, check=check)
 
     def event_filter(self, event_name, **kwargs):
         event = getattr(self.contract.events, event_name)
         return event.createFilter(**kwargs)
 
+    def transact(self, func, name, tx_params=None, wait=True, succeeded=None):
+        # send transaction via pipeline of the account, not to wait for
+        # receipts one by one.
+        # returns receipt, or TransactionHandle (awaitable) if not wait.
+        def check(tx_receipt):
+            self.gaslog(name, tx_receipt)
+            if tx_receipt['status'] != 1:
+                raise ValueError('Transaction failed: {}'.format(name))
+            if succeeded:
+                succeeded(tx_receipt)
+
+        handle = TransactionPipeline.of(self.contracts.web3).submit(
+            func, tx_params, check)
+        return handle.result() if wait else handle
+
     def gaslog(self, func, tx_receipt):
         GASLOG.info(
             '%s.%s: gasUsed=%d', self.__class__.__name__, func,
@@ -0,0 +1,321 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import codecs
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from threading import Thread, Event, Lock
+from weakref import WeakValueDictionary
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+LOGGER = logging.getLogger('common')
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT_SEC = 30
+## number of resumes in a download() call.
+DOWNLOAD_MAX_RESUMES = 3
+## interval to retry the downloads saved as <token>.url.
+DOWNLOAD_RETRY_INTERVAL_SEC = int(
+    os.getenv('DOWNLOAD_RETRY_INTERVAL_SEC', '60'))
+## a download saved as <token>.url is given up after this number of trials.
+DOWNLOAD_RETRY_MAX = int(os.getenv('DOWNLOAD_RETRY_MAX', '10'))
+RETRY_JOIN_TIMEOUT_SEC = 30
+PART_SUFFIX = '.part'
+
+# downloads into the same file are serialized. {abspath: Lock}
+_PATH_LOCKS = WeakValueDictionary()
+_PATH_LOCKS_LOCK = Lock()
+
+STRUCTURE = re.compile(r'["{}\[\]:,]')
+STRING_END = re.compile(r'["\\]')
+
+
+class TitleParser:
+    # Incremental scanner of MISP JSON for Event.info, to get the title
+    # without loading the whole document. feed() chunks until done.
+
+    def __init__(self, path=('Event', 'info')):
+        self.path = list(path)
+        self.reset()
+
+    def reset(self):
+        self.title = None
+        self.done = False
+        self.__stack = []  # '{' or '['
+        self.__keys = []  # current key of each level, None for array
+        self.__expect_key = False
+        self.__string = None  # chars of string being read, or None
+        self.__capture = False  # the string is key or target value
+        self.__escaped = False
+        # multibyte chars may be split into chunks.
+        self.__decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        text = self.__decoder.decode(chunk)
+        pos = 0
+        while pos < len(text) and not self.done:
+            if self.__string is not None:
+                pos = self.__read_string(text, pos)
+                continue
+            match = STRUCTURE.search(text, pos)
+            if not match:
+                break
+            self.__structure(match.group())
+            pos = match.end()
+
+    def __read_string(self, text, pos):
+        if self.__escaped:
+            if self.__capture:
+                self.__string.append(text[pos])
+            self.__escaped = False
+            return pos + 1
+        match = STRING_END.search(text, pos)
+        end = match.start() if match else len(text)
+        if self.__capture:
+            self.__string.append(text[pos:end])
+        if not match:
+            return end
+        if match.group() == '\\':
+            if self.__capture:
+                self.__string.append('\\')
+            self.__escaped = True
+            return end + 1
+        self.__end_string()
+        return end + 1
+
+    def __end_string(self):
+        raw = ''.join(self.__string) if self.__capture else ''
+        self.__string = None
+        if not self.__capture:
+            return
+        value = json.loads('"' + raw + '"')
+        if self.__expect_key:
+            self.__keys[-1] = value
+            self.__expect_key = False
+        else:  # target value
+            self.title = value
+            self.done = True
+
+    def __target(self):
+        # the value to come is at the path.
+        return self.__keys == self.path and \
+            all(container == '{' for container in self.__stack)
+
+    def __structure(self, char):
+        if char == '"':
+            self.__string = []
+            self.__capture = self.__expect_key or self.__target()
+        elif char in '{[':
+            if self.__target():  # not a string. give up.
+                self.done = True
+            self.__stack.append(char)
+            self.__keys.append(None)
+            self.__expect_key = char == '{'
+        elif char in '}]':
+            if not self.__stack:
+                self.done = True
+                return
+            self.__stack.pop()
+            self.__keys.pop()
+            self.__expect_key = False
+        elif char == ',':
+            if self.__stack and self.__stack[-1] == '{':
+                self.__keys[-1] = None
+                self.__expect_key = True
+
+
+def is_permanent(err):
+    # 4xx other than timeout and throttling, e.g. expired signed URL.
+    return isinstance(err, HTTPError) and 400 <= err.code < 500 and \
+        err.code not in {408, 429}
+
+
+def path_lock(filepath):
+    _PATH_LOCKS_LOCK.acquire()
+    try:
+        key = os.path.abspath(filepath)
+        lock = _PATH_LOCKS.get(key)
+        if lock is None:
+            lock = Lock()
+            _PATH_LOCKS[key] = lock
+        return lock
+    finally:
+        _PATH_LOCKS_LOCK.release()
+
+
+def download(url, filepath, parser=None):
+    # stream url into filepath, via filepath.part which is kept for
+    # resuming with Range request if interrupted.
+    # filepath appears atomically when completed.
+    with path_lock(filepath):  # another download may write the part.
+        return _download(url, filepath, parser)
+
+
+def _download(url, filepath, parser):
+    part = filepath + PART_SUFFIX
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    if parser and os.path.exists(part):  # title may be in the part.
+        with open(part, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(DOWNLOAD_CHUNK_SIZE), b''):
+                parser.feed(chunk)
+    for trial in range(DOWNLOAD_MAX_RESUMES + 1):
+        try:
+            _download_part(url, part, parser)
+            break
+        except (OSError, ValueError) as err:
+            if isinstance(err, HTTPError) and err.code < 500 and \
+                    err.code != 416:
+                raise
+            if trial >= DOWNLOAD_MAX_RESUMES:
+                raise
+            LOGGER.warning('resume download of %s: %s', url, err)
+    os.replace(part, filepath)
+    return parser.title if parser else None
+
+
+def _download_part(url, part, parser):
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    try:
+        response = urlopen(
+            Request(url, method='GET', headers=headers),
+            timeout=DOWNLOAD_TIMEOUT_SEC)
+    except HTTPError as err:
+        if err.code == 416 and offset:  # broken part. start over.
+            os.remove(part)
+        raise
+    with response:
+        if offset and response.status == 206 and \
+                response.headers.get('Content-Range', '').startswith(
+                    'bytes {}-'.format(offset)):
+            mode = 'ab'
+        else:  # range not supported. start over.
+            mode = 'wb'
+            offset = 0
+            if parser:
+                parser.reset()
+        with open(part, mode) as fout:
+            for chunk in iter(
+                    lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                fout.write(chunk)
+                if parser:
+                    parser.feed(chunk)
+            length = response.headers.get('Content-Length')
+            if length is not None and fout.tell() < offset + int(length):
+                raise ValueError('connection closed before completed')
+            fout.flush()
+            os.fsync(fout.fileno())
+
+
+def download_cti(download_url, dirpath, token_address):
+    # returns (filepath, title). title is None if not found.
+    filepath = '{}/{}.json'.format(dirpath, token_address)
+    title = download(download_url, filepath, TitleParser())
+    return filepath, title
+
+
+class DownloadRetryQueue:
+    # Retries the downloads saved as <token>.url in background, and
+    # removes the .url file when completed, or given up on 4xx or after
+    # DOWNLOAD_RETRY_MAX trials.
+
+    def __init__(self, dirpath, callback=None,
+                 interval=DOWNLOAD_RETRY_INTERVAL_SEC):
+        self.dirpath = dirpath
+        self.callback = callback  # called with (token, filepath, title)
+        self.interval = interval
+        self.wakeup = Event()  # set to retry now
+        self.__trials = dict()  # {token: (url, number of failures)}
+        self.__stopping = False
+        self.__thread = None
+
+    def start(self):
+        if self.__thread:
+            return
+        self.__stopping = False
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if not self.__thread:
+            return
+        self.__stopping = True
+        self.wakeup.set()
+        self.__thread.join(timeout=RETRY_JOIN_TIMEOUT_SEC)
+        if self.__thread.is_alive():
+            LOGGER.error('failed stopping download retry queue')
+        self.__thread = None
+
+    def __run(self):
+        while not self.__stopping:
+            self.retry_all()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def retry_all(self):
+        if not os.path.isdir(self.dirpath):
+            return
+        for urlfile in sorted(Path(self.dirpath).glob('*.url')):
+            if self.__stopping:
+                return
+            token_address = urlfile.stem
+            try:
+                download_url = urlfile.read_text().strip()
+            except OSError as err:
+                LOGGER.warning('cannot read %s: %s', urlfile, err)
+                continue
+            try:
+                filepath, title = download_cti(
+                    download_url, self.dirpath, token_address)
+            except Exception as err:
+                self.__failed(urlfile, token_address, download_url, err)
+                continue
+            self.__trials.pop(token_address, None)
+            self.__remove(urlfile, download_url)
+            LOGGER.info('downloaded %s: %s', filepath, title)
+            if self.callback:
+                self.callback(token_address, filepath, title)
+
+    def __failed(self, urlfile, token_address, download_url, err):
+        url, failures = self.__trials.get(token_address, (None, 0))
+        # the url is renewed by a new challenge.
+        failures = failures + 1 if url == download_url else 1
+        if is_permanent(err) or failures >= DOWNLOAD_RETRY_MAX:
+            LOGGER.error(
+                'gave up download for %s after %d trials: %s',
+                token_address, failures, err)
+            self.__trials.pop(token_address, None)
+            self.__remove(urlfile, download_url)
+            return
+        self.__trials[token_address] = (download_url, failures)
+        LOGGER.warning(
+            'retry download for %s failed (%d/%d): %s',
+            token_address, failures, DOWNLOAD_RETRY_MAX, err)
+
+    @staticmethod
+    def __remove(urlfile, download_url):
+        # keep the url saved meanwhile.
+        try:
+            if urlfile.read_text().strip() == download_url:
+                urlfile.unlink()
+        except OSError:
+            pass
@@ -29,29 +29,18 @@ class CTIBroker(ContractVisitor):
         super().__init__()
         self.contract_id = 'CTIBroker.sol:CTIBroker'
 
-    def consign_token(self, catalog, token, amount):
+    def consign_token(self, catalog, token, amount, wait=True):
         func = self.contract.functions.consignToken(catalog, token, amount)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('consignToken', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('consignToken: transaction failed')
+        return self.transact(func, 'consignToken', wait=wait)
 
-    def takeback_token(self, catalog, token, amount):
+    def takeback_token(self, catalog, token, amount, wait=True):
         func = self.contract.functions.takebackToken(catalog, token, amount)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('takebackToken', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('takebackToken: transaction failed')
+        return self.transact(func, 'takebackToken', wait=wait)
 
-    def buy_token(self, catalog, token, wei, allow_cheaper=False):
+    def buy_token(self, catalog, token, wei, allow_cheaper=False, wait=True):
         func = self.contract.functions.buyToken(catalog, token, allow_cheaper)
-        tx_hash = func.transact({'value': wei})
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('buyToken', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('buyToken: transaction failed')
+        return self.transact(
+            func, 'buyToken', tx_params={'value': wei}, wait=wait)
 
     def get_amounts(self, catalog, tokens):
         func = self.contract.functions.getAmounts(catalog, tokens)
@@ -16,6 +16,7 @@
 
 import logging
 from contract_visitor import ContractVisitor
+from batch_call import BatchCall
 
 LOGGER = logging.getLogger('common')
 
@@ -33,40 +34,26 @@ class CTICatalog(ContractVisitor):
         func = self.contract.functions.getOwner()
         return func.call()
 
-    def publish_cti(self, producer_address, token_address):
+    def publish_cti(self, producer_address, token_address, wait=True):
         func = self.contract.functions.publishCti(
             producer_address, token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('publishCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: publishCti')
+        return self.transact(func, 'publishCti', wait=wait)
 
-    def register_cti(self, token_address, uuid, title, price, operator):
+    def register_cti(
+            self, token_address, uuid, title, price, operator, wait=True):
         func = self.contract.functions.registerCti(
             token_address, uuid, title, price, operator)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('registerCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: registerCti')
+        return self.transact(func, 'registerCti', wait=wait)
 
-    def modify_cti(self, token_address, uuid, title, price, operator):
+    def modify_cti(
+            self, token_address, uuid, title, price, operator, wait=True):
         func = self.contract.functions.modifyCti(
             token_address, uuid, title, price, operator)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('modifyCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: modifyCti')
+        return self.transact(func, 'modifyCti', wait=wait)
 
-    def unregister_cti(self, token_address):
+    def unregister_cti(self, token_address, wait=True):
         func = self.contract.functions.unregisterCti(token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('unregisterCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: unregisterCti')
+        return self.transact(func, 'unregisterCti', wait=wait)
 
     def list_token_uris(self):
         func = self.contract.functions.listTokenURIs()
@@ -78,13 +65,16 @@ class CTICatalog(ContractVisitor):
         token_id, owner, uuid, title, price, operator, likecount = func.call()
         return token_id, owner, uuid, title, price, operator, likecount
 
-    def like_cti(self, token_address):
+    def get_cti_info_list(self, token_addresses):
+        # same as get_cti_info() for each token, with a few round trips.
+        batch = BatchCall(self.contracts.web3)
+        for token_address in token_addresses:
+            batch.add(self.contract.functions.getCtiInfo(token_address))
+        return [tuple(info) for info in batch.execute()]
+
+    def like_cti(self, token_address, wait=True):
         func = self.contract.functions.likeCti(token_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('likeCti', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: likeCti')
+        return self.transact(func, 'likeCti', wait=wait)
 
     def get_like_event(self, search_blocks=1000):
         # 最大search_blocks数だけ、CtiLiked eventを取得して返す
@@ -100,37 +90,21 @@ class CTICatalog(ContractVisitor):
         func = self.contract.functions.isPrivate()
         return func.call()
 
-    def set_private(self):
+    def set_private(self, wait=True):
         func = self.contract.functions.setPrivate()
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('setPrivate', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: setPrivate')
+        return self.transact(func, 'setPrivate', wait=wait)
 
-    def set_public(self):
+    def set_public(self, wait=True):
         func = self.contract.functions.setPublic()
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('setPublic', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: setPublic')
+        return self.transact(func, 'setPublic', wait=wait)
 
-    def authorize_user(self, eoa_address):
+    def authorize_user(self, eoa_address, wait=True):
         func = self.contract.functions.authorizeUser(eoa_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('authorizeUser', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: authorizeUser')
+        return self.transact(func, 'authorizeUser', wait=wait)
 
-    def revoke_user(self, eoa_address):
+    def revoke_user(self, eoa_address, wait=True):
         func = self.contract.functions.revokeUser(eoa_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('revokeUser', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: revokeUser')
+        return self.transact(func, 'revokeUser', wait=wait)
 
     def show_authorized_users(self):
         func = self.contract.functions.showAuthorizedUsers()
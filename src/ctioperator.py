@@ -15,6 +15,7 @@
 #
 
 import logging
+from eth_tester.exceptions import TransactionFailed
 from contract_visitor import ContractVisitor
 
 LOGGER = logging.getLogger('common')
@@ -28,77 +29,68 @@ class CTIOperator(ContractVisitor):
         super().__init__()
         self.contract_id = 'CTIOperator.sol:CTIOperator'
 
-    def history(self, token_address, limit, offset=0):
+    def history(self, token_address, limit, offset=0, block='latest'):
+        # tasks of the caller (seeker), in descending order of id.
         func = self.contract.functions.history(token_address, limit, offset)
-        return func.call()
+        return func.call(
+            {'from': self.contracts.web3.eth.defaultAccount},
+            block_identifier=block)
 
-    def set_recipient(self):
+    def set_recipient(self, wait=True):
         func = self.contract.functions.recipientFor(self.contract_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('recipientFor', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: recipientFor')
+        return self.transact(func, 'recipientFor', wait=wait)
 
-    def register_recipient(self):
+    def register_recipient(self, wait=True):
         func = self.contract.functions.registerRecipient(self.contract_address)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('registerRecipient', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: registerRecipient')
+        return self.transact(func, 'registerRecipient', wait=wait)
 
-    def register_tokens(self, token_addresses):
+    def register_tokens(self, token_addresses, wait=True):
         func = self.contract.functions.register(token_addresses)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('register', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: register')
-        LOGGER.info('register succeeded: %s', token_addresses)
-
-    def unregister_tokens(self, token_addresses):
+        return self.transact(
+            func, 'register', wait=wait,
+            succeeded=lambda _: LOGGER.info(
+                'register succeeded: %s', token_addresses))
+
+    def unregister_tokens(self, token_addresses, wait=True):
         func = self.contract.functions.unregister(token_addresses)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('unregister', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: unregister')
-        LOGGER.info('unregister succeeded: %s', token_addresses)
-
-    def accept_task(self, task_id):
+        return self.transact(
+            func, 'unregister', wait=wait,
+            succeeded=lambda _: LOGGER.info(
+                'unregister succeeded: %s', token_addresses))
+
+    def accept_task(self, task_id, wait=True):
         func = self.contract.functions.accepted(task_id)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('accepted', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: accepted')
-        LOGGER.info('accept_task succeeded: %s', task_id)
-
-    def finish_task(self, task_id, data=''):
+        return self.transact(
+            func, 'accepted', wait=wait,
+            succeeded=lambda _: LOGGER.info(
+                'accept_task succeeded: %s', task_id))
+
+    def can_accept_task(self, task_id):
+        # simulate accepted() with eth_call. no gas, no block to wait.
+        # a node reverts with ValueError, and eth-tester TransactionFailed.
+        func = self.contract.functions.accepted(task_id)
+        try:
+            func.call({'from': self.contracts.web3.eth.defaultAccount})
+            return True
+        except (ValueError, TransactionFailed) as err:
+            # reverted. accepted by another, etc.
+            LOGGER.info('accept_task %s would fail: %s', task_id, err)
+            return False
+
+    def finish_task(self, task_id, data='', wait=True):
         func = self.contract.functions.finish(task_id, data)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('finish', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: finish')
-        LOGGER.info('finish_task succeeded: %s', task_id)
-
-    def cancel_challenge(self, task_id):
+        return self.transact(
+            func, 'finish', wait=wait,
+            succeeded=lambda _: LOGGER.info(
+                'finish_task succeeded: %s', task_id))
+
+    def cancel_challenge(self, task_id, wait=True):
         func = self.contract.functions.cancelTask(task_id)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('cancelTask', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: cancelTask')
+        return self.transact(func, 'cancelTask', wait=wait)
 
-    def reemit_pending_tasks(self, tokens):
+    def reemit_pending_tasks(self, tokens, wait=True):
         func = self.contract.functions.reemitPendingTasks(tokens)
-        tx_hash = func.transact()
-        tx_receipt = self.contracts.web3.eth.waitForTransactionReceipt(tx_hash)
-        self.gaslog('reemitPendingTasks', tx_receipt)
-        if tx_receipt['status'] != 1:
-            raise ValueError('Transaction failed: reemitPendingTasks')
+        return self.transact(func, 'reemitPendingTasks', wait=wait)
 
     def check_registered(self, token_addresses):
         func = self.contract.functions.checkRegistered(token_addresses)
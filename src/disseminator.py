@@ -0,0 +1,326 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from ctitoken import CTIToken
+from cticatalog import CTICatalog
+from ctibroker import CTIBroker
+from tx_pipeline import gather
+
+LOGGER = logging.getLogger('common')
+
+## number of MISP files disseminated together, stage by stage.
+DISSEMINATE_WINDOW = int(os.getenv('DISSEMINATE_WINDOW', '32'))
+## number of threads reading and validating MISP files.
+DISSEMINATE_READ_WORKERS = int(os.getenv('DISSEMINATE_READ_WORKERS', '8'))
+
+STAGES = ('read', 'deploy', 'register', 'publish', 'consign', 'accept')
+
+
+def load_mispdata(filepath):
+    # returns (uuid, title) of the MISP file, or raises ValueError.
+    try:
+        with open(filepath) as fin:
+            misp = json.load(fin)
+        return filepath.stem, misp['Event']['info']
+    except (OSError, ValueError) as err:
+        raise ValueError('cannot read {}: {}'.format(filepath, err)) from err
+    except (KeyError, TypeError) as err:
+        raise ValueError(
+            'There is no Event info in {}'.format(filepath)) from err
+
+
+class BulkDisseminator:
+    # Disseminates MISP files as CTI tokens.
+    # Files are read in parallel, and a window of files goes through each
+    # stage (deploy, register, publish, consign) together, so that each
+    # stage waits for receipts once per window instead of once per token.
+    # Each token is recorded in the token registry with the last stage it
+    # passed, as soon as it is deployed. Completed tokens are skipped, and
+    # tokens left halfway by a crashed or failed run resume from the next
+    # stage, instead of being deployed again.
+
+    def __init__(
+            self, player, catalog_address, price, quantity, num_consign,
+            auto_accept, view=None, window=DISSEMINATE_WINDOW):
+        assert window > 0
+        self.player = player
+        self.catalog_address = catalog_address
+        self.price = price
+        self.quantity = quantity
+        self.num_consign = num_consign
+        self.auto_accept = auto_accept
+        self.view = view
+        self.window = window
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.progress = {stage: 0 for stage in STAGES}
+        self.started = None
+        # the stage after which a token is completed.
+        self.__last = 'accept' if auto_accept else \
+            'consign' if num_consign > 0 else 'publish'
+        self.__lock = Lock()  # counters are updated by readers
+
+    def run(self, filepaths):
+        pending = [
+            self.__resume(row) for row in self.player.fetch_pending_token()]
+        targets = [
+            path for path in filepaths
+            if not self.player.is_registered_token(path.stem)]
+        self.total = len(pending) + len(targets)
+        self.started = time.time()
+        LOGGER.info(
+            'disseminating %d MISP files (%d resumed, %d already registered)',
+            self.total, len(pending),
+            len(filepaths) - len(targets) - len(pending))
+
+        token_addresses = []
+        for idx in range(0, len(pending), self.window):
+            token_addresses.extend(
+                self.__disseminate(pending[idx:idx + self.window]))
+        with ThreadPoolExecutor(
+                max_workers=DISSEMINATE_READ_WORKERS) as executor:
+            window = []
+            for metadata in executor.map(self.__read, targets):
+                if metadata is None:
+                    continue
+                window.append(metadata)
+                if len(window) >= self.window:
+                    token_addresses.extend(self.__disseminate(window))
+                    window = []
+            if window:
+                token_addresses.extend(self.__disseminate(window))
+        self.__report()
+        return token_addresses
+
+    def stats(self):
+        elapsed = time.time() - self.started if self.started else 0.0
+        return {
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'elapsed_sec': elapsed,
+            'tokens_per_sec': self.done / elapsed if elapsed > 0 else 0.0,
+            'stages': dict(self.progress),
+            }
+
+    def __read(self, filepath):
+        try:
+            uuid, title = load_mispdata(filepath)
+        except ValueError as err:
+            LOGGER.warning(err)
+            self.__lock.acquire()
+            self.failed += 1
+            self.__lock.release()
+            return None
+        self.__lock.acquire()
+        self.progress['read'] += 1
+        self.__lock.release()
+        return {
+            'uuid': uuid,
+            'title': title,
+            'price': self.price,
+            'operator': self.player.operator_address,
+            'quantity': self.quantity,
+            'stage': 'read',
+            }
+
+    def __resume(self, row):
+        # metadata of a token left halfway, from the token registry.
+        LOGGER.info(
+            'resuming dissemination after %s: %s: %s',
+            row['stage'], row['uuid'], row['tokenAddress'])
+        return {
+            'uuid': row['uuid'],
+            'title': row['title'],
+            'price': int(row['price']),
+            'operator': row['operator'],
+            'quantity': int(row['quantity']),
+            'tokenAddress': row['tokenAddress'],
+            'stage': row['stage'],
+            }
+
+    def __checkpoint(self, item, stage):
+        # record the stage passed, for resuming.
+        item['stage'] = stage
+        completed = self.__completed(item)
+        self.player.save_registered_token(
+            item, stage=None if completed else stage)
+        if completed:
+            self.__lock.acquire()
+            self.done += 1
+            self.__lock.release()
+
+    def __completed(self, item):
+        return STAGES.index(item['stage']) >= STAGES.index(self.__last)
+
+    def __stage(self, name, items, submit):
+        # submit transactions of all the items, then wait for all receipts.
+        # returns items succeeded, with the receipt.
+        submitted = []
+        for item in items:
+            try:
+                submitted.append((item, submit(item)))
+            except Exception as err:
+                self.__fail(name, item, err)
+        results = gather([handle for _, handle in submitted])
+        succeeded = []
+        for (item, _), result in zip(submitted, results):
+            if isinstance(result, Exception):
+                self.__fail(name, item, result)
+                continue
+            succeeded.append((item, result))
+        return succeeded
+
+    def __fail(self, stage, item, err):
+        if item.get('tokenAddress'):
+            # recorded in the token registry, resumed on the next run.
+            LOGGER.error(
+                'dissemination failed at %s: %s: %s (token %s is left '
+                'after %s)', stage, item['uuid'], err, item['tokenAddress'],
+                item['stage'])
+        else:
+            LOGGER.error(
+                'dissemination failed at %s: %s: %s',
+                stage, item['uuid'], err)
+        self.__lock.acquire()
+        self.failed += 1
+        self.__lock.release()
+
+    def __disseminate(self, items):
+        # items go through the stages after the one they passed.
+        contracts = self.player.contracts
+        account_id = self.player.account_id
+        cticatalog = contracts.accept(CTICatalog()).get(self.catalog_address)
+
+        def passed(*stages):
+            return [item for item in items if item['stage'] in stages]
+
+        for item in items:
+            # resumed with less stages than the crashed run.
+            if self.__completed(item):
+                self.__checkpoint(item, item['stage'])
+
+        deployed = self.__stage(
+            'deploy', passed('read'),
+            lambda item: contracts.accept(CTIToken()).deploy(
+                item['quantity'], []))
+        for item, receipt in deployed:
+            item['tokenAddress'] = receipt['contractAddress']
+            self.player.create_asset_content(item)
+            self.__checkpoint(item, 'deploy')
+        self.progress['deploy'] += len(deployed)
+
+        registered = self.__stage(
+            'register', passed('deploy'),
+            lambda item: cticatalog.register_cti(
+                item['tokenAddress'], item['uuid'], item['title'],
+                item['price'], item['operator'], wait=False))
+        for item, _ in registered:
+            self.__checkpoint(item, 'register')
+        self.progress['register'] += len(registered)
+
+        published = self.__stage(
+            'publish', passed('register'),
+            lambda item: cticatalog.publish_cti(
+                account_id, item['tokenAddress'], wait=False))
+        for item, _ in published:
+            self.__checkpoint(item, 'publish')
+            if self.view:
+                self.view.vio.print(
+                    'disseminated CTI: \n'
+                    '  UUID: ' + item['uuid'] + '\n'
+                    '  TITLE: ' + item['title'] + '\n'
+                    )
+        self.progress['publish'] += len(published)
+
+        if self.num_consign > 0 and passed('publish'):
+            self.__consign(passed('publish'))
+        # tokens failed to consign are not accepted, to consign on resume.
+        accepting = passed('consign') if self.num_consign > 0 else \
+            passed('publish', 'consign')
+        if self.auto_accept and accepting:
+            self.__accept(accepting)
+
+        self.__report()
+        return [
+            item['tokenAddress'] for item in items if self.__completed(item)]
+
+    def __accept(self, items):
+        token_addresses = [item['tokenAddress'] for item in items]
+        try:
+            msg = self.player.accept_challenges(token_addresses)
+        except Exception as err:
+            for item in items:
+                self.__fail('accept', item, err)
+            return
+        for item in items:
+            self.__checkpoint(item, 'accept')
+        if self.view and msg:
+            self.view.vio.print(msg)
+        self.progress['accept'] += len(items)
+
+    def __consign(self, items):
+        # same as Broker.consign() for each token.
+        contracts = self.player.contracts
+        broker_address = self.player.inventory.broker_address
+        ctibroker = contracts.accept(CTIBroker()).get(broker_address)
+
+        def ctitoken(item):
+            return contracts.accept(CTIToken()).get(item['tokenAddress'])
+
+        authorized = self.__stage(
+            'consign', items,
+            lambda item: ctitoken(item).authorize_operator(
+                broker_address, wait=False))
+        consigned = self.__stage(
+            'consign', [item for item, _ in authorized],
+            lambda item: ctibroker.consign_token(
+                self.catalog_address, item['tokenAddress'],
+                self.num_consign, wait=False))
+        for item, _ in consigned:
+            self.__checkpoint(item, 'consign')
+        # revoke even if consign failed.
+        self.__stage(
+            'consign', [item for item, _ in authorized],
+            lambda item: ctitoken(item).revoke_operator(
+                broker_address, wait=False))
+        self.progress['consign'] += len(consigned)
+        self.player.inventory.catalog_list.update_balanceof_myself_list(
+            [item['tokenAddress'] for item, _ in consigned],
+            self.catalog_address)
+
+    def __report(self):
+        stats = self.stats()
+        msg = (
+            'disseminated {done}/{total} ({failed} failed) '
+            'in {elapsed:.1f} sec, {rate:.2f} tokens/sec [{stages}]').format(
+                done=stats['done'], total=stats['total'],
+                failed=stats['failed'], elapsed=stats['elapsed_sec'],
+                rate=stats['tokens_per_sec'],
+                stages=', '.join(
+                    '{}={}'.format(stage, stats['stages'][stage])
+                    for stage in STAGES))
+        LOGGER.info(msg)
+        if self.view:
+            self.view.vio.print(msg)
@@ -14,41 +14,359 @@
 #    limitations under the License.
 #
 
+import json
 import logging
+import os
 import time
-from threading import Thread, Lock
+from functools import partial
+from queue import Queue, Full
+from threading import Thread, Lock, current_thread
+from hexbytes import HexBytes
 from requests.exceptions import ConnectionError as ConnError, HTTPError
+from web3._utils.method_formatters import log_entry_formatter
+from eventsubscriber import EventSubscriber
 
 LOGGER = logging.getLogger('common')
 
 
 EVENT_POLLING_INTERVAL_SEC = 2
 LISTENER_JOIN_TIMEOUT_SEC = 30
+## collapse all the filters into one eth_getLogs query per polling.
+EVENT_MULTIPLEXING = os.getenv('EVENT_MULTIPLEXING', 'False') == 'True'
+## number of workers which run event callbacks, and queue size per worker.
+EVENT_DISPATCH_WORKERS = int(os.getenv('EVENT_DISPATCH_WORKERS', '4'))
+EVENT_DISPATCH_QUEUE_SIZE = int(os.getenv('EVENT_DISPATCH_QUEUE_SIZE', '256'))
+DISPATCH_BLOCKING_WARN_SEC = 10
+## range of blocks to query at once on replaying missed events.
+REPLAY_CHUNK_BLOCKS = 5000
+## receive events pushed by eth_subscribe, instead of polling.
+## e.g. ws://localhost:8546 (empty to disable)
+EVENT_WEBSOCKET_URI = os.getenv('EVENT_WEBSOCKET_URI', '')
+## wait for pushed events at most this seconds, then poll for sure.
+WS_IDLE_TIMEOUT_SEC = 30
+## blocks to query again on subscribing, to fill the gap of subscription.
+WS_CATCHUP_MARGIN_BLOCKS = 2
+
+
+def match_log(filter_params, log):
+    # check the log matches with address & topics of the filter_params,
+    # in the same manner as the ethereum node does.
+    address = filter_params.get('address')
+    if address:
+        addresses = address if isinstance(address, list) else [address]
+        if log['address'].lower() not in [x.lower() for x in addresses]:
+            return False
+    for idx, topic in enumerate(filter_params.get('topics') or []):
+        if topic is None:
+            continue  # wildcard
+        if idx >= len(log['topics']):
+            return False
+        candidates = topic if isinstance(topic, list) else [topic]
+        if HexBytes(log['topics'][idx]) not in \
+                [HexBytes(x) for x in candidates]:
+            return False
+    return True
+
+
+def merge_filter_params(params_list):
+    # merge address & topic0 of the filter params into one query params.
+    # the result may match more logs than each filter does.
+    addresses = set()
+    topics = set()
+    for params in params_list:
+        address = params.get('address')
+        if not address:
+            addresses = None
+        elif addresses is not None:
+            addresses.update(
+                address if isinstance(address, list) else [address])
+        param_topics = params.get('topics')
+        topic = param_topics[0] if param_topics else None
+        if topic is None:
+            topics = None
+        elif topics is not None:
+            topics.update(topic if isinstance(topic, list) else [topic])
+    merged = dict()
+    if addresses:
+        merged['address'] = sorted(addresses)
+    if topics:
+        merged['topics'] = [sorted(topics)]
+    return merged
+
+
+def ordering_key(event):
+    # events with the same key are processed in sequence.
+    args = event.get('args') or {}
+    return args.get('token') or args.get('tokenURI') or event.get('address')
+
+
+def chain_order(event):
+    return (event.get('blockNumber') or 0, event.get('logIndex') or 0)
+
+
+class EventDispatcher:
+    # Runs event callbacks on a fixed number of workers. Each worker owns a
+    # bounded queue, and events are assigned to a worker by ordering_key(),
+    # so events for one token are processed in order of dispatch.
+    # dispatch() blocks while the queue is full, to apply backpressure on
+    # the listener polling.
+
+    def __init__(
+            self, identity, num_workers=EVENT_DISPATCH_WORKERS,
+            queue_size=EVENT_DISPATCH_QUEUE_SIZE):
+        assert num_workers > 0 and queue_size > 0
+        self.identity = identity
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.__queues = []
+        self.__threads = []
+        self.__lock = Lock()
+        self.__stats = {
+            'dispatched': 0, 'processed': 0, 'failed': 0,
+            'max_depth': 0, 'blocked_sec': 0.0}
+
+    def start(self):
+        self.__lock.acquire()
+        if not self.__threads:
+            for _ in range(self.num_workers):
+                que = Queue(maxsize=self.queue_size)
+                thread = Thread(target=self.__work, args=[que], daemon=True)
+                self.__queues.append(que)
+                self.__threads.append(thread)
+                thread.start()
+        self.__lock.release()
+
+    def stop(self):
+        self.__lock.acquire()
+        queues, self.__queues = self.__queues, []
+        threads, self.__threads = self.__threads, []
+        self.__lock.release()
+        for que in queues:
+            try:
+                que.put(None, timeout=LISTENER_JOIN_TIMEOUT_SEC)  # sentinel
+            except Full:
+                LOGGER.error('failed stopping dispatcher: %s', self.identity)
+        for thread in threads:
+            if thread == current_thread():
+                continue  # stopped from callback
+            thread.join(timeout=LISTENER_JOIN_TIMEOUT_SEC)
+            if thread.is_alive():
+                LOGGER.error(
+                    'failed stopping dispatcher worker: %s', self.identity)
+
+    def dispatch(self, callback, event, on_done=None):
+        # on_done() is called after the callback, even if it failed.
+        # returns False if the event is dropped as the dispatcher stopped.
+        self.start()
+        self.__lock.acquire()
+        queues = self.__queues
+        self.__lock.release()
+        if not queues:  # stopped concurrently
+            LOGGER.warning(
+                'dispatcher stopped, dropped event: %s', self.identity)
+            return False
+        que = queues[hash(ordering_key(event)) % len(queues)]
+        started = time.time()
+        while True:
+            try:
+                que.put(
+                    (callback, event, on_done),
+                    timeout=DISPATCH_BLOCKING_WARN_SEC)
+                break
+            except Full:
+                LOGGER.warning(
+                    'dispatch queue is full, waiting for workers: %s',
+                    self.identity)
+        self.__lock.acquire()
+        self.__stats['dispatched'] += 1
+        self.__stats['blocked_sec'] += time.time() - started
+        self.__stats['max_depth'] = max(
+            self.__stats['max_depth'], que.qsize())
+        self.__lock.release()
+        return True
+
+    def stats(self):
+        self.__lock.acquire()
+        stats = dict(self.__stats)
+        depths = [que.qsize() for que in self.__queues]
+        self.__lock.release()
+        stats['workers'] = len(depths)
+        stats['queue_size'] = self.queue_size
+        stats['depths'] = depths
+        stats['pending'] = sum(depths)
+        return stats
+
+    def __work(self, que):
+        while True:
+            item = que.get()
+            if item is None:
+                break
+            callback, event, on_done = item
+            failed = False
+            try:
+                callback(event)
+            except Exception as err:
+                failed = True
+                LOGGER.exception(err)
+            if on_done:
+                try:
+                    on_done()
+                except Exception as err:
+                    LOGGER.exception(err)
+            self.__lock.acquire()
+            self.__stats['processed'] += 1
+            if failed:
+                self.__stats['failed'] += 1
+            self.__lock.release()
+
+
+class CheckpointStore:
+    # Persists the last processed block number for each listener key.
+    # Events polled up to a block are registered with begin(), and the
+    # checkpoint moves to the block when done() is called for all of them,
+    # and for the events polled before.
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.__checkpoints = dict()  # {key: block number}
+        self.__inflight = dict()  # {key: [[block number, remaining], ...]}
+        self.__dirty = False
+        self.__lock = Lock()
+        try:
+            with open(filepath, 'r') as fin:
+                self.__checkpoints = json.load(fin)
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            LOGGER.error('cannot load checkpoint: %s: %s', filepath, err)
+
+    def get(self, key):
+        return self.__checkpoints.get(key)
+
+    def update(self, key, block_number):
+        self.__lock.acquire()
+        self.__update(key, block_number)
+        self.__lock.release()
+
+    def __update(self, key, block_number):
+        if self.__checkpoints.get(key, -1) < block_number:
+            self.__checkpoints[key] = block_number
+            self.__dirty = True
+
+    def begin(self, key, block_number, count):
+        # count events until block_number are being processed.
+        # returns the batch to give done() for each of them.
+        batch = [block_number, count]
+        self.__lock.acquire()
+        self.__inflight.setdefault(key, []).append(batch)
+        self.__advance(key)
+        self.__lock.release()
+        return batch
+
+    def done(self, key, batch):
+        self.__lock.acquire()
+        batch[1] -= 1
+        self.__advance(key)
+        self.__lock.release()
+
+    def __advance(self, key):
+        batches = self.__inflight.get(key, [])
+        while batches and batches[0][1] <= 0:
+            self.__update(key, batches.pop(0)[0])
+        if not batches:
+            self.__inflight.pop(key, None)
+
+    def discard_inflight(self):
+        # events not processed are replayed from the checkpoint.
+        self.__lock.acquire()
+        self.__inflight.clear()
+        self.__lock.release()
+
+    def save(self):
+        self.__lock.acquire()
+        try:
+            if not self.__dirty:
+                return
+            dirpath = os.path.dirname(self.filepath)
+            if dirpath:
+                os.makedirs(dirpath, exist_ok=True)
+            tmppath = self.filepath + '.tmp'
+            with open(tmppath, 'w') as fout:
+                json.dump(self.__checkpoints, fout, indent=2)
+            os.replace(tmppath, self.filepath)
+            self.__dirty = False
+        except OSError as err:
+            LOGGER.error('cannot save checkpoint: %s: %s', self.filepath, err)
+        finally:
+            self.__lock.release()
+
+
+def replay_logs(event_filter, from_block, to_block):
+    # fetch logs which event_filter should have caught in the range,
+    # in chunks not to overload the node.
+    targets = []
+    params = {
+        key: val for key, val in event_filter.filter_params.items()
+        if key in {'address', 'topics'}}
+    for start in range(from_block, to_block + 1, REPLAY_CHUNK_BLOCKS):
+        params['fromBlock'] = start
+        params['toBlock'] = min(start + REPLAY_CHUNK_BLOCKS - 1, to_block)
+        for log in event_filter.web3.eth.getLogs(params):
+            if event_filter.is_valid_entry(log):
+                targets.append(event_filter.format_entry(log))
+    return targets
 
 
 class BasicEventListener:
 
-    def __init__(self, identity):
+    def __init__(
+            self, identity, multiplex=None, checkpoint_file=None,
+            websocket_uri=None):
         self.__thread = None
         self.__identity = identity
         self.__stopping = True
         self.__prefix = self.__class__.__name__
-        self.__event_filters = dict() # {key: {filter:x, count:x, callback:x}}
+        # {key: {key:x, filter:x, count:x, callback:x,
+        #        replay:x, replay_from:x, dedup_until:x}}
+        self.__event_filters = dict()
         self.__lock = Lock()
         self.__pending_filters = list() # {key:x, filter:x, callback:x}
         self.__pending_lock = Lock()
+        self.__multiplex = \
+            EVENT_MULTIPLEXING if multiplex is None else multiplex
+        self.__last_blocks = dict() # {id(web3): block number}
+        self.__dispatcher = EventDispatcher(identity)
+        self.__checkpoints = \
+            CheckpointStore(checkpoint_file) if checkpoint_file else None
+        self.__polled_blocks = dict()  # {key: block number polled up to}
+        # with websocket, filters are used for their params only, and
+        # polling with eth_getLogs is the fallback while disconnected.
+        websocket_uri = \
+            EVENT_WEBSOCKET_URI if websocket_uri is None else websocket_uri
+        self.__subscriber = \
+            EventSubscriber(websocket_uri, identity) if websocket_uri else None
+        self.__subscribed_epoch = 0
+        self.__seen_logs = dict()  # {(txhash, logIndex): block number}
 
     def destroy(self):
         self.stop()
 
-    def add_event_filter(self, key, event_filter, callback):
+    def add_event_filter(self, key, event_filter, callback, replay=False):
+        # with replay, events emitted since the last checkpoint of the key
+        # are replayed before the live events. (needs checkpoint_file)
         self.__lock.acquire()
         if key in self.__event_filters.keys():
             assert self.__event_filters[key]['callback'] == callback
             self.__event_filters[key]['count'] += 1
         else:
+            replay = replay and self.__checkpoints is not None
+            checkpoint = self.__checkpoints.get(key) if replay else None
             self.__event_filters[key] = {
-                'filter':event_filter, 'callback': callback, 'count': 1}
+                'key': key,
+                'filter':event_filter, 'callback': callback, 'count': 1,
+                'replay': replay,
+                'replay_from': None if checkpoint is None else checkpoint + 1,
+                'dedup_until': -1}
             LOGGER.debug('start watching: %s', key)
         self.__lock.release()
         if not self.__stopping:
@@ -80,53 +398,71 @@ class BasicEventListener:
         self.__stopping = False
         if len(self.__event_filters) == 0:
             return
+        if self.__subscriber:
+            self.__subscriber.start()
         self.__thread = Thread(target=self.__run, daemon=True)
         self.__thread.start()
 
     def stop(self):
         if not self.__thread:
+            self.__dispatcher.stop()
             return
         LOGGER.info('%s: stopping %s', self.__prefix, self.__identity)
         self.__stopping = True
+        if self.__subscriber:
+            self.__subscriber.wakeup.set()
         self.__thread.join(timeout=LISTENER_JOIN_TIMEOUT_SEC)
         if self.__thread and self.__thread.is_alive():
             LOGGER.error('failed stopping listener: %s', self.__identity)
             return
+        self.__dispatcher.stop()
+        if self.__checkpoints:
+            self.__checkpoints.discard_inflight()
+            self.__checkpoints.save()
         self.__event_filters.clear()
         self.__pending_filters.clear()
         self.__thread = None
 
+    def dispatch_stats(self):
+        return self.__dispatcher.stats()
+
     def __run(self):
         LOGGER.info('%s: starting %s', self.__prefix, self.__identity)
         while True:
             if len(self.__event_filters) == 0:
                 break
 
+            if self.__subscriber:
+                self.__subscriber.wakeup.clear()
             self.__lock.acquire()
-            for value in self.__event_filters.values():
-                try:
-                    events = value['filter'].get_new_entries()
-                except (ConnError, HTTPError) as err:
-                    LOGGER.warning(
-                        'could not connect to ethereum network: %s', err)
-                    break  # retry on next time
-
-                for event in events:
-                    if self.__stopping:
-                        break
-                    LOGGER.info(
-                        'event %s: address=%s args=%s',
-                        event['event'], event['address'], event['args'])
-
-                    Thread(target=value['callback'], args=[event]).start()
+            targets = self.__replay_filters()
+            if self.__subscriber:
+                targets.extend(self.__poll_subscribed())
+            elif self.__multiplex:
+                targets.extend(self.__poll_multiplexed())
+            else:
+                targets.extend(self.__poll_filters())
+            polled, self.__polled_blocks = self.__polled_blocks, dict()
+            self.__lock.release()
 
+            # dispatch out of the lock, callbacks may touch filters.
+            targets.sort(key=lambda x: chain_order(x[1]))
+            hooks = self.__begin_checkpoints(polled, targets)
+            for value, event in targets:
                 if self.__stopping:
                     break
-            self.__lock.release()
+                self.__dispatch(value, event, hooks.get(value['key']))
+            if self.__checkpoints:
+                self.__checkpoints.save()
 
             if self.__stopping:
                 break
-            time.sleep(EVENT_POLLING_INTERVAL_SEC)
+            if self.__subscriber:
+                self.__subscriber.wakeup.wait(
+                    WS_IDLE_TIMEOUT_SEC if self.__subscriber.live()
+                    else EVENT_POLLING_INTERVAL_SEC)
+            else:
+                time.sleep(EVENT_POLLING_INTERVAL_SEC)
 
             self.__pending_lock.acquire()
             for item in self.__pending_filters:
@@ -139,4 +475,188 @@ class BasicEventListener:
             self.__pending_lock.release()
 
         LOGGER.info('%s: thread exiting: %s', self.__prefix, self.__identity)
+        if self.__subscriber:
+            self.__subscriber.stop()
+            self.__subscribed_epoch = 0
+            self.__seen_logs.clear()
+        self.__last_blocks.clear()
         self.__thread = None
+
+    def __dispatch(self, value, event, on_done):
+        LOGGER.info(
+            'event %s: address=%s args=%s',
+            event['event'], event['address'], event['args'])
+        self.__dispatcher.dispatch(value['callback'], event, on_done)
+
+    def __update_checkpoints(self, values, block_number):
+        # events until block_number are polled. the checkpoints move after
+        # the callbacks of the events finish, in __begin_checkpoints().
+        if not self.__checkpoints:
+            return
+        for value in values:
+            if value['replay']:
+                self.__polled_blocks[value['key']] = max(
+                    block_number, self.__polled_blocks.get(value['key'], -1))
+
+    def __begin_checkpoints(self, polled, targets):
+        # returns {key: hook to call when an event of the key is processed}
+        if not self.__checkpoints:
+            return dict()
+        counts = {key: 0 for key in polled}
+        for value, _ in targets:
+            if value['replay']:
+                counts[value['key']] = counts.get(value['key'], 0) + 1
+        hooks = dict()
+        for key, count in counts.items():
+            # -1 for events polled without checkpoint. keeps them in order.
+            batch = self.__checkpoints.begin(
+                key, polled.get(key, -1), count)
+            hooks[key] = partial(self.__checkpoints.done, key, batch)
+        return hooks
+
+    def __replay_filters(self):
+        targets = []  # [(value, event), ...]
+        for key, value in self.__event_filters.items():
+            if value['replay_from'] is None:
+                continue
+            try:
+                latest = value['filter'].web3.eth.blockNumber
+                LOGGER.info(
+                    'replaying %s from block %d to %d',
+                    key, value['replay_from'], latest)
+                events = replay_logs(
+                    value['filter'], value['replay_from'], latest)
+            except (ConnError, HTTPError) as err:
+                LOGGER.warning(
+                    'could not connect to ethereum network: %s', err)
+                break  # retry on next time
+            targets.extend([(value, event) for event in events])
+            # live filter may return the same events up to latest.
+            value['dedup_until'] = latest
+            value['replay_from'] = None
+            self.__update_checkpoints([value], latest)
+        return targets
+
+    def __poll_filters(self):
+        targets = []  # [(value, event), ...]
+        # block number to checkpoint. events until here are polled below.
+        checkpoints = dict()  # {id(web3): block number}
+        try:
+            for value in self.__event_filters.values():
+                web3 = value['filter'].web3
+                if value['replay'] and id(web3) not in checkpoints:
+                    checkpoints[id(web3)] = web3.eth.blockNumber
+        except (ConnError, HTTPError) as err:
+            LOGGER.warning('could not connect to ethereum network: %s', err)
+            return targets  # retry on next time
+
+        for value in self.__event_filters.values():
+            try:
+                events = value['filter'].get_new_entries()
+            except (ConnError, HTTPError) as err:
+                LOGGER.warning(
+                    'could not connect to ethereum network: %s', err)
+                return targets  # retry on next time, without checkpoints
+
+            targets.extend([
+                (value, event) for event in events
+                if event['blockNumber'] > value['dedup_until']])
+
+            if self.__stopping:
+                return targets
+        for value in self.__event_filters.values():
+            block_number = checkpoints.get(id(value['filter'].web3))
+            if block_number is not None:
+                self.__update_checkpoints([value], block_number)
+        return targets
+
+    def __poll_multiplexed(self):
+        # filters may come from different web3 (e.g. another EOA).
+        targets = []  # [(value, event), ...]
+        groups = dict()  # {id(web3): [value, ...]}
+        for value in self.__event_filters.values():
+            groups.setdefault(id(value['filter'].web3), []).append(value)
+
+        for web3_id, values in groups.items():
+            web3 = values[0]['filter'].web3
+            try:
+                latest = web3.eth.blockNumber
+                last = self.__last_blocks.get(web3_id)
+                if last is None:  # first time. start from latest.
+                    self.__last_blocks[web3_id] = latest
+                    continue
+                if latest <= last:
+                    continue
+                params = merge_filter_params(
+                    [value['filter'].filter_params for value in values])
+                params['fromBlock'] = last + 1
+                params['toBlock'] = latest
+                logs = web3.eth.getLogs(params)
+            except (ConnError, HTTPError) as err:
+                LOGGER.warning(
+                    'could not connect to ethereum network: %s', err)
+                break  # retry on next time
+            self.__last_blocks[web3_id] = latest
+
+            for log in logs:
+                targets.extend(self.__demultiplex(log, values))
+            self.__update_checkpoints(values, latest)
+        return targets
+
+    def __poll_subscribed(self):
+        targets = []  # [(value, event), ...]
+        values = list(self.__event_filters.values())
+        self.__subscriber.set_log_params(merge_filter_params(
+            [value['filter'].filter_params for value in values]))
+        if not self.__subscriber.live():
+            targets.extend(self.__poll_multiplexed())
+            self.__prune_seen_logs()
+            return targets
+
+        head, logs = self.__subscriber.pop()
+        if self.__subscribed_epoch != self.__subscriber.epoch:
+            # (re)subscribed. catch up events missed before subscription.
+            self.__subscribed_epoch = self.__subscriber.epoch
+            targets.extend(self.__poll_multiplexed())
+        for log in logs:
+            if log.get('removed'):
+                LOGGER.warning('ignored log removed by reorg: %s', log)
+                continue
+            targets.extend(
+                self.__demultiplex(log_entry_formatter(log), values))
+
+        if head is not None:
+            # logs until a few blocks ago should have been pushed.
+            block_number = head - WS_CATCHUP_MARGIN_BLOCKS
+            for web3_id in {id(value['filter'].web3) for value in values}:
+                if self.__last_blocks.get(web3_id, -1) < block_number:
+                    self.__last_blocks[web3_id] = block_number
+            self.__update_checkpoints(values, block_number)
+        self.__prune_seen_logs()
+        return targets
+
+    def __prune_seen_logs(self):
+        # pushed logs and catching up may overlap within the margin.
+        if not self.__last_blocks:
+            return
+        floor = min(self.__last_blocks.values()) - WS_CATCHUP_MARGIN_BLOCKS
+        self.__seen_logs = {
+            key: val for key, val in self.__seen_logs.items() if val > floor}
+
+    def __demultiplex(self, log, values):
+        targets = []  # [(value, event), ...]
+        if self.__subscriber:
+            log_id = (HexBytes(log['transactionHash']), log['logIndex'])
+            if log_id in self.__seen_logs:
+                return targets
+            self.__seen_logs[log_id] = log['blockNumber']
+        for value in values:
+            event_filter = value['filter']
+            if log['blockNumber'] <= value['dedup_until']:
+                continue  # already replayed
+            if not match_log(event_filter.filter_params, log):
+                continue
+            if not event_filter.is_valid_entry(log):
+                continue  # mismatch with non-indexed arguments
+            targets.append((value, event_filter.format_entry(log)))
+        return targets
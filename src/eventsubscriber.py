@@ -0,0 +1,167 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import asyncio
+import json
+import logging
+from threading import Thread, Lock, Event
+import websockets
+
+LOGGER = logging.getLogger('common')
+
+WS_RECONNECT_INTERVAL_SEC = 5
+WS_MAX_MESSAGE_SIZE = 2 ** 24
+SUBSCRIBER_JOIN_TIMEOUT_SEC = 30
+
+
+class EventSubscriber:
+    # Client of eth_subscribe (newHeads and logs) over WebSocket.
+    # Runs an asyncio loop in its own thread, and keeps pushed logs and
+    # the latest block number until the listener pops them.
+    # Reconnects automatically. The listener should poll while not live().
+
+    def __init__(self, uri, identity):
+        self.uri = uri
+        self.identity = identity
+        self.wakeup = Event()  # set when something is pushed or lost
+        self.epoch = 0  # incremented every time logs are (re)subscribed
+        self.__thread = None
+        self.__loop = None
+        self.__conn = None
+        self.__stopping = True
+        self.__lock = Lock()
+        self.__head = None
+        self.__logs = []
+        self.__log_params = None
+        self.__request_id = 0
+        self.__requests = dict()  # {request id: kind}
+        self.__subscriptions = dict()  # {subscription id: kind}
+
+    def start(self):
+        if self.__thread:
+            return
+        self.__stopping = False
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if not self.__thread:
+            return
+        LOGGER.info('EventSubscriber: stopping %s', self.identity)
+        self.__stopping = True
+        if self.__conn:
+            asyncio.run_coroutine_threadsafe(self.__conn.close(), self.__loop)
+        self.__thread.join(timeout=SUBSCRIBER_JOIN_TIMEOUT_SEC)
+        if self.__thread.is_alive():
+            LOGGER.error('failed stopping subscriber: %s', self.identity)
+            return
+        self.__thread = None
+
+    def live(self):
+        return self.__conn is not None and \
+            'logs' in self.__subscriptions.values()
+
+    def set_log_params(self, params):
+        # params: {address:x, topics:x} for eth_subscribe logs.
+        if params == self.__log_params:
+            return
+        self.__log_params = params
+        if self.__conn:
+            asyncio.run_coroutine_threadsafe(
+                self.__subscribe('logs', params), self.__loop)
+
+    def pop(self):
+        self.__lock.acquire()
+        head, logs, self.__logs = self.__head, self.__logs, []
+        self.__lock.release()
+        return head, logs
+
+    def __run(self):
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_until_complete(self.__main())
+        finally:
+            self.__loop.close()
+
+    async def __main(self):
+        while not self.__stopping:
+            try:
+                async with websockets.connect(
+                        self.uri, max_size=WS_MAX_MESSAGE_SIZE) as conn:
+                    LOGGER.info('EventSubscriber: connected to %s', self.uri)
+                    self.__conn = conn
+                    await self.__subscribe('newHeads')
+                    if self.__log_params is not None:
+                        await self.__subscribe('logs', self.__log_params)
+                    async for message in conn:
+                        await self.__on_message(json.loads(message))
+            except (OSError, websockets.exceptions.WebSocketException) as err:
+                if not self.__stopping:
+                    LOGGER.warning(
+                        'EventSubscriber: lost connection to %s: %s',
+                        self.uri, err)
+            finally:
+                self.__conn = None
+                self.__requests.clear()
+                self.__subscriptions.clear()
+                self.wakeup.set()  # let listener fall back to polling
+            if not self.__stopping:
+                await asyncio.sleep(WS_RECONNECT_INTERVAL_SEC)
+
+    async def __send(self, method, params, kind=None):
+        self.__request_id += 1
+        self.__requests[self.__request_id] = kind
+        await self.__conn.send(json.dumps({
+            'jsonrpc': '2.0', 'id': self.__request_id,
+            'method': method, 'params': params}))
+
+    async def __subscribe(self, kind, params=None):
+        await self.__send(
+            'eth_subscribe', [kind] if params is None else [kind, params],
+            kind)
+
+    async def __on_message(self, msg):
+        if 'id' in msg:  # response for __send()
+            kind = self.__requests.pop(msg['id'], None)
+            if 'error' in msg:
+                LOGGER.error('EventSubscriber: %s', msg['error'])
+                return
+            if kind is None:  # eth_unsubscribe
+                return
+            # new subscription is active. drop the old one, if any.
+            olds = [sid for sid, val in self.__subscriptions.items()
+                    if val == kind]
+            self.__subscriptions[msg['result']] = kind
+            for sid in olds:
+                del self.__subscriptions[sid]
+                await self.__send('eth_unsubscribe', [sid])
+            if kind == 'logs':
+                self.epoch += 1
+            self.wakeup.set()
+            return
+
+        if msg.get('method') != 'eth_subscription':
+            return
+        kind = self.__subscriptions.get(msg['params']['subscription'])
+        result = msg['params']['result']
+        self.__lock.acquire()
+        if kind == 'newHeads':
+            self.__head = int(result['number'], 16)
+        elif kind == 'logs':
+            self.__logs.append(result)
+        self.__lock.release()
+        self.wakeup.set()
@@ -19,23 +19,54 @@ import sys
 import json
 import glob
 import time
+import hashlib
 import logging
 import pathlib
 import argparse
+import ctypes
+import ctypes.util
+import select
+import struct
+from concurrent.futures import ProcessPoolExecutor
 from threading import Thread
-from socketserver import TCPServer
-from http.server import SimpleHTTPRequestHandler
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pymisp import MISPEvent
 
 LOGGER = logging.getLogger(__name__)
 
 JOIN_TIMEOUT_SEC = 30
+## persisted state to regenerate changed events only.
+STATE_FILENAME = '.feed_state.json'
+STATE_VERSION = 1
+## number of processes converting events. None for number of CPUs.
+FEED_WORKERS = int(os.getenv('FEED_WORKERS', '0')) or None
+## changes are gathered until quiet for DEBOUNCE_SEC, up to MAX_DELAY_SEC.
+DEBOUNCE_SEC = 0.5
+MAX_DELAY_SEC = 5.0
+POLL_INTERVAL_SEC = 1.0
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def write_atomic(path, data):
+    # readers see old or new file, never half-written one.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        fout.write(data)
+    os.replace(tmp_path, path)
 
 
 def save_event(outputdir, event):
     try:
-        with open(os.path.join(outputdir, f'{event["Event"]["uuid"]}.json'), 'w') as f:
-            json.dump(event, f, indent=2)
+        write_atomic(
+            os.path.join(outputdir, f'{event["Event"]["uuid"]}.json'),
+            json.dumps(event, indent=2))
     except Exception as e:
         print(e)
         sys.exit('Could not create the event dump.')
@@ -43,9 +74,8 @@ def save_event(outputdir, event):
 
 def save_manifest(outputdir, manifest):
     try:
-        manifestFile = open(os.path.join(outputdir, 'manifest.json'), 'w')
-        manifestFile.write(json.dumps(manifest))
-        manifestFile.close()
+        write_atomic(
+            os.path.join(outputdir, 'manifest.json'), json.dumps(manifest))
     except Exception as e:
         print(e)
         sys.exit('Could not create the manifest file.')
@@ -53,37 +83,300 @@ def save_manifest(outputdir, manifest):
 
 def save_hashes(outputdir, hashes):
     try:
-        with open(os.path.join(outputdir, 'hashes.csv'), 'w') as hashFile:
-            for element in hashes:
-                hashFile.write('{},{}\n'.format(element[0], element[1]))
+        write_atomic(
+            os.path.join(outputdir, 'hashes.csv'),
+            ''.join('{},{}\n'.format(h, uuid) for h, uuid in hashes))
     except Exception as e:
         print(e)
         sys.exit('Could not create the quick hash lookup file.')
 
 
-def generate_feed(inputdir, outputdir):
-    manifest = {}
-    hashes = []
-    for file in glob.glob(os.path.join(inputdir, '*.json')):
-        print(file)
-        event = MISPEvent()
-        event.from_json(open(file).read())
-        event_feed = event.to_feed(with_meta=True)
-        
-        hashes += [[h, event.uuid] for h in event_feed['Event'].pop('_hashes')]
-        manifest.update(event_feed['Event'].pop('_manifest'))
-        save_event(outputdir, event_feed)
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def convert_event(path, outputdir):
+    # runs in worker process. returns the state entry of the input.
+    with open(path, 'rb') as fin:
+        raw = fin.read()
+    event = MISPEvent()
+    event.from_json(raw.decode())
+    event_feed = event.to_feed(with_meta=True)
+    hashes = event_feed['Event'].pop('_hashes')
+    manifest = event_feed['Event'].pop('_manifest')
+    save_event(outputdir, event_feed)
+    return {
+        'sha256': hashlib.sha256(raw).hexdigest(),
+        'uuid': event.uuid,
+        'hashes': hashes,
+        'manifest': manifest,
+        }
+
+
+def load_state(outputdir):
+    try:
+        with open(os.path.join(outputdir, STATE_FILENAME)) as fin:
+            state = json.load(fin)
+        if state.get('version') == STATE_VERSION:
+            return state
+    except FileNotFoundError:
+        pass
+    except ValueError as err:
+        LOGGER.warning('rebuilding feed for broken state: %s', err)
+    return {'version': STATE_VERSION, 'files': {}}
+
+
+def generate_feed(inputdir, outputdir, paths=None, workers=FEED_WORKERS):
+    # regenerate events of the input files changed since the last run.
+    # paths: candidates of change (created, modified or deleted).
+    #        all *.json in inputdir if None.
+    # returns number of the events regenerated and removed.
+    state = load_state(outputdir)
+    files = state['files']  # {filename: entry}
+    if paths is None:
+        names = {
+            os.path.basename(path)
+            for path in glob.glob(os.path.join(inputdir, '*.json'))}
+        names |= set(files.keys())  # to find deleted ones
+    else:
+        names = {
+            os.path.basename(path) for path in paths
+            if str(path).endswith('.json')}
+
+    changed = dict()  # {filename: (mtime_ns, size)}
+    removed = []
+    touched = 0
+    for name in names:
+        path = os.path.join(inputdir, name)
+        entry = files.get(name)
+        try:
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+            if entry and (entry['mtime_ns'], entry['size']) == key:
+                continue
+            if entry and entry['sha256'] == file_sha256(path):  # touched
+                entry['mtime_ns'], entry['size'] = key
+                touched += 1
+                continue
+        except FileNotFoundError:  # deleted or renamed meanwhile
+            if entry:
+                removed.append(name)
+            continue
+        except OSError as err:  # e.g. being written. next change retries.
+            LOGGER.warning('skipped %s: %s', name, err)
+            continue
+        changed[name] = key
+    if not changed and not removed:
+        if touched:  # not to hash them again on the next run.
+            write_atomic(
+                os.path.join(outputdir, STATE_FILENAME), json.dumps(state))
+        return 0, 0
+
+    manifest = load_manifest(outputdir, files)
+    obsolete = set()  # uuids no longer generated
+    for name in removed:
+        entry = files.pop(name)
+        manifest.pop(entry['uuid'], None)
+        obsolete.add(entry['uuid'])
+
+    converted = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(
+                convert_event, os.path.join(inputdir, name), outputdir)
+            for name in sorted(changed)}
+        for name, future in futures.items():
+            print(os.path.join(inputdir, name))
+            try:
+                result = future.result()
+            except Exception as err:
+                LOGGER.error('skipped %s: %s', name, err)
+                continue
+            old = files.get(name)
+            if old and old['uuid'] != result['uuid']:
+                manifest.pop(old['uuid'], None)
+                obsolete.add(old['uuid'])
+            result['mtime_ns'], result['size'] = changed[name]
+            files[name] = result
+            manifest.update(result['manifest'])
+            obsolete.discard(result['uuid'])
+            converted += 1
 
+    # events are written before, and removed after the manifest, so that
+    # the manifest never refers a missing event.
     save_manifest(outputdir, manifest)
-    save_hashes(outputdir, hashes)
+    save_hashes(outputdir, [
+        [h, entry['uuid']]
+        for entry in files.values() for h in entry['hashes']])
+    write_atomic(os.path.join(outputdir, STATE_FILENAME), json.dumps(state))
+    for uuid in obsolete:
+        try:
+            os.remove(os.path.join(outputdir, f'{uuid}.json'))
+        except FileNotFoundError:
+            pass
+    return converted, len(removed)
+
+
+def load_manifest(outputdir, files):
+    # manifest.json is updated in place, or rebuilt from the state.
+    if not files:  # first run. entries of the old full run are stale.
+        return {}
+    try:
+        with open(os.path.join(outputdir, 'manifest.json')) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        manifest = {}
+        for entry in files.values():
+            manifest.update(entry['manifest'])
+        return manifest
+
+
+class InotifySource():
+    # changed filenames in the directory, by inotify(7) via libc.
+
+    def __init__(self, dirpath):
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+        if self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dirpath), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed')
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        # returns set of filenames changed, or None if events are lost.
+        rfds, _, _ = select.select([self.fd], [], [], timeout)
+        if not rfds:
+            return set()
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = buf[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+
+class PollingSource():
+    # changed filenames in the directory, by comparing mtime and size.
+
+    def __init__(self, dirpath, interval=POLL_INTERVAL_SEC):
+        self.dirpath = dirpath
+        self.interval = interval
+        self.stats = self.__scan()
+
+    def close(self):
+        pass
+
+    def __scan(self):
+        stats = {}
+        with os.scandir(self.dirpath) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        stats = self.__scan()
+        names = {
+            name for name in stats.keys() | self.stats.keys()
+            if stats.get(name) != self.stats.get(name)}
+        self.stats = stats
+        return names
+
+
+def open_source(dirpath, mode='auto'):
+    if mode in {'auto', 'inotify'}:
+        try:
+            return InotifySource(dirpath)
+        except (OSError, AttributeError) as err:  # not on Linux, etc.
+            if mode == 'inotify':
+                raise
+            LOGGER.warning('inotify unavailable, polling: %s', err)
+    return PollingSource(dirpath)
+
+
+def watch(inputdir, callback, mode='auto'):
+    # call callback with the changed paths (None to check all), after
+    # a burst of changes settles.
+    source = open_source(inputdir, mode)
+    pending = set()
+    rescan = False
+    first = last = None
+    try:
+        while True:
+            names = source.wait(DEBOUNCE_SEC if first else POLL_INTERVAL_SEC)
+            now = time.time()
+            if names is None:
+                rescan = True
+            else:
+                pending |= names
+            if names is None or names:
+                first = first or now
+                last = now
+            if first and (now - last >= DEBOUNCE_SEC or
+                          now - first >= MAX_DELAY_SEC):
+                paths = None if rescan else [
+                    os.path.join(inputdir, name) for name in pending]
+                pending = set()
+                rescan = False
+                first = last = None
+                try:
+                    callback(paths)
+                except Exception as err:
+                    # changes may be lost. check all on the next change.
+                    LOGGER.exception(err)
+                    rescan = True
+    finally:
+        source.close()
+
+
+class FeedHandler(SimpleHTTPRequestHandler):
+    # feed files are replaced by rename, so a response is always a
+    # complete file. state and temporary files are hidden.
+
+    def send_head(self):
+        name = os.path.basename(self.path.split('?', 1)[0].rstrip('/'))
+        if name.startswith('.') or name.endswith('.tmp'):
+            self.send_error(404, 'File not found')
+            return None
+        return super().send_head()
+
+    def log_message(self, *args):
+        LOGGER.info(args[0], *args[1:])
 
 
 class FeedHttpServer():
 
-    def __init__(self, port):
+    def __init__(self, port, directory=None):
         self.thread = None
         self.server = None
         self.port = port
+        self.directory = directory
 
     def start(self):
         if self.thread:
@@ -92,7 +385,9 @@ class FeedHttpServer():
         self.thread.start()
 
     def run(self):
-        with TCPServer(("", self.port), SimpleHTTPRequestHandler) as httpd:
+        def handler(*args):
+            return FeedHandler(*args, directory=self.directory)
+        with ThreadingHTTPServer(("", self.port), handler) as httpd:
             self.server = httpd
             httpd.serve_forever()
 
@@ -122,6 +417,13 @@ if __name__ == '__main__':
     parser.add_argument(
         '-p', '--port', action='store', type=int, default=8080,
         help='Port number of feed server')
+    parser.add_argument(
+        '-j', '--jobs', action='store', type=int, default=FEED_WORKERS,
+        help='Number of processes converting events')
+    parser.add_argument(
+        '-w', '--watch', action='store', default='auto',
+        choices=['auto', 'inotify', 'poll'],
+        help='How feed server detects changes of input directory')
     args = parser.parse_args()
 
     # convert to abs path
@@ -131,20 +433,18 @@ if __name__ == '__main__':
     output_rel = pathlib.Path(args.outputdir)
     output_abs = output_rel.resolve()
 
-    generate_feed(input_abs, output_abs)
+    generate_feed(input_abs, output_abs, workers=args.jobs)
 
     if args.server:
-        os.chdir(output_abs)
-        feedserver = FeedHttpServer(args.port)
+        feedserver = FeedHttpServer(args.port, str(output_abs))
         feedserver.start()
-
-        event_files = set(os.listdir(input_abs))
         try:
-            while True:
-                current_files = set(os.listdir(input_abs))
-                if event_files != current_files:
-                    generate_feed(input_abs, output_abs)
-                    event_files = current_files
-                time.sleep(1)
+            watch(
+                input_abs,
+                lambda paths: generate_feed(
+                    input_abs, output_abs, paths, workers=args.jobs),
+                mode=args.watch)
         except KeyboardInterrupt:
+            pass
+        finally:
             feedserver.stop()
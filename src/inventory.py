@@ -17,16 +17,22 @@
 import logging
 import time
 import inspect
-import copy
+from collections.abc import Mapping
+from itertools import count
+from threading import Lock
+from types import MappingProxyType
 from web3 import Web3
 from ens.constants import EMPTY_ADDR_HEX
 from ctibroker import CTIBroker
 from cticatalog import CTICatalog
 from ctitoken import CTIToken
+from batch_call import BatchCall
+from search_index import SearchIndex
 from client_ui import PTS_RATE
 
 LOGGER = logging.getLogger('common')
 CATALOG_ID_BIAS = 1000  # XXX temporal value
+VERSIONS = count(1)  # versions of catalogs, unique over the process
 
 
 def catalog_tokens_key(catalog, token):
@@ -39,6 +45,56 @@ def divide_token_key(token_key):
     return catalog, token
 
 
+class CatalogTokensView(Mapping):
+    # Read-only merged view of catalog tokens, {token_key: metadata}.
+    # A view is never modified. CatalogList returns the same view until
+    # the catalogs change, so reading it does not copy the tokens.
+    # Secondary indexes are built on first use, once per view.
+
+    def __init__(self, tokens, version):
+        self.__tokens = tokens  # {token_key: MappingProxyType}
+        self.version = version
+        self.__owners = None  # {owner: {token_key: metadata}}
+        self.__token_ids = None  # {tokenId: token_key}
+        self.__holding = None  # {token_key: metadata} of balance > 0
+
+    def __getitem__(self, key):
+        return self.__tokens[key]
+
+    def __iter__(self):
+        return iter(self.__tokens)
+
+    def __len__(self):
+        return len(self.__tokens)
+
+    def by_owner(self, owner):
+        if self.__owners is None:
+            owners = dict()
+            for key, metadata in self.__tokens.items():
+                owners.setdefault(metadata['owner'], dict())[key] = metadata
+            self.__owners = {
+                owner: MappingProxyType(tokens)
+                for owner, tokens in owners.items()}
+        return self.__owners.get(owner, MappingProxyType({}))
+
+    def by_token_id(self, token_id):
+        # (token_key, metadata), or None.
+        if self.__token_ids is None:
+            self.__token_ids = {
+                metadata['tokenId']: key
+                for key, metadata in self.__tokens.items()}
+        key = self.__token_ids.get(token_id)
+        return None if key is None else (key, self.__tokens[key])
+
+    def holding(self):
+        # tokens of which the user has balance.
+        if self.__holding is None:
+            self.__holding = MappingProxyType({
+                key: metadata for key, metadata in self.__tokens.items()
+                if metadata.get('balanceOfUser', 0) > 0})
+        return self.__holding
+
+
 class Inventory:
     def __init__(
             self, contracts, account_id, event_listener, broker_address=None):
@@ -86,6 +142,11 @@ class Inventory:
     def catalog_tokens(self):
         return self.catalog_list.catalog_tokens
 
+    def search(self, query):
+        # {token_key: metadata} of active catalogs matching the query.
+        # see search_index.parse_query() for the syntax.
+        return self.catalog_list.search(query)
+
     def is_catalog_owner(self, address):
         return self.catalog_list.is_owner(address)
 
@@ -130,7 +191,7 @@ class Inventory:
             return []
         tokens = [
             v['token_address'] for v
-            in self.catalog_tokens.values() if v['owner'] == account_id]
+            in self.catalog_tokens.by_owner(account_id).values()]
         return tokens
 
     def update_balanceof_myself(self, token_address, catalog_address=None):
@@ -218,6 +279,9 @@ class CatalogList:
         self.catalog_user = catalog_user
         self.event_listener = event_listener
         self.catalogs = {}  # {addr: {index, active, catalog}}
+        self.__parts = dict()  # {addr: (version, index, {key: metadata})}
+        self.__views = dict()  # {(addresses, active): (state, view)}
+        self.__lock = Lock()
 
     def destroy(self):
         for catalog in self.catalogs.values():
@@ -265,6 +329,7 @@ class CatalogList:
             return
         self.catalogs[address]['catalog'].destroy()
         del self.catalogs[address]
+        self.__parts.pop(address, None)
 
     def activate(self, address):
         assert address in self.catalogs.keys()
@@ -291,6 +356,14 @@ class CatalogList:
         for catalog in self.catalogs.values():
             catalog['catalog'].update_balanceof_myself(token_address)
 
+    def update_balanceof_myself_list(
+            self, token_addresses, catalog_address=None):
+        if catalog_address:
+            self.passthrough(catalog_address, token_addresses)
+            return
+        for catalog in self.catalogs.values():
+            catalog['catalog'].update_balanceof_myself_list(token_addresses)
+
 #    def _index_to_address(self, index):
 #        tgt = [k for k, v in self.catalogs.items() if v['index'] == index]
 #        return tgt[0] if tgt else None
@@ -300,23 +373,62 @@ class CatalogList:
         return self.fixed_tokens(active=True)
 
     def fixed_tokens(self, addresses=None, active=None):
+        # returns CatalogTokensView, memoized until the catalogs change.
+        cache_key = (tuple(addresses) if addresses else None, active)
         if not addresses:
             addresses = self.catalogs.keys()
-        fixed = dict()
-        for addr, val in self.catalogs.items():
-            if addr not in addresses:
-                continue
-            if active is not None and active != val['active']:
-                continue
-            tokens = copy.deepcopy(val['catalog'].catalog_tokens)
-            for token, metadata in tokens.items():
-                metadata['token_address'] = token
-                metadata['catalog_address'] = addr
-                metadata['tokenId'] += val['index'] * CATALOG_ID_BIAS  # overwr
+        targets = [
+            (addr, val) for addr, val in list(self.catalogs.items())
+            if addr in addresses and
+            (active is None or active == val['active'])]
+        state = tuple(
+            (addr, val['index'], val['catalog'].version)
+            for addr, val in targets)
+        self.__lock.acquire()
+        try:
+            cached = self.__views.get(cache_key)
+            if cached and cached[0] == state:
+                return cached[1]
+            fixed = dict()
+            for addr, val in targets:
+                fixed.update(self.__part(addr, val))
+            view = CatalogTokensView(fixed, state)
+            self.__views[cache_key] = (state, view)
+            return view
+        finally:
+            self.__lock.release()
+
+    def __part(self, addr, val):
+        # tokens of a catalog, rebuilt only if the catalog is changed.
+        catalog = val['catalog']
+        version = catalog.version  # read before, not to miss changes
+        part = self.__parts.get(addr)
+        if part and part[0] == version and part[1] == val['index']:
+            return part[2]
+        tokens = dict()
+        for token, metadata in list(catalog.catalog_tokens.items()):
+            metadata = dict(metadata)
+            metadata['token_address'] = token
+            metadata['catalog_address'] = addr
+            metadata['tokenId'] += val['index'] * CATALOG_ID_BIAS  # overwr
+            tokens[catalog_tokens_key(addr, token)] = \
+                MappingProxyType(metadata)
+        self.__parts[addr] = (version, val['index'], tokens)
+        return tokens
 
+    def search(self, query, addresses=None, active=True):
+        view = self.fixed_tokens(addresses, active)
+        hits = []
+        for addr, val in list(self.catalogs.items()):
+            for token in val['catalog'].search_index.search(query):
                 key = catalog_tokens_key(addr, token)
-                fixed[key] = metadata
-        return fixed
+                if key in view:
+                    hits.append(view[key])
+        hits.sort(key=lambda x: x['tokenId'])  # as same as the view
+        return {
+            catalog_tokens_key(metadata['catalog_address'],
+                               metadata['token_address']): metadata
+            for metadata in hits}
 
     def is_owner(self, catalog_address):
         return self.passthrough(catalog_address)
@@ -380,15 +492,23 @@ class Catalog:
         self.catalog_owner = self.cticatalog.get_owner()
         self.catalog_user = catalog_user
         self.is_owner = (self.catalog_owner == self.catalog_user)
+        # replayed events may arrive before init_catalog() completes.
+        self.catalog_tokens = dict()
+        self.like_users = dict()
+        # renewed when catalog_tokens are changed.
+        self.version = next(VERSIONS)
+        self.search_index = SearchIndex()
 
         event_filter = self.cticatalog.event_filter(
             'CtiInfo', fromBlock='latest')
         event_listener.add_event_filter(
-            'CtiInfo:'+catalog_address, event_filter, self.ctiinfo_callback)
+            'CtiInfo:'+catalog_address, event_filter, self.ctiinfo_callback,
+            replay=True)
         event_filter = self.cticatalog.event_filter(
             'CtiLiked', fromBlock='latest')
         event_listener.add_event_filter(
-            'CtiLiked:'+catalog_address, event_filter, self.liked_callback)
+            'CtiLiked:'+catalog_address, event_filter, self.liked_callback,
+            replay=True)
         event_listener.start()
         self.event_listener = event_listener
 
@@ -431,6 +551,8 @@ class Catalog:
         if len(cti['uuid']) == 0:
             # removed
             del self.catalog_tokens[cti['tokenURI']]
+            self.search_index.remove(cti['tokenURI'])
+            self.version = next(VERSIONS)
             LOGGER.info('CTI removed: %s: %s', cti['title'], cti['tokenURI'])
             return
 
@@ -453,6 +575,8 @@ class Catalog:
         target['title'] = cti['title']
         target['price'] = cti['price']
         target['operator'] = cti['operator']
+        self.search_index.add(cti['tokenURI'], target)
+        self.version = next(VERSIONS)
 
         self.update_balanceof_myself(cti['tokenURI'])
 
@@ -461,11 +585,9 @@ class Catalog:
         catalog = dict()
 
         tokens = self.cticatalog.list_token_uris()
-        for token_address in tokens:
-            if token_address == '': # removed cti
-                continue
-            token_id, owner, uuid, title, price, operator, likecount = \
-                self.cticatalog.get_cti_info(token_address)
+        infos = self.cticatalog.get_cti_info_list(tokens)
+        for token_address, info in zip(tokens, infos):
+            token_id, owner, uuid, title, price, operator, likecount = info
 
             if token_id == 0: # registered, but not yet published
                 continue
@@ -479,23 +601,27 @@ class Catalog:
             catalog[token_address]['operator'] = operator
             catalog[token_address]['like'] = likecount
 
+        search_index = SearchIndex()
+        for token_address, metadata in catalog.items():
+            search_index.add(token_address, metadata)
         self.catalog_tokens = catalog
+        self.search_index = search_index
+        self.version = next(VERSIONS)
 
-        for token_address in tokens:
-            self.update_balanceof_myself(token_address)
+        self.update_balanceof_myself_list(list(catalog.keys()))
 
     def fill_quantity(self, get_amounts_func):
         token_addresses = list(self.catalog_tokens.keys())
         amounts = get_amounts_func(self.catalog_address, token_addresses)
         for i, token_address in enumerate(token_addresses):
             self.catalog_tokens[token_address]['quantity'] = amounts[i]
+        self.version = next(VERSIONS)
 
     def restore_disseminate(self, account_id, callback, view=None):
-        for token in self.cticatalog.list_token_uris():
-            if token == '':
-                continue
-            _id, owner, uuid, title, _price, _ope, _like = \
-                self.cticatalog.get_cti_info(token)
+        tokens = self.cticatalog.list_token_uris()
+        infos = self.cticatalog.get_cti_info_list(tokens)
+        for token, info in zip(tokens, infos):
+            _id, owner, uuid, title, _price, _ope, _like = info
             if account_id != owner:
                 continue
             metadata = {}
@@ -528,6 +654,7 @@ class Catalog:
                 raise Exception('not found on catalog, token: '+token_address)
             if token['tokenId'] > 0:
                 token['quantity'] = quantity
+                self.version = next(VERSIONS)
         except Exception as err:
             LOGGER.error(err)
 
@@ -540,6 +667,27 @@ class Catalog:
             token_address, self.catalog_user)
         ctitoken = self.contracts.accept(CTIToken()).get(token_address)
         target['balanceOfUser'] = ctitoken.balance_of(self.catalog_user)
+        self.version = next(VERSIONS)
+
+    def update_balanceof_myself_list(self, token_addresses):
+        # same as update_balanceof_myself() for each token, in a batch.
+        targets = [
+            address for address in token_addresses
+            if address in self.catalog_tokens.keys()]
+        if not targets:
+            return
+        LOGGER.info(
+            'CTI tokens (%d) call balanceOf(%s) in batch',
+            len(targets), self.catalog_user)
+        batch = BatchCall(self.contracts.web3)
+        for token_address in targets:
+            ctitoken = self.contracts.accept(CTIToken()).get(token_address)
+            batch.add(ctitoken.contract.functions.balanceOf(self.catalog_user))
+        for token_address, balance in zip(targets, batch.execute()):
+            target = self.catalog_tokens.get(token_address)
+            if target is not None:  # may be unregistered meanwhile
+                target['balanceOfUser'] = balance
+        self.version = next(VERSIONS)
 
     def register_token(self, producer_address, token_address, metadata):
         self.cticatalog.register_cti(
@@ -611,7 +759,7 @@ class Broker:
             'AmountChanged', fromBlock='latest')
         event_listener.add_event_filter(
             'AmountChanged:'+broker_address,
-            event_filter, amountchanged_callback)
+            event_filter, amountchanged_callback, replay=True)
         event_listener.start()
         self.event_listener = event_listener
 
@@ -27,54 +27,10 @@ options:
 from docopt import docopt
 import configparser
 from subprocess import call
-import pymisp
-import re
-import os
-import json
-import urllib3
+from misp_client import MISPClient, MISPFetcher
 
 CONFIG_INI_FILEPATH = 'metemctl.ini'
 
-class MISPClient():
-    def __init__(self, url, key, ssl=2):
-        self.url = url
-        self.key = key
-        self.ssl = ssl
-        if ssl == 0:
-            urllib3.disable_warnings()
-        self.misp = pymisp.PyMISP(url, key, ssl == 2)
-
-    def get_event(self, event_id):
-        return self.misp.get_event(event_id)
-
-    def search(self, **kwargs):
-        return self.misp.search(**kwargs)
-
-    def search_index(self, **kwargs):
-        return self.misp.search_index(**kwargs)
-
-    def add_event(self, event_obj):
-        return self.misp.add_event(event_obj)
-
-    def update_event(self, event_obj):
-        return self.misp.update_event(event_obj)
-
-def dump_json(data, dumpdir, force=False, indent=None):
-    try:
-        uuid = data['Event']['uuid']
-        if len(uuid) == 0:
-            raise Exception('Empty UUID')
-    except Exception as err:
-        raise Exception('Unexpected data: missing Event or UUID') from err
-
-    fpath = dumpdir + '/' + uuid + '.json'
-    if os.path.isfile(fpath) and not force:
-        raise Exception('already exists: ' + fpath)
-    with open(fpath, 'w') as fout:
-        json.dump(data, fout, indent=indent, ensure_ascii=False)
-
-    return fpath
-
 
 if __name__ == '__main__':
 
@@ -100,32 +56,9 @@ if __name__ == '__main__':
         json_dumpdir = config['general']['misp_json_dumpdir']
 
         # MISP Client instance
-        client = MISPClient(url, auth_key, ssl_cert)
-
-        # build query
-        basequery = "search"
-        query_string = basequery + " limit=100 page=1"
-        query = re.split(r'\s+', query_string)
-        qname = query[0]
-        qargs = query[1:]
-        indent = 2
-        query = dict()
-        for token in qargs:
-            key, val = token.split('=')
-            query[key] = val
-
-        # send query
-        result = getattr(client, qname)(**query)
-
-        # separate json data
-        results = result if isinstance(result, list) else [result]
+        client = MISPClient(url, auth_key, int(ssl_cert))
 
-        # store json file
-        for val in results:
-            try:
-                fpath = dump_json(val, json_dumpdir, True, indent)
-                print('dumped to ' + fpath)
-            except Exception as err:
-                print(err)
+        # fetch events changed since last fetch, page by page.
+        MISPFetcher(client, json_dumpdir, indent=2).run()
     else:
         exit("Invalid command. See 'metemctl misp --help'.")
@@ -40,8 +40,9 @@ import sys
 from getpass import getpass
 import glob
 from pathlib import Path
-import csv
 import logging
+from functools import lru_cache
+from token_registry import TokenRegistry
 
 LOGGER = logging.getLogger('metemctl publish')
 
@@ -49,7 +50,6 @@ CONFIG_INI_FILEPATH = "metemctl.ini"
 WORKSPACE_CONFIG_INI_FILEPATH = "./workspace/config.ini"
 MISP_DATAFILE_PATH = os.getenv('MISP_DATAFILE_PATH', './fetched_misp_events')
 MISP_INI_FILEPATH = './workspace/misp.ini'
-REGISTERED_TOKEN_TSV = './workspace/registered_token.tsv'
 
 
 def decode_keyfile(w3, filename):
@@ -135,46 +135,29 @@ def read_dir(misp_json_dir):
         return None
 
 
-def save_registered_token(cti_metadata):
-    # cticatalog コントラクトに登録したtokenのmetadataを保存する
-    fieldnames = ['uuid', 'tokenAddress',
-                  'title', 'price', 'operator', 'quantity']
+@lru_cache(maxsize=None)
+def token_registry():
+    # opened once per process.
+    return TokenRegistry()
 
-    is_empty = not os.path.isfile(REGISTERED_TOKEN_TSV)
 
-    with open(REGISTERED_TOKEN_TSV, 'a', newline='') as tsvfile:
-        writer = csv.DictWriter(
-            tsvfile, fieldnames=fieldnames, extrasaction='ignore', delimiter='\t')
-        if is_empty:
-            writer.writeheader()
-        writer.writerow(cti_metadata)
+def save_registered_token(cti_metadata):
+    # cticatalog コントラクトに登録したtokenのmetadataを保存する
+    token_registry().add(cti_metadata)
 
 
 def fetch_registered_token():
     # 登録済みトークンのfetch
-    registered_tokens = []
-    try:
-        with open(REGISTERED_TOKEN_TSV, newline='') as tsvfile:
-            tsv = csv.DictReader(tsvfile, delimiter='\t')
-            for row in tsv:
-                registered_tokens.append(row)
-            return registered_tokens
-    except FileNotFoundError:
-        pass
-    except Exception as err:
-        LOGGER.error(err)
-    return registered_tokens
+    return token_registry().list()
 
 
 def create_metadata(misp_json_file, operators, token_price, token_quantity):
-    # get registered token info from "registered_token.tsv"
-    registered_token = fetch_registered_token()
-    registered_uuid = [token.get('uuid') for token in registered_token]
     metadata = {}
     with open(misp_json_file) as fin:
         misp = json.load(fin)
     uuid = misp['Event']['uuid']
-    if uuid in registered_uuid:
+    # check registered token info in the local token registry
+    if token_registry().contains(uuid):
         return None
     metadata['uuid'] = uuid
     metadata['title'] = misp['Event']['info']
@@ -424,7 +407,7 @@ if __name__ == '__main__':
         # if the CTI already exists, exit
         if not cti_metadata:
             print('Error. ' + 'uuid of the MISP EVENT(' + misp_json_file +
-                  ') already exists in "registered_token.tsv".')
+                  ') already exists in the token registry.')
             continue
         if cti_metadata['uuid'] in registered_uuids:
             print('Error. ' + 'uuid of the MISP EVENT(' +
@@ -18,11 +18,26 @@ import os
 import sys
 import re
 import json
+import time
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from threading import Lock, local
 import urllib3
 import pymisp
 
+## number of events inserted at once in bulk import.
+BULK_WORKERS = int(os.getenv('MISP_BULK_WORKERS', '8'))
+## page size of search_index to prefetch existing UUIDs.
+BULK_PAGE_SIZE = 1000
+REPORT_INTERVAL_SEC = 5
+## number of pages fetched at once, and events per page.
+FETCH_WORKERS = int(os.getenv('MISP_FETCH_WORKERS', '4'))
+FETCH_PAGE_SIZE = 100
+## timestamp to fetch events changed since, saved in dump directory.
+WATERMARK_FILENAME = '.fetch_watermark'
+
 class MISPClient():
     def __init__(self, url, key, ssl=2):
         self.url = url
@@ -31,21 +46,33 @@ class MISPClient():
         if ssl == 0:
             urllib3.disable_warnings()
         self.misp = pymisp.PyMISP(url, key, ssl == 2)
+        self.__local = local()
+        self.__local.misp = self.misp
+
+    @property
+    def local_misp(self):
+        # PyMISP for this thread, which keeps its connection alive.
+        # workers of bulk import share no session, nor wait for another.
+        misp = getattr(self.__local, 'misp', None)
+        if not misp:
+            misp = self.__local.misp = pymisp.PyMISP(
+                self.url, self.key, self.ssl == 2)
+        return misp
 
     def get_event(self, event_id):
         return self.misp.get_event(event_id)
 
     def search(self, **kwargs):
-        return self.misp.search(**kwargs)
+        return self.local_misp.search(**kwargs)
 
     def search_index(self, **kwargs):
-        return self.misp.search_index(**kwargs)
+        return self.local_misp.search_index(**kwargs)
 
     def add_event(self, event_obj):
-        return self.misp.add_event(event_obj)
+        return self.local_misp.add_event(event_obj)
 
     def update_event(self, event_obj):
-        return self.misp.update_event(event_obj)
+        return self.local_misp.update_event(event_obj)
 
 
 def dump_json(data, dumpdir, force=False, indent=None):
@@ -59,12 +86,115 @@ def dump_json(data, dumpdir, force=False, indent=None):
     fpath = dumpdir + '/' + uuid + '.json'
     if os.path.isfile(fpath) and not force:
         raise Exception('already exists: ' + fpath)
-    with open(fpath, 'w') as fout:
-        json.dump(data, fout, indent=indent, ensure_ascii=False)
+    # readers never see half-written file.
+    fd, tmp_path = tempfile.mkstemp(dir=dumpdir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(data, fout, indent=indent, ensure_ascii=False)
+        os.replace(tmp_path, fpath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
     return fpath
 
 
+class MISPFetcher():
+    # Dumps MISP events changed since the last fetch, paging through
+    # search concurrently. The watermark is saved only when all the pages
+    # are fetched, so a failed fetch is retried next time.
+
+    def __init__(self, client, dumpdir, workers=FETCH_WORKERS,
+                 page_size=FETCH_PAGE_SIZE, indent=None,
+                 watermark_path=None):
+        self.client = client
+        self.dumpdir = dumpdir
+        self.workers = workers
+        self.page_size = page_size
+        self.indent = indent
+        self.watermark_path = watermark_path or \
+            os.path.join(dumpdir, WATERMARK_FILENAME)
+        self.fetched = 0
+        self.pages = 0
+        self.__lock = Lock()
+
+    def load_watermark(self):
+        # JSON, or lasttimestamp=N saved by old fetch_misp_events.sh.
+        try:
+            with open(self.watermark_path) as fin:
+                text = fin.read().strip()
+        except FileNotFoundError:
+            return None
+        if text.startswith('lasttimestamp='):
+            return int(text.split('=', 1)[1])
+        return json.loads(text).get('timestamp')
+
+    def save_watermark(self, timestamp):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.watermark_path)))
+        with os.fdopen(fd, 'w') as fout:
+            json.dump({'timestamp': timestamp}, fout)
+        os.replace(tmp_path, self.watermark_path)
+
+    def run(self, full=False):
+        os.makedirs(self.dumpdir, exist_ok=True)
+        since = None if full else self.load_watermark()
+        if since:
+            print('fetching MISP events which timestamp is newer than '
+                  '{} ({})'.format(since, time.ctime(since)))
+        else:
+            print('fetching all MISP events.')
+        started = time.time()
+        newest = 0
+        end = None  # last page
+        page = 1
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            try:
+                while futures or end is None:
+                    while end is None and len(futures) < self.workers:
+                        futures[executor.submit(
+                            self.__fetch_page, page, since)] = page
+                        page += 1
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        fetched_page = futures.pop(future)
+                        num, latest = future.result()
+                        newest = max(newest, latest)
+                        if num < self.page_size:  # no more pages after
+                            end = fetched_page if end is None \
+                                else min(end, fetched_page)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        elapsed = time.time() - started
+        print('fetched {} events in {} pages, {:.1f} sec, '
+              '{:.1f} events/sec'.format(
+                  self.fetched, self.pages, elapsed,
+                  self.fetched / elapsed if elapsed > 0 else 0.0))
+        if newest > 0:
+            self.save_watermark(newest + 1)
+        return self.fetched
+
+    def __fetch_page(self, page, since):
+        query = {'limit': self.page_size, 'page': page}
+        if since:
+            query['timestamp'] = since
+        result = self.client.search(**query)
+        if isinstance(result, dict) and 'errors' in result:
+            raise Exception('search failed: {}'.format(result['errors']))
+        newest = 0
+        for val in result:
+            dump_json(val, self.dumpdir, True, self.indent)
+            newest = max(newest, int(val['Event'].get('timestamp') or 0))
+        self.__lock.acquire()
+        self.fetched += len(result)
+        self.pages += 1
+        self.__lock.release()
+        return len(result), newest
+
+
 def insert_json(client, event_dict):
     #event_id = event_dict.get('Event', {}).get('id')
     uuid = event_dict.get('Event', {}).get('uuid')
@@ -81,23 +211,150 @@ def insert_json(client, event_dict):
         raise Exception('There is no uuid in json')
 
 
-def bulk_insert_json(client, insertdir):
-    for obj_path in Path(insertdir).glob("./*.json"):
+def prefetch_uuids(client, page_size=BULK_PAGE_SIZE):
+    # UUIDs of all the events in MISP, by paged search_index.
+    uuids = set()
+    page = 1
+    while True:
+        result = client.search_index(page=page, limit=page_size)
+        if isinstance(result, dict) and 'errors' in result:
+            raise Exception('search_index failed: {}'.format(result))
+        uuids.update(event['uuid'] for event in result)
+        if len(result) < page_size:
+            return uuids
+        page += 1
+
+
+class BulkImporter():
+    # Inserts MISP event files concurrently.
+    # Existing UUIDs are fetched once instead of searching each event.
+    # Finished files are appended to the progress file, and skipped when
+    # resumed unless modified.
+
+    def __init__(self, client, workers=BULK_WORKERS, dry_run=False,
+                 progress_path=None):
+        self.client = client
+        self.workers = workers
+        self.dry_run = dry_run
+        self.progress_path = progress_path
+        self.existing = set()
+        self.counts = {'added': 0, 'updated': 0, 'failed': 0, 'skipped': 0}
+        self.started = None
+        self.reported = None
+        self.__lock = Lock()
+        self.__progress = None
+
+    def run(self, insertdir):
+        done = self.__load_progress()
+        targets = []
+        for obj_path in sorted(Path(insertdir).glob('./*.json')):
+            if done.get(obj_path.name) == obj_path.stat().st_mtime_ns:
+                self.counts['skipped'] += 1
+            else:
+                targets.append(obj_path)
+        print('prefetching existing events')
+        self.existing = prefetch_uuids(self.client)
+        print('{} events in MISP, {} files to insert ({} done before)'.format(
+            len(self.existing), len(targets), self.counts['skipped']))
+
+        self.started = self.reported = time.time()
+        if self.progress_path and not self.dry_run:
+            self.__progress = open(self.progress_path, 'a')
         try:
-            event_dict = json.loads(open(obj_path).read())
-            insert_json(client, event_dict)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for _ in executor.map(self.__insert, targets):
+                    pass
+        finally:
+            if self.__progress:
+                self.__progress.close()
+                self.__progress = None
+        self.__report(final=True)
+        return self.counts
+
+    def __load_progress(self):
+        # {filename: mtime_ns}
+        done = {}
+        if not self.progress_path or not os.path.isfile(self.progress_path):
+            return done
+        with open(self.progress_path) as fin:
+            for line in fin:
+                name, _, mtime = line.rstrip('\n').rpartition('\t')
+                if name and mtime.isdigit():
+                    done[name] = int(mtime)
+        return done
+
+    def __insert(self, obj_path):
+        try:
+            mtime = obj_path.stat().st_mtime_ns
+            with open(obj_path) as fin:
+                event_dict = json.load(fin)
+            uuid = event_dict.get('Event', {}).get('uuid')
+            if not uuid:
+                raise Exception('There is no uuid in json')
+            self.__lock.acquire()
+            action = 'updated' if uuid in self.existing else 'added'
+            self.existing.add(uuid)
+            self.__lock.release()
+            if not self.dry_run:
+                event_obj = pymisp.MISPEvent()
+                event_obj.from_dict(**event_dict)
+                if action == 'updated':
+                    result = self.client.update_event(event_obj)
+                else:
+                    result = self.client.add_event(event_obj)
+                if isinstance(result, dict) and 'errors' in result:
+                    raise Exception(result['errors'])
         except json.decoder.JSONDecodeError:
-            print('%s: Unparsable data', obj_path)
+            print('{}: Unparsable data'.format(obj_path))
+            action = 'failed'
         except Exception as err:
-            print('%s: %s', obj_path, err)
+            print('{}: {}'.format(obj_path, err))
+            action = 'failed'
+        self.__lock.acquire()
+        try:
+            self.counts[action] += 1
+            if self.__progress and action != 'failed':
+                self.__progress.write('{}\t{}\n'.format(obj_path.name, mtime))
+                self.__progress.flush()
+            if time.time() - self.reported >= REPORT_INTERVAL_SEC:
+                self.__report()
+        finally:
+            self.__lock.release()
+
+    def __report(self, final=False):
+        self.reported = time.time()
+        elapsed = self.reported - self.started
+        processed = sum(
+            val for key, val in self.counts.items() if key != 'skipped')
+        print('{}{}: added={added} updated={updated} failed={failed} '
+              'skipped={skipped}, {:.1f} events/sec'.format(
+                  '[dry-run] ' if self.dry_run else '',
+                  'finished' if final else 'progress',
+                  processed / elapsed if elapsed > 0 else 0.0,
+                  **self.counts))
+
+
+def bulk_insert_json(client, insertdir, workers=BULK_WORKERS, dry_run=False,
+                     progress_path=None):
+    return BulkImporter(client, workers, dry_run, progress_path).run(
+        insertdir)
 
 
 def main(args):
     client = MISPClient(args.url, args.key, args.ssl)
 
-    if args.insertpath:
+    if args.fetch:
+        if not args.dumppath:
+            raise Exception('specify directory to dump with --dump')
+        MISPFetcher(
+            client, args.dumppath, args.workers or FETCH_WORKERS,
+            indent=2 if args.pretty else None,
+            watermark_path=args.watermark).run(full=args.full)
+    elif args.insertpath:
         if os.path.isdir(args.insertpath):
-            bulk_insert_json(client, args.insertpath)
+            bulk_insert_json(
+                client, args.insertpath, args.workers or BULK_WORKERS,
+                args.dry_run, args.progress)
         else:
             event_dict = json.loads(open(args.insertpath).read())
             insert_json(client, event_dict)
@@ -162,6 +419,26 @@ if __name__ == '__main__':
     PARSER.add_argument(
         '-p', '--pretty', dest='pretty', action='store_true',
         help='output pretty formatted JSON')
+    PARSER.add_argument(
+        '-F', '--fetch', dest='fetch', action='store_true',
+        help='dump events changed since last fetch (all with --full)')
+    PARSER.add_argument(
+        '--full', dest='full', action='store_true',
+        help='fetch all events, ignoring the watermark')
+    PARSER.add_argument(
+        '-m', '--watermark', dest='watermark', action='store', default=None,
+        help='file to save timestamp of last fetch')
+    PARSER.add_argument(
+        '-w', '--workers', dest='workers', action='store', type=int,
+        default=None,
+        help='number of events inserted, or pages fetched, at once '
+        '(default: MISP_BULK_WORKERS or MISP_FETCH_WORKERS)')
+    PARSER.add_argument(
+        '-n', '--dry-run', dest='dry_run', action='store_true',
+        help='show what would be inserted from directory, without change')
+    PARSER.add_argument(
+        '-r', '--progress', dest='progress', action='store', default=None,
+        help='record inserted files to resume from, skipping them')
 
     ARGS = PARSER.parse_args()
     main(ARGS)
@@ -14,23 +14,44 @@
 #    limitations under the License.
 #
 
+import codecs
+import glob
 import json
+import os
+import re
+import sys
 import argparse
-import pymisp
+from concurrent.futures import ProcessPoolExecutor
+
+## number of processes validating files. None means number of CPUs.
+VALIDATOR_WORKERS = int(os.getenv('VALIDATOR_WORKERS', '0')) or None
+VALIDATOR_CHUNK_SIZE = 256 * 1024
+## files given to a worker at once.
+VALIDATOR_BATCH = 8
+
+TTP_TYPE = ['mitre-attack-pattern']
+CUSTOME_RULE = ['yara', 'zeek']
+
+# values to look at while scanning, by path. None stands for array items.
+TARGETS = {
+    ('Event', 'info'): 'info',
+    ('Event', 'Attribute', None, 'to_ids'): 'IOC',
+    ('Event', 'Attribute', None, 'type'): 'Rule',
+    ('Event', 'Object', None, 'Attribute', None, 'to_ids'): 'IOC',
+    ('Event', 'Object', None, 'Attribute', None, 'type'): 'Rule',
+    ('Event', 'Galaxy', None, 'type'): 'TTP',
+    }
+
+STRUCTURE = re.compile(r'["{}\[\]:,]')
+STRING_END = re.compile(r'["\\]')
+LITERAL = re.compile(
+    r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null')
 
 
-def _has_ids_flag(objects_list):
-    return any([attribute['to_ids'] for attribute in objects_list])
-    
 def _has_ttp_galaxy(galaxies_list):
-    TTP_TYPE = ['mitre-attack-pattern']
     return any([galaxy['type'] in TTP_TYPE
                 for galaxy in galaxies_list])
 
-def _has_custom_rule(objects_list):
-    CUSTOME_RULE = ['yara', 'zeek']
-    return any([attribute['type'] in CUSTOME_RULE for attribute in objects_list])
-
 def validate_event(event_json):
     has_ioc = False
     has_ttp = False
@@ -43,37 +64,273 @@ def validate_event(event_json):
         return {'MISPEvent': False}
     else:
         result = {'MISPEvent': True}
-        # IOCの判断 -> to_ids flagの有無
-        has_ioc = _has_ids_flag(event_dict['Attribute'])
-
+        # IOC, Custom ruleの判断をAttributeごとに一度で行う
+        attributes = list(event_dict['Attribute'])
         for obj in event_dict['Object']:
-            has_ioc = has_ioc or _has_ids_flag(obj['Attribute'])
-        
+            attributes.extend(obj['Attribute'])
+        for attribute in attributes:
+            # IOCの判断 -> to_ids flagの有無
+            has_ioc = has_ioc or bool(attribute['to_ids'])
+            # Custom ruleの判断 -> yara, zeek
+            has_rule = has_rule or attribute['type'] in CUSTOME_RULE
+            if has_ioc and has_rule:
+                break
+
         # TTPs framework
         has_ttp = _has_ttp_galaxy(event_dict['Galaxy'])
 
-        # Custom ruleの判断 -> yara, zeek
-        has_rule = _has_custom_rule(event_dict['Attribute'])
-        for obj in event_dict['Object']:
-            has_rule = has_rule or _has_custom_rule(obj['Attribute'])
-
         result['content'] = {
             'IOC': has_ioc,
             'TTP': has_ttp,
             'Rule': has_rule
         }
         return result
-    
+
+
+class EventScanner:
+    # Incremental JSON parser which computes the result of validate_event
+    # in a single pass, without loading the whole event.
+    # feed() chunks of the file, then close() to get the result.
+    # Raises ValueError for malformed JSON.
+
+    def __init__(self):
+        self.flags = {'info': False, 'IOC': False, 'TTP': False, 'Rule': False}
+        self.event = False  # Event is an object
+        self.__stack = []  # '{' or '['
+        self.__keys = []  # current key of each level, None for array
+        self.__state = 'value'  # what comes next
+        self.__string = None  # chars of string being read, or None
+        self.__capture = False  # the string is key or target value
+        self.__escaped = False
+        self.__literal = []  # chars of number, true, false or null
+        self.__decoder = codecs.getincrementaldecoder('utf-8')('strict')
+
+    def feed(self, chunk):
+        text = self.__decoder.decode(chunk)
+        pos = 0
+        while pos < len(text):
+            if self.__string is not None:
+                pos = self.__read_string(text, pos)
+                continue
+            match = STRUCTURE.search(text, pos)
+            end = match.start() if match else len(text)
+            if end > pos:
+                self.__read_literal(text[pos:end])
+            if not match:
+                break
+            self.__structure(match.group())
+            pos = match.end()
+
+    def close(self):
+        self.feed(b'')
+        self.__decoder.decode(b'', final=True)
+        if self.__string is not None:
+            raise ValueError('unterminated string')
+        self.__end_literal()
+        if self.__state != 'end':
+            raise ValueError('unexpected end of data')
+        if not self.event or not self.flags['info']:
+            return {'MISPEvent': False}
+        return {
+            'MISPEvent': True,
+            'content': {
+                'IOC': self.flags['IOC'],
+                'TTP': self.flags['TTP'],
+                'Rule': self.flags['Rule'],
+                },
+            }
+
+    def __target(self):
+        # the flag which the value to come affects, or None.
+        return TARGETS.get(tuple(self.__keys))
+
+    def __value(self, value):
+        # a scalar value has been read.
+        target = self.__target()
+        if target == 'info':
+            self.flags['info'] = self.flags['info'] or value is not None
+        elif target == 'IOC':
+            self.flags['IOC'] = self.flags['IOC'] or bool(value)
+        elif target == 'Rule':
+            self.flags['Rule'] = self.flags['Rule'] or value in CUSTOME_RULE
+        elif target == 'TTP':
+            self.flags['TTP'] = self.flags['TTP'] or value in TTP_TYPE
+        self.__after_value()
+
+    def __after_value(self):
+        self.__state = 'comma' if self.__stack else 'end'
+
+    def __read_literal(self, text):
+        if self.__literal or not text.isspace():
+            if self.__state not in {'value', 'value_or_end'}:
+                raise ValueError('unexpected {!r}'.format(text.strip()))
+            self.__literal.append(text)
+
+    def __end_literal(self):
+        if not self.__literal:
+            return
+        raw = ''.join(self.__literal).strip()
+        self.__literal = []
+        if not LITERAL.fullmatch(raw):
+            raise ValueError('invalid literal {!r}'.format(raw[:32]))
+        self.__value(json.loads(raw))
+
+    def __read_string(self, text, pos):
+        if self.__escaped:
+            if self.__capture:
+                self.__string.append(text[pos])
+            self.__escaped = False
+            return pos + 1
+        match = STRING_END.search(text, pos)
+        end = match.start() if match else len(text)
+        if self.__capture:
+            self.__string.append(text[pos:end])
+        if not match:
+            return end
+        if match.group() == '\\':
+            if self.__capture:
+                self.__string.append('\\')
+            self.__escaped = True
+            return end + 1
+        self.__end_string()
+        return end + 1
+
+    def __end_string(self):
+        value = json.loads('"' + ''.join(self.__string) + '"') \
+            if self.__capture else ''
+        self.__string = None
+        if self.__state in {'key', 'key_or_end'}:
+            self.__keys[-1] = value
+            self.__state = 'colon'
+        else:
+            self.__value(value)
+
+    def __structure(self, char):
+        self.__end_literal()
+        state = self.__state
+        if char == '"':
+            if state in {'key', 'key_or_end'}:
+                self.__capture = True
+            elif state in {'value', 'value_or_end'}:
+                self.__capture = self.__target() is not None
+            else:
+                raise ValueError('unexpected string')
+            self.__string = []
+        elif char in '{[':
+            if state not in {'value', 'value_or_end'}:
+                raise ValueError('unexpected {!r}'.format(char))
+            if char == '{' and self.__keys == ['Event'] and \
+                    self.__stack == ['{']:
+                self.event = True
+            self.__stack.append(char)
+            self.__keys.append(None)
+            self.__state = 'key_or_end' if char == '{' else 'value_or_end'
+        elif char in '}]':
+            opening = '{' if char == '}' else '['
+            if not self.__stack or self.__stack[-1] != opening or \
+                    state not in {'comma', 'key_or_end', 'value_or_end'} \
+                    or (state == 'key_or_end' and char != '}') \
+                    or (state == 'value_or_end' and char != ']'):
+                raise ValueError('unexpected {!r}'.format(char))
+            self.__stack.pop()
+            self.__keys.pop()
+            self.__after_value()
+        elif char == ':':
+            if state != 'colon':
+                raise ValueError('unexpected {!r}'.format(char))
+            self.__state = 'value'
+        elif char == ',':
+            if state != 'comma':
+                raise ValueError('unexpected {!r}'.format(char))
+            if self.__stack[-1] == '{':
+                self.__keys[-1] = None
+                self.__state = 'key'
+            else:
+                self.__state = 'value'
+
+
+def validate_file(path, chunk_size=VALIDATOR_CHUNK_SIZE):
+    # validate a MISP event file by streaming. returns a report line.
+    report = {'path': str(path)}
+    scanner = EventScanner()
+    try:
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(chunk_size), b''):
+                scanner.feed(chunk)
+        report.update(scanner.close())
+    except (OSError, ValueError) as err:
+        report['MISPEvent'] = False
+        report['error'] = str(err)
+    return report
+
+
+def expand_targets(targets):
+    # files in directories, and files matching glob patterns.
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            paths.extend(sorted(glob.glob(os.path.join(target, '*.json'))))
+        elif glob.has_magic(target):
+            paths.extend(sorted(
+                path for path in glob.glob(target, recursive=True)
+                if os.path.isfile(path)))
+        else:
+            paths.append(target)
+    return paths
+
+
+def validate_files(paths, workers=VALIDATOR_WORKERS):
+    # yields reports of the files in order, validated in parallel.
+    if workers == 1 or len(paths) <= 1:
+        yield from map(validate_file, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(
+            validate_file, paths, chunksize=VALIDATOR_BATCH)
+
+
+def validate_batch(targets, outfile, workers=VALIDATOR_WORKERS):
+    # write JSONL report of the targets. returns number of invalid files.
+    invalid = 0
+    for report in validate_files(expand_targets(targets), workers):
+        if not report['MISPEvent']:
+            invalid += 1
+        outfile.write(json.dumps(report, ensure_ascii=False) + '\n')
+    outfile.flush()
+    return invalid
+
 
 if __name__ == '__main__':
 
     # to use proxy, set environment variable HTTP_PROXY or HTTPS_PROXY.
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', type=argparse.FileType('r'))
+    parser.add_argument(
+        'targets', nargs='+',
+        help='MISP Event file, or directory or glob pattern of them')
+    parser.add_argument(
+        '-b', '--batch', action='store_true',
+        help='Write JSONL report even if a single file is given')
+    parser.add_argument(
+        '-o', '--output', action='store', default='-',
+        help='Path of JSONL report (default: stdout)')
+    parser.add_argument(
+        '-j', '--jobs', action='store', type=int, default=VALIDATOR_WORKERS,
+        help='Number of processes validating files')
     args = parser.parse_args()
-    event_json = json.load(args.infile)
-    validate_result = validate_event(event_json)
-    
+
+    if args.batch or len(args.targets) > 1 or \
+            not os.path.isfile(args.targets[0]):
+        if args.output == '-':
+            invalid = validate_batch(args.targets, sys.stdout, args.jobs)
+        else:
+            with open(args.output, 'w') as fout:
+                invalid = validate_batch(args.targets, fout, args.jobs)
+        sys.exit(1 if invalid else 0)
+
+    validate_result = validate_file(args.targets[0])
+    if 'error' in validate_result:
+        sys.exit(validate_result['error'])
+
     if validate_result['MISPEvent']:
         print('The content of MISP Event file:')
         print('IOC:', 'Exist' if validate_result['content']['IOC'] else 'Not Exist')
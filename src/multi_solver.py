@@ -24,8 +24,13 @@ import socket
 import logging
 import crypt
 import secrets
+import time
+import asyncio
+import struct
 
-from threading import Thread, Condition
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Lock
 from hmac import compare_digest
 from web3 import Web3
 from web3.exceptions import ExtraDataLengthError
@@ -37,6 +42,12 @@ from contract import Contracts
 from ctioperator import CTIOperator
 from plugin import PluginManager
 from solver import BaseSolver
+from tx_pipeline import TransactionPipeline
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 #logging.basicConfig(format='[%(levelname)s]: %(message)s')
 LOGGER = logging.getLogger('common')
@@ -44,10 +55,23 @@ LOGGER = logging.getLogger('common')
 SOCKET_FILE = 'workspace/mcs.sock'
 NUM_THREADS = 4
 BUFSIZ = 4096
+## threads running MCSolver methods for AsyncMCSServer.
+ASYNC_WORKERS = int(os.getenv('MCS_ASYNC_WORKERS', '32'))
+## max length of a message AsyncMCSServer accepts.
+ASYNC_STREAM_LIMIT = 2 ** 24
 
 ARGS_DELIMITER = '\t'   # for command line input
 EOM = '\v'  # End of Message
 
+## protocol versions. negotiated with ping, and 1 if peer does not know.
+##   1: JSON terminated with EOM.
+##   2: length-prefixed frame of JSON or msgpack, with request id.
+PROTOCOL_VERSIONS = (1, 2)
+FRAME_HEADER = struct.Struct('>I')  # payload length
+MAX_FRAME_SIZE = 2 ** 24
+## max number of solver calls in progress at once, per connection.
+MAX_INFLIGHT = int(os.getenv('MCS_MAX_INFLIGHT', '64'))
+
 
 def TRACELOG(*args, **kwargs):
     stacks = inspect.stack()
@@ -62,30 +86,105 @@ def TRACELOG(*args, **kwargs):
     else:
         LOGGER.info(pref, **kwargs)
 
-def encode_msg(cmd, *args, **kwargs):
-    pack = {
+def pack_msg(cmd, *args, **kwargs):
+    return {
         'cmd': cmd,
         'args': args,
         'kwargs': kwargs,
         }
-    return json.dumps(pack)
 
-def decode_msg(packed_json):
-    pack = json.loads(packed_json)
-    return pack.get('cmd'), pack.get('args'), pack.get('kwargs')
+def unpack_msg(pack):
+    return pack.get('cmd'), pack.get('args') or [], pack.get('kwargs') or {}
 
-def send_encoded(sock, msg):
-    if not msg.endswith(EOM):
-        msg += EOM
-    enc_msg = msg.encode()
+def send_bytes(sock, data):
     total = 0
-    while total < len(enc_msg):
-        tmp = sock.send(enc_msg[total:], socket.SOCK_NONBLOCK)
+    while total < len(data):
+        tmp = sock.send(data[total:], socket.SOCK_NONBLOCK)
         if tmp == 0:  # disconnected
             return 0
         total += tmp
     return total
 
+def supported_encodings():
+    return ['msgpack', 'json'] if msgpack else ['json']
+
+
+class MCSCodec():
+    # Framing and encoding of messages (pack_msg() with optional 'id').
+    # Received data is buffered and scanned only once, then decoded messages
+    # are returned by feed().
+
+    def __init__(self, version=1, encoding='json'):
+        self.version = version
+        self.encoding = encoding
+        self.__buffer = bytearray()
+        self.__offset = 0  # start of the first incomplete message
+        self.__scanned = 0  # already scanned for EOM (version 1)
+
+    def upgrade(self, version, encoding):
+        self.version = version
+        self.encoding = encoding
+
+    def encode(self, pack):
+        if self.version == 1:
+            if pack.get('cmd') in {'SHUTDOWN', 'DISCONNECT'}:
+                return (pack['cmd'] + EOM).encode()
+            pack = {key: val for key, val in pack.items() if key != 'id'}
+            return (json.dumps(pack) + EOM).encode()
+        if self.encoding == 'msgpack':
+            payload = msgpack.packb(pack, use_bin_type=True)
+        else:
+            payload = json.dumps(pack).encode()
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    def feed(self, data):
+        self.__buffer.extend(data)
+        packs = []
+        while True:
+            payload = self.__next_v1() if self.version == 1 \
+                else self.__next_v2()
+            if payload is None:
+                break
+            packs.append(self.__decode(payload))
+        if self.__offset > 0:
+            del self.__buffer[:self.__offset]
+            self.__scanned -= self.__offset
+            self.__offset = 0
+        return packs
+
+    def __next_v1(self):
+        idx = self.__buffer.find(
+            EOM.encode(), max(self.__scanned, self.__offset))
+        if idx < 0:
+            self.__scanned = len(self.__buffer)
+            return None
+        payload = bytes(self.__buffer[self.__offset:idx])
+        self.__offset = self.__scanned = idx + 1
+        return payload
+
+    def __next_v2(self):
+        if len(self.__buffer) - self.__offset < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self.__buffer, self.__offset)
+        if length > MAX_FRAME_SIZE:
+            raise MCSError(MCSError.EPROTO, 'too large frame')
+        start = self.__offset + FRAME_HEADER.size
+        if len(self.__buffer) < start + length:
+            return None
+        payload = bytes(self.__buffer[start:start+length])
+        self.__offset = self.__scanned = start + length
+        return payload
+
+    def __decode(self, payload):
+        if self.version == 1:
+            msg = payload.decode()
+            if msg in {'SHUTDOWN', 'DISCONNECT'}:
+                return {'cmd': msg}
+            return json.loads(msg)
+        if self.encoding == 'msgpack':
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload.decode())
+
 
 class MCSError(Exception):
     OK =        0xE000
@@ -123,15 +222,20 @@ class MCSolver():
         self.plugin = PluginManager()
         self.plugin.load()
         self.plugin.set_default_solverclass('gcs_solver.py')
-        self.random_once = None
         self.solvers = dict()  # {eoa: {...}}
+        self.__lock = Lock()  # sessions call concurrently
+
 
         if eoaa and operator_address:
             self.new_solver(eoaa, pkey, operator_address, pluginfile)
 
     def destroy(self):
-        for solver in [v['solver'] for v in self.solvers.values()]:
-            solver.destroy()
+        self.__lock.acquire()
+        wrappers, self.solvers = list(self.solvers.values()), dict()
+        self.__lock.release()
+        for wrapper in wrappers:
+            wrapper['solver'].destroy()
+            TransactionPipeline.close_of(wrapper['web3'])
 
     @staticmethod
     def ping():
@@ -167,50 +271,205 @@ class MCSolver():
         solverclass = self.plugin.get_solverclass(operator_address)
         solver = solverclass(contracts, account_id, operator_address)
 
-        self.solvers[account_id] = {
-            'pkey': pkey,
-            'web3': web3,
-            'contracts': contracts,
-            'solver': solver,
-        }
-        TRACELOG('added solver: %s', str(self.solvers))
+        self.__lock.acquire()
+        exists = account_id in self.solvers.keys()
+        if not exists:
+            self.solvers[account_id] = {
+                'pkey': pkey,
+                'web3': web3,
+                'contracts': contracts,
+                'solver': solver,
+            }
+        self.__lock.release()
+        if exists:  # added by another session meanwhile
+            solver.destroy()
+            TransactionPipeline.close_of(web3)
+            raise MCSError(MCSError.EALREADY, 'already exists for this EOA')
+        TRACELOG('added solver: %s', account_id)
         return solver
 
-    def get_random(self):
-        if not self.random_once:
-            self.random_once = secrets.token_hex(secrets.randbelow(16)+16)
-        return self.random_once
+    @staticmethod
+    def get_random():
+        # nonce to hash pkey with. kept by the session which asked.
+        return secrets.token_hex(secrets.randbelow(16)+16)
 
-    def _solver_control(self, eoaa, pkey_hash, act):
-        if not self.random_once:
+    def _solver_control(self, eoaa, pkey_hash, act, random_once):
+        if not random_once:
             raise MCSError(MCSError.EPROTO, 'protocol error')
         try:
             account_id = Web3.toChecksumAddress(eoaa)
         except Exception as err:
             raise MCSError(MCSError.EINVAL, 'invalid address') from err
-        wrapper = self.solvers.get(account_id)
-        if not wrapper:
-            raise MCSError(MCSError.ENOENT, 'not found')
-        if not compare_digest(
-                pkey_hash,
-                crypt.crypt(
-                    self.random_once + wrapper.get('pkey'), pkey_hash)):
-            raise MCSError(MCSError.EINVAL, 'pkey_hash mismatch')
-        self.random_once = None  # reset random token
+        self.__lock.acquire()
+        try:
+            wrapper = self.solvers.get(account_id)
+            if not wrapper:
+                raise MCSError(MCSError.ENOENT, 'not found')
+            if not compare_digest(
+                    pkey_hash,
+                    crypt.crypt(random_once + wrapper.get('pkey'), pkey_hash)):
+                raise MCSError(MCSError.EINVAL, 'pkey_hash mismatch')
+            if act == 'purge':
+                del self.solvers[account_id]
+        finally:
+            self.__lock.release()
 
         if act == 'get':
             return wrapper.get('solver')
         # act == 'purge'
         TRACELOG('purge solver: %s', str(wrapper['solver']))
-        self.solvers[account_id]['solver'].destroy()
-        del self.solvers[account_id]
+        wrapper['solver'].destroy()
+        TransactionPipeline.close_of(wrapper['web3'])
         return None
 
-    def get_solver(self, eoaa, pkey_hash):
-        return self._solver_control(eoaa, pkey_hash, act='get')
+    def get_solver(self, eoaa, pkey_hash, random_once=None):
+        return self._solver_control(eoaa, pkey_hash, 'get', random_once)
+
+    def purge_solver(self, eoaa, pkey_hash, random_once=None):
+        return self._solver_control(eoaa, pkey_hash, 'purge', random_once)
 
-    def purge_solver(self, eoaa, pkey_hash):
-        return self._solver_control(eoaa, pkey_hash, act='purge')
+
+class MCSSession():
+    # State of a client connection, and dispatcher of the queries to
+    # MCSolver or to the solver the client got.
+    # Shared by the server implementations, which handle transport only.
+
+    def __init__(self, mcs, name, server=None):
+        self.mcs = mcs
+        self.name = name
+        self.server = server
+        self.solver = None
+        self.upgrade = None  # (version, encoding) negotiated with ping
+        self.__random_once = None  # nonce given to this client
+        self.__lock = Lock()  # queries may be handled concurrently
+        self.metrics = {
+            'connected_at': time.time(),
+            'requests': 0,
+            'errors': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'busy_sec': 0.0,
+            'max_latency_sec': 0.0,
+            }
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats['uptime_sec'] = time.time() - stats['connected_at']
+        stats['solver'] = str(self.solver) if self.solver else None
+        return stats
+
+    def count(self, key, num):
+        self.__lock.acquire()
+        self.metrics[key] += num
+        self.__lock.release()
+
+    def handle(self, query):
+        # query is a message decoded by MCSCodec.
+        # returns (response, action). action is None, 'disconnect' or
+        # 'shutdown', and response is None unless action is None.
+        func, args, kwargs = unpack_msg(query)
+        if func in {'shutdown', 'disconnect'}:
+            return None, func
+        started = time.time()
+        failed = True
+        try:
+            resp = self.__dispatch(func, args, kwargs)
+            failed = False
+        except MCSError as err:
+            resp = pack_msg(err.code, data=err.msg)
+        except TypeError as err:
+            LOGGER.exception(err)
+            resp = pack_msg(MCSError.EINVAL, data=str(err))
+        except Exception as err:
+            LOGGER.exception(err)
+            resp = pack_msg(MCSError.EINTERNAL, data=str(err))
+        latency = time.time() - started
+        self.__lock.acquire()
+        self.metrics['requests'] += 1
+        self.metrics['errors'] += 1 if failed else 0
+        self.metrics['busy_sec'] += latency
+        self.metrics['max_latency_sec'] = max(
+            self.metrics['max_latency_sec'], latency)
+        self.__lock.release()
+
+        if 'id' in query:
+            resp['id'] = query['id']
+        TRACELOG(
+            '%s: retval: %X, %s, %s',
+            self.name, resp['cmd'], resp['args'], resp['kwargs'])
+        return resp, None
+
+    def __negotiate(self, protocols, encodings):
+        # choose the latest protocol and the encoding client prefers.
+        versions = set(protocols) & set(PROTOCOL_VERSIONS)
+        if not versions:
+            raise MCSError(MCSError.EPROTO, 'no protocol in common')
+        version = max(versions)
+        encoding = next(
+            (enc for enc in encodings if enc in supported_encodings()),
+            'json')
+        # the transport switches after sending this response.
+        self.upgrade = (version, encoding)
+        TRACELOG('%s: upgrade to %d/%s', self.name, version, encoding)
+        return pack_msg(
+            MCSError.OK, data=self.mcs.ping(),
+            protocol=version, encoding=encoding)
+
+    def __dispatch(self, func, args, kwargs):
+        if func == 'ping' and 'protocols' in kwargs:
+            return self.__negotiate(
+                kwargs['protocols'], kwargs.get('encodings', ['json']))
+        if func == 'connection_stats':
+            return pack_msg(MCSError.OK, data=self.stats())
+        if func == 'server_stats':
+            if not self.server:
+                raise MCSError(MCSError.ENOP, 'not supported')
+            return pack_msg(MCSError.OK, data=self.server.stats())
+
+        if func == 'get_random':
+            random_once = self.mcs.get_random()
+            self.__lock.acquire()
+            self.__random_once = random_once
+            self.__lock.release()
+            return pack_msg(MCSError.OK, data=random_once)
+        if func in {'get_solver', 'purge_solver'}:
+            # the nonce is used once, whether the client passes or not.
+            self.__lock.acquire()
+            kwargs['random_once'], self.__random_once = \
+                self.__random_once, None
+            self.__lock.release()
+
+        # TODO FIXME XXX check method strictly!
+        target = self.mcs
+        if func == 'solver':
+            # operation with solver
+            if len(args) == 0:
+                raise MCSError(MCSError.EINVAL, 'wrong arg')
+            if not self.solver:
+                raise MCSError(MCSError.EPROTO, 'solver not set')
+            target = self.solver
+            func = args[0]
+            args = [] if len(args) == 1 else args[1:]
+        if not hasattr(target, func):
+            raise MCSError(MCSError.EINVAL, "no such method")
+
+        data = getattr(target, func)(*args, **kwargs)
+
+        if target == self.mcs:
+            if func in {'new_solver', 'get_solver'}:
+                assert not self.solver
+                assert isinstance(data, BaseSolver)
+                self.solver = data
+                TRACELOG('%s: set solver: %s', self.name, self.solver)
+                return pack_msg(
+                    MCSError.OK,
+                    operator_address=self.solver.operator_address,
+                    solver_class=str(self.solver))
+            if func == 'purge_solver':
+                TRACELOG('%s: purged solver: %s', self.name, self.solver)
+                self.solver = None
+                return pack_msg(MCSError.OK)
+        return pack_msg(MCSError.OK, data=data)
 
 
 class SolverThread():
@@ -220,7 +479,6 @@ class SolverThread():
         self.index = index
         self.shutdown = False
         self.conn = self.addr = None
-        self.solver = None
         self.cond = Condition()
         self.thread = Thread(target=self.run, daemon=False)
         self.thread.start()
@@ -249,15 +507,15 @@ class SolverThread():
         self.cond.acquire()
         self.conn = conn
         self.addr = addr
-        self.solver = None
         self.cond.notify()
         TRACELOG('%d: cond notify', self.index)
         self.cond.release()
 
     def communicate(self, conn, _addr):
         TRACELOG('%d: communicate with %s', self.index, conn)
+        session = MCSSession(self.mcs, str(self.index))
+        codec = MCSCodec()
         disconnect = False
-        msg = ''
         while not disconnect:
             while True:
                 rfds, _, _ = select.select([conn], [], [], 1.0)
@@ -267,82 +525,42 @@ class SolverThread():
                 disconnect = True
                 TRACELOG('%d: self.shutdown', self.index)
                 try:
-                    send_encoded(conn, 'SHUTDOWN')
+                    send_bytes(conn, codec.encode({'cmd': 'SHUTDOWN'}))
                 except Exception as err:
                     TRACELOG('%d: send error: %s', self.index, err)
                 break
 
-            tmp = conn.recv(BUFSIZ).decode()
+            tmp = conn.recv(BUFSIZ)
             if len(tmp) == 0:  # disconnected
                 TRACELOG('%d: len == 0 (disconnect)', self.index)
                 break
-            msg += tmp
-            TRACELOG('received: ' + tmp.strip())
-            queries = msg.split(EOM)
-            TRACELOG('current queries: ' + str(queries))
-            for query in queries[:-1]:
-                func, args, kwargs = decode_msg(query)
-                if func == 'shutdown':
+            session.count('bytes_in', len(tmp))
+            TRACELOG('received: %s', tmp)
+            try:
+                queries = codec.feed(tmp)
+            except (MCSError, ValueError) as err:
+                TRACELOG('%d: broken message: %s', self.index, err)
+                break
+            for query in queries:
+                resp, action = session.handle(query)
+                if action == 'shutdown':
                     signal.raise_signal(signal.SIGINT)
                     break
-                if func == 'disconnect':
+                if action == 'disconnect':
                     disconnect = True
                     break
                 try:
-                    # TODO FIXME XXX check method strictly!
-                    target = self.mcs
-                    if func == 'solver':
-                        # operation with solver
-                        if len(args) == 0:
-                            raise MCSError(MCSError.EINVAL, 'wrong arg')
-                        if not self.solver:
-                            raise MCSError(MCSError.EPROTO, 'solver not set')
-                        target = self.solver
-                        func = args[0]
-                        args = [] if len(args) == 1 else args[1:]
-                    if not hasattr(target, func):
-                        raise MCSError(MCSError.EINVAL, "no such method")
-
-                    data = getattr(target, func)(*args, **kwargs)
-
-                    resp = None
-                    if target == self.mcs:
-                        if func in {'new_solver', 'get_solver'}:
-                            assert not self.solver
-                            assert isinstance(data, BaseSolver)
-                            self.solver = data
-                            TRACELOG(
-                                '%d: set solver: %s', self.index, self.solver)
-                            resp = encode_msg(
-                                MCSError.OK,
-                                operator_address=self.solver.operator_address,
-                                solver_class=str(self.solver))
-                        elif func == 'purge_solver':
-                            TRACELOG(
-                                '%d: purged solver: %s',
-                                self.index, self.solver)
-                            self.solver = None
-                            resp = encode_msg(MCSError.OK)
-                    if resp is None:
-                        resp = encode_msg(MCSError.OK, data=data)
-                except MCSError as err:
-                    resp = encode_msg(err.code, data=err.msg)
-                except TypeError as err:
-                    LOGGER.exception(err)
-                    resp = encode_msg(MCSError.EINVAL, data=str(err))
-                except Exception as err:
-                    LOGGER.exception(err)
-                    resp = encode_msg(MCSError.EINTERNAL, data=str(err))
-
-                code, args, kwargs = decode_msg(resp)
-                TRACELOG('retval: %X, %s, %s', code, args, kwargs)
-                try:
-                    if send_encoded(conn, resp) == 0:
+                    sent = send_bytes(conn, codec.encode(resp))
+                    if sent == 0:
                         break
+                    session.count('bytes_out', sent)
                 except Exception as err:
                     TRACELOG('%d: send error: %s', self.index, err)
-            msg = queries[-1]  # empty or incomplete msg
+                if session.upgrade:
+                    codec.upgrade(*session.upgrade)
+                    session.upgrade = None
 
+        TRACELOG('%d: session stats: %s', self.index, session.stats())
         TRACELOG('%d: disconnecting', self.index)
         TRACELOG('%d: closing %s', self.index, conn)
         conn.close()
@@ -417,7 +635,141 @@ class MCSServer():
         TRACELOG('MCSServer shutted down')
 
 
+class AsyncMCSServer():
+    # asyncio version of MCSServer.
+    # Serves any number of clients on one event loop, and runs MCSolver
+    # methods on a thread pool not to block the loop. Queries from a client
+    # are processed in order, except that solver calls of protocol version 2
+    # run concurrently (up to MAX_INFLIGHT) and are answered as completed.
+    # SIGINT (or shutdown query) closes all the connections immediately.
+
+    def __init__(self, mcs, max_workers=ASYNC_WORKERS):
+        self.mcs = mcs
+        self.sessions = dict()  # {name: (session, writer, task)}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='mcs')
+        self.started = None
+        self.total_connections = 0
+        self.__shutdown = None
+
+    def stats(self):
+        return {
+            'uptime_sec': time.time() - self.started if self.started else 0,
+            'total_connections': self.total_connections,
+            'connections': len(self.sessions),
+            'sessions': {
+                name: session.stats()
+                for name, (session, _, _) in list(self.sessions.items())},
+            }
+
+    def run(self):
+        try:
+            asyncio.run(self.__serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            if self.mcs:
+                self.mcs.destroy()
+            if os.path.exists(SOCKET_FILE):
+                os.remove(SOCKET_FILE)
+        TRACELOG('AsyncMCSServer shutted down')
+
+    async def __serve(self):
+        loop = asyncio.get_running_loop()
+        self.__shutdown = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.__shutdown.set)
+        server = await asyncio.start_unix_server(
+            self.__communicate, path=SOCKET_FILE, limit=ASYNC_STREAM_LIMIT)
+        self.started = time.time()
+        try:
+            await self.__shutdown.wait()
+            TRACELOG('shutting down')
+            server.close()
+            tasks = [task for _, _, task in self.sessions.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+
+    async def __process(self, session, codec, writer, wlock, query):
+        # returns action of the query.
+        loop = asyncio.get_running_loop()
+        resp, action = await loop.run_in_executor(
+            self.executor, session.handle, query)
+        if action:
+            return action
+        enc_resp = codec.encode(resp)
+        async with wlock:
+            writer.write(enc_resp)
+            await writer.drain()
+        session.count('bytes_out', len(enc_resp))
+        if session.upgrade:
+            codec.upgrade(*session.upgrade)
+            session.upgrade = None
+        return None
+
+    async def __communicate(self, reader, writer):
+        self.total_connections += 1
+        session = MCSSession(
+            self.mcs, 'a{}'.format(self.total_connections), server=self)
+        self.sessions[session.name] = \
+            (session, writer, asyncio.current_task())
+        TRACELOG('%s: accepted', session.name)
+        codec = MCSCodec()
+        wlock = asyncio.Lock()  # responses may be written concurrently
+        slots = asyncio.Semaphore(MAX_INFLIGHT)
+        inflight = set()
+        action = None
+        try:
+            while not action:
+                data = await reader.read(BUFSIZ)
+                if not data:  # disconnected
+                    break
+                session.count('bytes_in', len(data))
+                try:
+                    queries = codec.feed(data)
+                except (MCSError, ValueError) as err:
+                    TRACELOG('%s: broken message: %s', session.name, err)
+                    break
+                for query in queries:
+                    if codec.version > 1 and query.get('cmd') == 'solver':
+                        await slots.acquire()
+                        task = asyncio.ensure_future(self.__process(
+                            session, codec, writer, wlock, query))
+                        inflight.add(task)
+                        task.add_done_callback(inflight.discard)
+                        task.add_done_callback(lambda _: slots.release())
+                        continue
+                    # others may change the session. wait for in-flights.
+                    if inflight:
+                        await asyncio.wait(inflight)
+                    action = await self.__process(
+                        session, codec, writer, wlock, query)
+                    if action:
+                        break
+            if inflight:
+                await asyncio.wait(inflight)
+            if action == 'shutdown':
+                self.__shutdown.set()
+        except asyncio.CancelledError:
+            for task in inflight:
+                task.cancel()
+            writer.write(codec.encode({'cmd': 'SHUTDOWN'}))
+        except OSError as err:
+            TRACELOG('%s: connection error: %s', session.name, err)
+        finally:
+            del self.sessions[session.name]
+            writer.close()
+            TRACELOG('%s: disconnected: %s', session.name, session.stats())
+
+
 class MCSClient():
+    # Client of the solver daemon.
+    # Once ping negotiated protocol version 2, solver calls can be
+    # pipelined: submit_solver() returns a request id without waiting, and
+    # wait_result() collects the result of the id in any order.
+
     def __init__(self, eoaa, pkey):
         self.eoaa = eoaa
         self.pkey = pkey
@@ -425,7 +777,12 @@ class MCSClient():
         self.operator_address = None
         self.solver_class = None
         self.disconnecting = False
-        self.buffer = ''
+        self.codec = MCSCodec()
+        self.responses = dict()  # {request id: response not waited yet}
+        self.__request_id = 0
+        self.__unnumbered = deque()  # ids of queries sent in version 1
+        self.__send_lock = Lock()
+        self.__recv_lock = Lock()
         TRACELOG('initialized %s', self)
 
     def destroy(self):
@@ -445,46 +802,89 @@ class MCSClient():
     def disconnect(self):
         self.disconnecting = True
         try:
-            self.send_query(encode_msg('disconnect'))
+            self.send_query('disconnect')
             self.sock.close()
         except:
             pass
         self.sock = None
 
     def shutdown(self):
-        self.send_query(encode_msg('shutdown'))
-
-    def send_query(self, query):
-        TRACELOG(query.strip())  # strip EOM
-        if send_encoded(self.sock, query) == 0:
-            self.disconnecting = True
+        self.send_query('shutdown')
 
-    def wait_response(self):
-        resp = self.buffer
-        assert len(resp) == 0  # XXX Uhmm how to control msg drived by peer...
-        while EOM not in resp:
-            tmp = self.sock.recv(BUFSIZ).decode()
-            if len(tmp) == 0:  # disconnected
+    def send_query(self, cmd, *args, **kwargs):
+        # returns request id to wait_response().
+        query = pack_msg(cmd, *args, **kwargs)
+        self.__send_lock.acquire()
+        try:
+            self.__request_id += 1
+            query['id'] = req_id = self.__request_id
+            if self.codec.version == 1:
+                # responses of version 1 have no id, and come in order.
+                self.__unnumbered.append(req_id)
+            TRACELOG('%d: %s, %s, %s', req_id, cmd, args, kwargs)
+            if send_bytes(self.sock, self.codec.encode(query)) == 0:
                 self.disconnecting = True
-                return None, [], {}
-            resp += tmp
-        resp, left = resp.split(EOM, 1)
-        code, args, kwargs = decode_msg(resp)
-        TRACELOG('%X, %s, %s', code, args, kwargs)
-        self.buffer = left  # maybe no left message
+        finally:
+            self.__send_lock.release()
+        return req_id
+
+    def wait_response(self, req_id):
+        # responses for other requests are kept for the waiters.
+        self.__recv_lock.acquire()
+        try:
+            while req_id not in self.responses:
+                if self.disconnecting:
+                    return None, [], {}
+                tmp = self.sock.recv(BUFSIZ)
+                if len(tmp) == 0:  # disconnected
+                    self.disconnecting = True
+                    return None, [], {}
+                for resp in self.codec.feed(tmp):
+                    self.__store(resp)
+            resp = self.responses.pop(req_id)
+        finally:
+            self.__recv_lock.release()
+        code, args, kwargs = unpack_msg(resp)
+        TRACELOG('%d: %X, %s, %s', req_id, code, args, kwargs)
         return code, args, kwargs
 
+    def __store(self, resp):
+        if resp.get('cmd') in {'SHUTDOWN', 'DISCONNECT'}:
+            self.disconnecting = True
+            return
+        if 'id' in resp:
+            self.responses[resp['id']] = resp
+        elif self.__unnumbered:
+            self.responses[self.__unnumbered.popleft()] = resp
+
     def ping(self):
-        query = encode_msg('ping')
         try:
-            self.send_query(query)
-            code, _, _ = self.wait_response()
+            if self.codec.version == 1:
+                return self.__negotiate()
+            code, _, _ = self.wait_response(self.send_query('ping'))
             if code == MCSError.OK:
                 return True
         except Exception as err:
             TRACELOG('failed: %s', err)
         return False
 
+    def __negotiate(self):
+        code, _, kwargs = self.wait_response(self.send_query(
+            'ping', protocols=PROTOCOL_VERSIONS,
+            encodings=supported_encodings()))
+        if code == MCSError.OK:
+            # server switched after the response.
+            self.codec.upgrade(
+                kwargs.get('protocol', 1), kwargs.get('encoding', 'json'))
+            TRACELOG(
+                'protocol: %d/%s', self.codec.version, self.codec.encoding)
+            return True
+        if code is None:  # disconnected
+            return False
+        # server does not know negotiation. keep version 1.
+        code, _, _ = self.wait_response(self.send_query('ping'))
+        return code == MCSError.OK
+
     def new_solver(self, operator_address='', pluginfile=None):
         kwargs = {
             'eoaa': self.eoaa,
@@ -492,8 +892,8 @@ class MCSClient():
             'operator_address': operator_address,
             'solver_plugin': pluginfile,
             }
-        self.send_query(encode_msg('new_solver', **kwargs))
-        code, _, kwargs = self.wait_response()
+        code, _, kwargs = self.wait_response(
+            self.send_query('new_solver', **kwargs))
         if code == MCSError.OK:
             self.operator_address = kwargs.get('operator_address')
             self.solver_class = kwargs.get('solver_class')
@@ -501,8 +901,7 @@ class MCSClient():
         raise MCSError(code=code, msg=kwargs.get('data'))
 
     def _get_random(self):
-        self.send_query(encode_msg('get_random'))
-        code, _, kwargs = self.wait_response()
+        code, _, kwargs = self.wait_response(self.send_query('get_random'))
         if code == MCSError.OK:
             return kwargs.get('data')
         raise MCSError(code=code, msg=kwargs.get('data'))
@@ -515,8 +914,7 @@ class MCSClient():
             'eoaa': self.eoaa,
             'pkey_hash': pkey_hash,
             }
-        self.send_query(encode_msg(act, **kwargs))
-        code, _, kwargs = self.wait_response()
+        code, _, kwargs = self.wait_response(self.send_query(act, **kwargs))
         if code == MCSError.OK:
             if act == 'get_solver':
                 self.operator_address = kwargs.get('operator_address')
@@ -533,15 +931,22 @@ class MCSClient():
     def purge_solver(self):
         return self._solver_control('purge_solver')
 
+    def submit_solver(self, *args, **kwargs):
+        # returns request id to wait_result().
+        assert len(args) > 0
+        return self.send_query('solver', *args, **kwargs)
+
+    def wait_result(self, req_id):
+        code, _, kwargs = self.wait_response(req_id)
+        if code == MCSError.OK:
+            return kwargs.get('data')
+        raise MCSError(code=code, msg=kwargs.get('data'))
+
     def solver(self, *args, **kwargs):
         assert self.solver
         assert len(args) > 0
         try:
-            self.send_query(encode_msg('solver', *args, **kwargs))
-            code, _, kwargs = self.wait_response()
-            if code == MCSError.OK:
-                return kwargs.get('data')
-            raise MCSError(code=code, msg=kwargs.get('data'))
+            return self.wait_result(self.submit_solver(*args, **kwargs))
         except OSError as err:
             if err.errno == 32:  # Broken pipe
                 LOGGER.error('%s failed: %s', args[0], err)
@@ -554,7 +959,6 @@ def mcs_client(eoaa, pkey):
     if not client.connect():
         raise Exception('cannot connect to solver daemon')
     sock = client.sock
-    msg = ''
     while not client.disconnecting:
         print('query? ', end='')
         sys.stdout.flush()
@@ -562,17 +966,14 @@ def mcs_client(eoaa, pkey):
             rfds, _, _ = select.select([sock, sys.stdin], [], [])
 
             if sock in rfds:  # received message from peer
-                tmp = sock.recv(BUFSIZ).decode()
+                tmp = sock.recv(BUFSIZ)
                 if len(tmp) == 0:  # disconnected
                     break
-                msg += tmp
-                TRACELOG('received: %s', tmp.strip())
-                queries = msg.split(EOM)
-                for query in queries[:-1]:
-                    if query in {'SHUTDOWN', 'DISCONNECT'}:
+                TRACELOG('received: %s', tmp)
+                for pack in client.codec.feed(tmp):
+                    if pack.get('cmd') in {'SHUTDOWN', 'DISCONNECT'}:
                         client.disconnecting = True
                         break  # immediately
-                msg = queries[-1]  # empty or incomplete msg
                 if client.disconnecting:
                     break
 
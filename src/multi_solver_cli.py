@@ -18,7 +18,7 @@ import argparse
 import logging
 from web3.providers.rpc import HTTPProvider
 from client import decode_keyfile
-from multi_solver import MCSolver, MCSServer, mcs_client
+from multi_solver import MCSolver, MCSServer, AsyncMCSServer, mcs_client
 
 logging.basicConfig(format='[%(levelname)s]: %(message)s')
 LOGGER = logging.getLogger('common')
@@ -38,7 +38,10 @@ def main(args):
     if args.mode == 'server':
         provider = HTTPProvider(args.endpoint_uri)
         mcs = MCSolver(provider, eoaa, pkey, operator_address, pluginfile)
-        server = MCSServer(mcs)
+        if args.server_type == 'asyncio':
+            server = AsyncMCSServer(mcs)
+        else:
+            server = MCSServer(mcs)
         server.run()
     else:
         mcs_client(eoaa, pkey)
@@ -47,6 +50,10 @@ OPTIONS = [
     ('-m', '--mode', dict(
         action='store', required=True,
         choices=['server', 'client'])),
+    ('-s', '--server-type', dict(
+        action='store', dest='server_type', default='thread',
+        choices=['thread', 'asyncio'],
+        help='サーバの実装 (asyncio は多数の同時接続に対応)')),
     ('-f', '--keyfile', dict(
         action='store', dest='keyfile',
         help='キーファイル')),
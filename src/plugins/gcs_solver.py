@@ -15,17 +15,30 @@
 #
 
 import os
+import hashlib
+import json
 import logging
+import time
+from threading import BoundedSemaphore, Event, Lock
 import requests
+from requests.adapters import HTTPAdapter
 from web3 import Web3
 from solver import BaseSolver
 from client_model import FILESERVER_ASSETS_PATH
+from asset_store import AssetStore
 
 
 LOGGER = logging.getLogger('common')
 
 FUNCTIONS_URL = os.getenv("FUNCTIONS_URL", "")
 FUNCTIONS_TOKEN = os.getenv("FUNCTIONS_TOKEN", "")
+## number of uploads at once, per solver.
+UPLOAD_WORKERS = int(os.getenv('GCS_UPLOAD_WORKERS', '4'))
+UPLOAD_TIMEOUT_SEC = 300
+## uploaded URL is reused for the same content in this period.
+UPLOAD_CACHE_TTL_SEC = int(os.getenv('GCS_UPLOAD_CACHE_TTL_SEC', '3600'))
+UPLOAD_CACHE_FILEPATH = './workspace/upload_cache.json'
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 class Solver(BaseSolver):
@@ -33,6 +46,12 @@ class Solver(BaseSolver):
         super().__init__(contracts, account_id, operator_address)
         self.uploader = Uploader()
 
+    def destroy(self):
+        super().destroy()
+        if self.uploader:
+            self.uploader.close()
+            self.uploader = None
+
     def notify_first_accept(self):
         if FUNCTIONS_URL:
             return \
@@ -57,14 +76,16 @@ class Solver(BaseSolver):
         data = ''
         try:
             try:
-                download_url = self.upload_to_storage(token_address)
+                download_url = self.retry(
+                    self.upload_to_storage, token_address)
                 url = Web3.toText(event['args']['data'])
             except:
                 data = 'Challenge failed by solver side error'
                 raise
             try:
                 # return answer via webhook
-                self.webhook(url, download_url, token_address)
+                self.retry(
+                    self.webhook, url, download_url, token_address, task_id)
             except Exception as err:
                 data = 'cannot sendback result via webhook: ' + str(err)
                 raise
@@ -76,6 +97,11 @@ class Solver(BaseSolver):
             LOGGER.info('finished task %s', task_id)
 
     def upload_to_storage(self, cti_address):
+        store = AssetStore.of(FILESERVER_ASSETS_PATH)
+        entry = store.get(cti_address)
+        if entry:  # hashed ahead.
+            return self.uploader.upload_file(
+                store.blob_path(entry['sha256']), entry['sha256'])
         file_path = os.path.abspath('{}/{}'.format(
             FILESERVER_ASSETS_PATH, cti_address))
         url = self.uploader.upload_file(file_path)
@@ -83,21 +109,120 @@ class Solver(BaseSolver):
 
 
 class Uploader:
-    @staticmethod
-    def upload_file(upload_path):
+    # Uploads assets to FUNCTIONS_URL over pooled connections.
+    # Returned URLs are cached by sha256 of the content, so the same asset
+    # is not uploaded again while the URL is fresh.
+    # An asset is streamed in one POST, as FUNCTIONS_URL takes the whole
+    # content in a request and returns the URL. The relay has no API to
+    # upload in parts or to query the bytes received, so an interrupted
+    # upload is retried from the beginning by BaseSolver.retry().
+
+    def __init__(self, max_workers=UPLOAD_WORKERS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.__slots = BoundedSemaphore(max_workers)
+        self.__lock = Lock()
+        self.__uploading = dict()  # {sha256: Event}
+        self.__hashes = dict()  # {(path, size, mtime): sha256}
+        self.__cache = self.__load_cache()  # {sha256: [url, uploaded_at]}
+
+    def close(self):
+        self.session.close()
+
+    def upload_file(self, upload_path, digest=None):
+        # digest: sha256 of the content, if known.
         if not FUNCTIONS_URL:
             LOGGER.error('There are no settings for upload URL')
             return None
+        digest = digest or self.__sha256(upload_path)
+        while True:
+            self.__lock.acquire()
+            url = self.__cached_url(digest)
+            uploading = self.__uploading.get(digest)
+            if not url and not uploading:
+                self.__uploading[digest] = Event()
+            self.__lock.release()
+            if url:
+                LOGGER.info('upload skipped. cached: %s', upload_path)
+                return url
+            if not uploading:
+                break
+            uploading.wait()  # same content is being uploaded by other
+        try:
+            url = self.__upload(upload_path)
+            if url:
+                self.__lock.acquire()
+                self.__cache[digest] = [url, time.time()]
+                self.__save_cache()
+                self.__lock.release()
+            return url
+        finally:
+            self.__lock.acquire()
+            self.__uploading.pop(digest).set()
+            self.__lock.release()
 
+    def __upload(self, upload_path):
         headers = {
             'Authorization': 'Bearer {}'.format(FUNCTIONS_TOKEN),
             'Content-Type': 'application/json'}
-        response = requests.post(
-            FUNCTIONS_URL,
-            data=open(upload_path, 'rb'),
-            headers=headers)
+        self.__slots.acquire()
+        try:
+            # file object is streamed, not loaded into memory.
+            with open(upload_path, 'rb') as fin:
+                response = self.session.post(
+                    FUNCTIONS_URL, data=fin, headers=headers,
+                    timeout=UPLOAD_TIMEOUT_SEC)
+        finally:
+            self.__slots.release()
+        if response.status_code >= 500:  # transient. caller may retry.
+            response.raise_for_status()
         results = response.json()
         if 'result' in results:
             return results['result']
         LOGGER.error('File upload Error: %s', results['error'])
         return None
+
+    def __sha256(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.__hashes:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            self.__hashes[key] = sha256.hexdigest()
+        return self.__hashes[key]
+
+    def __cached_url(self, digest):
+        cached = self.__cache.get(digest)
+        if cached and time.time() - cached[1] < UPLOAD_CACHE_TTL_SEC:
+            return cached[0]
+        return None
+
+    @staticmethod
+    def __load_cache():
+        try:
+            with open(UPLOAD_CACHE_FILEPATH) as fin:
+                return json.load(fin)
+        except FileNotFoundError:
+            return dict()
+        except ValueError as err:
+            LOGGER.warning('ignored broken upload cache: %s', err)
+            return dict()
+
+    def __save_cache(self):
+        # merge with the entries saved by other solvers.
+        cache = self.__load_cache()
+        cache.update(self.__cache)
+        now = time.time()
+        self.__cache = cache = {
+            key: val for key, val in cache.items()
+            if now - val[1] < UPLOAD_CACHE_TTL_SEC}
+        os.makedirs(os.path.dirname(UPLOAD_CACHE_FILEPATH), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(UPLOAD_CACHE_FILEPATH, os.getpid())
+        with open(tmp_path, 'w') as fout:
+            json.dump(cache, fout)
+        os.replace(tmp_path, UPLOAD_CACHE_FILEPATH)
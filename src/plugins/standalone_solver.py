@@ -14,14 +14,21 @@
 #    limitations under the License.
 #
 
+import gzip
 import logging
+import os
+import shutil
 import socket
-from threading import Thread
-from socketserver import TCPServer
-from http.server import SimpleHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread, Lock
+from urllib.parse import unquote, urlsplit
 from web3 import Web3
 from solver import BaseSolver
 from client_model import FILESERVER_ASSETS_PATH
+from asset_store import AssetStore
 
 LOGGER = logging.getLogger('common')
 
@@ -30,23 +37,237 @@ LISTEN_ADDR = ''
 LISTEN_PORT = 50080
 LISTEN_PORT_RANGE = 1000
 CONTENTS_ROOT = FILESERVER_ASSETS_PATH
+## number of downloads served at once.
+HTTPD_WORKERS = int(os.getenv('SOLVER_HTTPD_WORKERS', '16'))
+## idle keep-alive connection is closed to free the worker.
+## connections are closed after a response while all the workers are busy.
+KEEPALIVE_TIMEOUT_SEC = 2
+## assets larger than this are gzipped ahead, and served to the clients
+## accepting gzip.
+GZIP_MIN_SIZE = int(os.getenv('SOLVER_GZIP_MIN_SIZE', str(64 * 1024)))
+GZIP_SUFFIX = '.gz'
 
 
-class SimpleHandler(SimpleHTTPRequestHandler):
+def gzip_path(path):
+    return path + GZIP_SUFFIX
 
-    def __init__(self, *args):
-        self.logpref = 'LocalHttpServer'
-        SimpleHTTPRequestHandler.__init__(self, *args, directory=CONTENTS_ROOT)
+
+def precompress(path):
+    # create gzip variant of the asset, if missing or stale.
+    try:
+        stat = os.stat(path)
+        if stat.st_size < GZIP_MIN_SIZE:
+            return
+        gz_path = gzip_path(path)
+        if os.path.exists(gz_path) and \
+                os.stat(gz_path).st_mtime >= stat.st_mtime:
+            return
+        tmp_path = '{}.{}.tmp'.format(gz_path, os.getpid())
+        with open(path, 'rb') as fin, gzip.open(tmp_path, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        os.replace(tmp_path, gz_path)  # atomic for readers
+        LOGGER.info('precompressed %s', path)
+    except OSError as err:
+        LOGGER.warning('cannot precompress %s: %s', path, err)
+
+
+class AssetHandler(BaseHTTPRequestHandler):
+    # Serves files in CONTENTS_ROOT with sendfile, supporting keep-alive,
+    # Range, ETag/If-None-Match and precompressed gzip variant.
+    # Assets in the asset store are served from the blobs, with sha256 as
+    # ETag.
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    timeout = KEEPALIVE_TIMEOUT_SEC
+    logpref = 'LocalHttpServer'
 
     def do_GET(self):
-        SimpleHTTPRequestHandler.do_GET(self)
+        self.__serve(body=True)
+
+    def do_HEAD(self):
+        self.__serve(body=False)
 
     def log_error(self, *args):
         LOGGER.error(self.logpref+': '+args[0], *args[1:])
 
+    def end_headers(self):
+        # do not hold the worker for this client, while others wait.
+        if not self.close_connection and self.server.saturated():
+            self.send_header('Connection', 'close')
+        super().end_headers()
+
     def log_message(self, *args):
         LOGGER.info(self.logpref+': '+args[0], *args[1:])
 
+    def __resolve(self):
+        # returns (path, entry). entry is None if not in the asset store.
+        # other assets are flat files named by token address.
+        name = unquote(urlsplit(self.path).path).lstrip('/')
+        if not name or '/' in name or name.startswith('.'):
+            return None, None
+        entry = self.server.store.get(name)
+        if entry:
+            return self.server.store.blob_path(entry['sha256']), entry
+        path = os.path.join(CONTENTS_ROOT, name)
+        return (path if os.path.isfile(path) else None), None
+
+    def __select(self, path, entry):
+        # returns (path, stat, encoding) of the representation to serve.
+        gzip_ok = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if entry:  # blobs are immutable.
+            if gzip_ok and entry['gzip']:
+                path = gzip_path(path)
+                return path, os.stat(path), 'gzip'
+            return path, os.stat(path), None
+        stat = os.stat(path)
+        if gzip_ok:
+            try:
+                gz_stat = os.stat(gzip_path(path))
+                if gz_stat.st_mtime >= stat.st_mtime:
+                    return gzip_path(path), gz_stat, 'gzip'
+            except FileNotFoundError:
+                if stat.st_size >= GZIP_MIN_SIZE:
+                    self.server.precompress(path)  # for next requests
+        return path, stat, None
+
+    @staticmethod
+    def __etag(stat, encoding, entry):
+        if entry:
+            return '"{}"'.format(
+                entry['gzip']['sha256'] if encoding else entry['sha256'])
+        return '"{:x}-{:x}{}"'.format(
+            stat.st_mtime_ns, stat.st_size,
+            '-' + encoding if encoding else '')
+
+    def __range(self, size, etag):
+        # returns (start, end) inclusive, None for whole, or False if
+        # not satisfiable. only single range is supported.
+        spec = self.headers.get('Range')
+        if not spec or not spec.startswith('bytes=') or ',' in spec:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range != etag:
+            return None
+        first, _, last = spec[len('bytes='):].strip().partition('-')
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:  # suffix
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start >= size or start > end:
+            return False
+        return start, min(end, size - 1)
+
+    def __serve(self, body):
+        path, entry = self.__resolve()
+        if not path:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            path, stat, encoding = self.__select(path, entry)
+            fobj = open(path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with fobj:
+            etag = self.__etag(stat, encoding, entry)
+            size = stat.st_size
+            if etag in [tag.strip() for tag in self.headers.get(
+                    'If-None-Match', '').split(',')]:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            brange = self.__range(size, etag)
+            if brange is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = brange if brange else (0, size - 1)
+            if brange:
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header(
+                    'Content-Range',
+                    'bytes {}-{}/{}'.format(start, end, size))
+            else:
+                self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/json')
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header(
+                'Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+            self.end_headers()
+            if body and end >= start:
+                # zero-copy by os.sendfile, with fallback to send.
+                self.connection.sendfile(fobj, start, end - start + 1)
+
+
+class PooledHTTPServer(HTTPServer):
+    # HTTPServer handling connections on a bounded thread pool.
+
+    def __init__(self, server_address, handler, max_workers=HTTPD_WORKERS):
+        super().__init__(server_address, handler)
+        self.store = AssetStore.of(CONTENTS_ROOT)
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='httpd')
+        self.__compressing = set()
+        self.__connections = 0  # running or waiting for a worker
+        self.__lock = Lock()
+
+    def saturated(self):
+        return self.__connections >= self.max_workers
+
+    def process_request(self, request, client_address):
+        self.__lock.acquire()
+        self.__connections += 1
+        self.__lock.release()
+        self.executor.submit(self.__process, request, client_address)
+
+    def __process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.__lock.acquire()
+            self.__connections -= 1
+            self.__lock.release()
+
+    def precompress(self, path):
+        # compress in background, once for each path at a time.
+        self.__lock.acquire()
+        try:
+            if path in self.__compressing:
+                return
+            self.__compressing.add(path)
+        finally:
+            self.__lock.release()
+        self.executor.submit(self.__precompress, path)
+
+    def __precompress(self, path):
+        try:
+            precompress(path)
+        finally:
+            self.__lock.acquire()
+            self.__compressing.discard(path)
+            self.__lock.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
 
 class LocalHttpServer():
 
@@ -56,7 +277,7 @@ class LocalHttpServer():
         self.server = None
         self.addr = LISTEN_ADDR
         self.port = 0
-        self.handler = SimpleHandler
+        self.handler = AssetHandler
 
     def start(self):
         if self.thread:
@@ -71,8 +292,10 @@ class LocalHttpServer():
                     '%s: starting httpd: %s at %s:%d',
                     self.__class__.__name__, self.identity,
                     self.addr, self.port)
-                with TCPServer((self.addr, self.port), self.handler) as httpd:
+                with PooledHTTPServer(
+                        (self.addr, self.port), self.handler) as httpd:
                     self.server = httpd
+                    self.__precompress_all(httpd)
                     httpd.serve_forever()
                 LOGGER.info(
                     '%s: stopped httpd: %s',
@@ -84,6 +307,20 @@ class LocalHttpServer():
                 raise
         raise Exception("cannot assign listen port for httpd")
 
+    @staticmethod
+    def __precompress_all(httpd):
+        if not os.path.isdir(CONTENTS_ROOT):
+            return
+        tokens = set(httpd.store.tokens())  # blobs have gzip variants.
+        for name in os.listdir(CONTENTS_ROOT):
+            if name.endswith(GZIP_SUFFIX) or name.startswith('.') or \
+                    name in tokens:
+                continue
+            path = os.path.join(CONTENTS_ROOT, name)
+            if os.path.isfile(path) and \
+                    os.path.getsize(path) >= GZIP_MIN_SIZE:
+                httpd.precompress(path)
+
     def stop(self):
         if self.server:
             self.server.shutdown()
@@ -130,7 +367,8 @@ class Solver(BaseSolver):
 
             # return answer via webhook
             LOGGER.info('returning answer to %s', url)
-            self.webhook(url, download_url, token_address)
+            self.retry(
+                self.webhook, url, download_url, token_address, task_id)
         except Exception as err:
             data = str(err)
             LOGGER.exception(err)
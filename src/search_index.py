@@ -0,0 +1,213 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import bisect
+import shlex
+import unicodedata
+from threading import Lock
+
+# title is indexed by n-grams of these lengths.
+# a term shorter than them is searched by scanning titles.
+GRAM_SIZES = (2, 3)
+# fields searched by prefix, e.g. owner:0x12ab
+PREFIX_FIELDS = ('uuid', 'owner', 'operator')
+
+
+def normalize(text):
+    # case and width insensitive.
+    return unicodedata.normalize('NFKC', str(text or '')).lower()
+
+
+def ngrams(text, size):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def parse_query(query):
+    # returns list of (field, value, prefix).
+    # terms are separated by spaces, and may be quoted.
+    #   word       title containing word
+    #   word*      title starting with word
+    #   owner:0x1  owner (uuid, operator) starting with 0x1
+    #   price:100..500, price:..500, price:100.., price:100
+    try:
+        words = shlex.split(query)
+    except ValueError:  # unbalanced quote
+        words = query.split()
+    terms = []
+    for word in words:
+        field, sep, value = word.partition(':')
+        if not sep or field not in PREFIX_FIELDS + ('title', 'price'):
+            field, value = 'title', word
+        prefix = value.endswith('*') and field != 'price'
+        value = value[:-1] if prefix else value
+        if field == 'price':
+            terms.append((field, parse_price_range(value), False))
+        elif value:
+            terms.append((field, normalize(value), prefix))
+    return terms
+
+
+def parse_price_range(value):
+    # (low, high) inclusive, None for open end. None if invalid.
+    low, sep, high = value.partition('..')
+    try:
+        low = int(low) if low else None
+        high = int(high) if high else None
+    except ValueError:
+        return None
+    if not sep:
+        if low is None:
+            return None
+        high = low
+    return low, high
+
+
+class SearchIndex:
+    # In-memory inverted index of CTI tokens.
+    # Titles are indexed by n-grams and matched as substrings, and uuid,
+    # owner and operator are matched by prefix on sorted values. Prices
+    # are kept sorted for range queries.
+    # All the terms of a query must match.
+
+    def __init__(self):
+        self.__docs = dict()  # {key: {field: normalized value}}
+        self.__grams = dict()  # {gram: set of keys}
+        self.__sorted = {field: [] for field in PREFIX_FIELDS}
+        self.__prices = []  # sorted (price, key)
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__docs)
+
+    def add(self, key, metadata):
+        # index (or re-index) metadata of the token.
+        doc = {
+            field: normalize(metadata.get(field))
+            for field in ('title',) + PREFIX_FIELDS}
+        doc['price'] = metadata.get('price') or 0
+        self.__lock.acquire()
+        try:
+            if self.__docs.get(key) == doc:
+                return
+            self.__remove(key)
+            self.__docs[key] = doc
+            for size in GRAM_SIZES:
+                for gram in ngrams(doc['title'], size):
+                    self.__grams.setdefault(gram, set()).add(key)
+            for field in PREFIX_FIELDS:
+                bisect.insort(self.__sorted[field], (doc[field], key))
+            bisect.insort(self.__prices, (doc['price'], key))
+        finally:
+            self.__lock.release()
+
+    def remove(self, key):
+        self.__lock.acquire()
+        try:
+            self.__remove(key)
+        finally:
+            self.__lock.release()
+
+    def __remove(self, key):
+        doc = self.__docs.pop(key, None)
+        if doc is None:
+            return
+        for size in GRAM_SIZES:
+            for gram in ngrams(doc['title'], size):
+                keys = self.__grams.get(gram)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.__grams[gram]
+        for field in PREFIX_FIELDS:
+            self.__discard(self.__sorted[field], (doc[field], key))
+        self.__discard(self.__prices, (doc['price'], key))
+
+    @staticmethod
+    def __discard(sorted_list, item):
+        idx = bisect.bisect_left(sorted_list, item)
+        if idx < len(sorted_list) and sorted_list[idx] == item:
+            del sorted_list[idx]
+
+    def search(self, query):
+        # keys of the tokens matching the query. all for empty query.
+        terms = parse_query(query)
+        self.__lock.acquire()
+        try:
+            if not terms:
+                return set(self.__docs.keys())
+            # narrow down with cheaper terms first.
+            hits = None
+            for field, value, prefix in sorted(
+                    terms, key=lambda x: x[0] == 'title'):
+                hits = self.__match(field, value, prefix, hits)
+                if not hits:
+                    return set()
+            return hits
+        finally:
+            self.__lock.release()
+
+    def __match(self, field, value, prefix, candidates):
+        if field == 'price':
+            keys = self.__price_range(value)
+        elif field in PREFIX_FIELDS:
+            keys = self.__prefixed(self.__sorted[field], value)
+        else:
+            keys = self.__title(value, prefix, candidates)
+        return keys if candidates is None else candidates & keys
+
+    def __price_range(self, price_range):
+        if price_range is None:
+            return set()
+        low, high = price_range
+        start = 0 if low is None else \
+            bisect.bisect_left(self.__prices, (low,))
+        end = len(self.__prices) if high is None else \
+            bisect.bisect_left(self.__prices, (high + 1,))
+        return {key for _, key in self.__prices[start:end]}
+
+    @staticmethod
+    def __prefixed(sorted_list, value):
+        keys = set()
+        idx = bisect.bisect_left(sorted_list, (value,))
+        while idx < len(sorted_list) and \
+                sorted_list[idx][0].startswith(value):
+            keys.add(sorted_list[idx][1])
+            idx += 1
+        return keys
+
+    def __title(self, value, prefix, candidates):
+        size = max(
+            [size for size in GRAM_SIZES if size <= len(value)], default=0)
+        if size:
+            postings = sorted(
+                (self.__grams.get(gram, set())
+                 for gram in ngrams(value, size)), key=len)
+            keys = set(postings[0])
+            for posting in postings[1:]:
+                keys &= posting
+            if candidates is not None:
+                keys &= candidates
+        else:  # shorter than grams. scan.
+            keys = set(self.__docs.keys()) if candidates is None \
+                else set(candidates)
+        # grams may match apart. check the whole.
+        if prefix:
+            return {
+                key for key in keys
+                if self.__docs[key]['title'].startswith(value)}
+        if size == len(value):
+            return keys
+        return {key for key in keys if value in self.__docs[key]['title']}
@@ -14,8 +14,12 @@
 #    limitations under the License.
 #
 
+import logging
 from ctitoken import CTIToken
 from ctioperator import CTIOperator
+from task_index import TaskIndex
+
+LOGGER = logging.getLogger('common')
 
 TASK_STATES = ['Pending', 'Accepted', 'Finished', 'Cancelled']
 
@@ -23,6 +27,7 @@ TASK_STATES = ['Pending', 'Accepted', 'Finished', 'Cancelled']
 class Seeker():
     def __init__(self, contracts):
         self.contracts = contracts
+        self.task_index = None  # opened on first use
 
     def challenge(self, operator_address, token_address, data=''):
         # tokenをoperatorに送信
@@ -35,7 +40,36 @@ class Seeker():
         operator.cancel_challenge(task_id)
 
     def list_tasks(self, operator_address, catalog=None):
+        # tasks of my own, as CTIOperator.history returns.
         operator = self.contracts.accept(CTIOperator()).get(operator_address)
+        account_id = self.contracts.web3.eth.defaultAccount
+        try:
+            if not self.task_index:
+                self.task_index = TaskIndex()
+            self.task_index.sync(operator, account_id)
+            raw_tasks = self.task_index.tasks(
+                operator_address, seeker=account_id)
+        except Exception as err:
+            LOGGER.warning('task index is not available: %s', err)
+            raw_tasks = self.__history(operator)
+
+        # token -> title, to look up in O(1) per task.
+        titles = {
+            v['token_address']: v['title']
+            for v in (catalog or {}).values()}
+        tasks = dict()
+        for (task_id, token, solver, seeker, state) in raw_tasks:
+            title = titles.get(token)
+            if title is None:
+                title = '(no information found on current catalog)'
+            tasks[task_id] = {
+                'token': token, 'title': title, 'solver': solver,
+                'seeker': seeker, 'state': TASK_STATES[state]}
+        return tasks
+
+    @staticmethod
+    def __history(operator):
+        # all the tasks by paging operator.history, in order of id.
         raw_tasks = []
         limit_atonce = 16
         offset = 0
@@ -45,16 +79,4 @@ class Seeker():
             if len(tmp) < limit_atonce:
                 break
             offset += limit_atonce
-
-        tasks = dict()
-        for (task_id, token, solver, seeker, state) in reversed(raw_tasks):
-            try:
-                title = [
-                    v for v in catalog.values() if v['token_address'] == token
-                    ][0]['title']
-            except:
-                title = '(no information found on current catalog)'
-            tasks[task_id] = {
-                'token': token, 'title': title, 'solver': solver,
-                'seeker': seeker, 'state': TASK_STATES[state]}
-        return tasks
+        return list(reversed(raw_tasks))
@@ -16,15 +16,55 @@
 
 import logging
 import json
+from collections import OrderedDict
+from threading import Lock
 from urllib.request import Request, urlopen
 from requests.exceptions import HTTPError
 from eth_utils.exceptions import ValidationError
+from eth_tester.exceptions import TransactionFailed
 
 from ctioperator import CTIOperator
 from eventlistener import BasicEventListener
+from task_scheduler import TaskScheduler, retry_call
 
 LOGGER = logging.getLogger('common')
 
+SOLVER_CHECKPOINT_FILEPATH_FORMAT = \
+    './workspace/checkpoint.solver.{user}.json'
+MAX_TASK_CLAIMS = 10000
+
+
+class TaskClaims:
+    # Tasks claimed by solvers in this process, to let only one of them
+    # send accepted() transaction for a task.
+
+    def __init__(self, capacity=MAX_TASK_CLAIMS):
+        self.capacity = capacity
+        self.__claims = OrderedDict()  # {(operator, task_id): account}
+        self.__lock = Lock()
+
+    def claim(self, operator_address, task_id, account_id):
+        # returns True if the task is not claimed by others.
+        key = (operator_address, task_id)
+        self.__lock.acquire()
+        try:
+            owner = self.__claims.setdefault(key, account_id)
+            if owner != account_id:
+                return False
+            self.__claims.move_to_end(key)
+            while len(self.__claims) > self.capacity:
+                self.__claims.popitem(last=False)  # oldest
+            return True
+        finally:
+            self.__lock.release()
+
+    def release(self, operator_address, task_id, account_id):
+        key = (operator_address, task_id)
+        self.__lock.acquire()
+        if self.__claims.get(key) == account_id:
+            del self.__claims[key]
+        self.__lock.release()
+
 
 class ChallengeListener(BasicEventListener):
 
@@ -32,10 +72,13 @@ class ChallengeListener(BasicEventListener):
         self.accepting = dict()
         ctioperator = solver.ctioperator
         event_filter = ctioperator.event_filter(event_name, fromBlock='latest')
-        super().__init__(self)
+        super().__init__(
+            self, checkpoint_file=SOLVER_CHECKPOINT_FILEPATH_FORMAT.format(
+                user=solver.account_id))
+        # missed challenges while solver was down are replayed.
         self.add_event_filter(
             event_name+':'+solver.operator_address,
-            event_filter, self.dispatch_callback)
+            event_filter, self.dispatch_callback, replay=True)
 
     def dispatch_callback(self, event):
         token_address = event['args']['token']
@@ -58,6 +101,8 @@ class ChallengeListener(BasicEventListener):
 
 class BaseSolver:
 
+    claims = TaskClaims()  # shared by all solvers in MCSolver process
+
     def __init__(self, contracts, account_id, operator_address):
         LOGGER.info(
             'initializing solver %s for %s', self, operator_address)
@@ -67,6 +112,15 @@ class BaseSolver:
         self.ctioperator = \
             self.contracts.accept(CTIOperator()).get(operator_address)
         self.listener = None
+        self.accept_stats = {
+            'accepted': 0,
+            'claimed_by_other': 0,  # skipped by local claim
+            'precheck_failed': 0,  # skipped by eth_call
+            'reverted': 0,  # wasted transaction
+            }
+        self.__stats_lock = Lock()
+        # challenges are processed on the workers, not on event thread.
+        self.scheduler = TaskScheduler(self.process_challenge, str(self))
 
     def destroy(self):
         LOGGER.info(
@@ -74,6 +128,9 @@ class BaseSolver:
         if self.listener:
             self.listener.destroy()
             self.listener = None
+        if self.scheduler:
+            self.scheduler.stop()
+            self.scheduler = None
 
     @staticmethod  # should be overwritten by subclass
     def notify_first_accept():
@@ -114,7 +171,7 @@ class BaseSolver:
         if not self.listener:
             self.listener = ChallengeListener(self, 'TokensReceivedCalled')
             self.listener.start()
-        self.listener.accept_tokens(token_addresses, self.process_challenge)
+        self.listener.accept_tokens(token_addresses, self.enqueue_challenge)
         if force_register:
             self.ctioperator.register_tokens(token_addresses)
         return self.notify_first_accept() if need_notify else None
@@ -123,17 +180,63 @@ class BaseSolver:
         LOGGER.info('BaseSolver: refuse: %s', token_addresses)
         if self.listener:
             self.listener.refuse_tokens(token_addresses)
+        if self.scheduler:
+            self.scheduler.cancel_tokens(token_addresses)
         self.ctioperator.unregister_tokens(token_addresses)
 
+    def enqueue_challenge(self, token_address, event):
+        LOGGER.info(
+            'queued task %s for %s', event['args']['taskId'], token_address)
+        self.scheduler.submit(token_address, event)
+
+    def set_token_priority(self, token_address, priority):
+        # challenges for higher priority token are processed first.
+        self.scheduler.set_priority(token_address, int(priority))
+
+    def cancel_task(self, task_id):
+        return self.scheduler.cancel(int(task_id))
+
+    def task_stats(self):
+        stats = self.scheduler.stats()
+        stats['accept'] = dict(self.accept_stats)
+        return stats
+
+    @staticmethod
+    def retry(func, *args, **kwargs):
+        # for transient failures in process_challenge().
+        return retry_call(func, *args, **kwargs)
+
     def accept_task(self, task_id):
+        # skip the transaction if it would not win, because a failed
+        # transaction costs gas and a block of latency.
+        if not self.claims.claim(
+                self.operator_address, task_id, self.account_id):
+            LOGGER.info('task %s is claimed by another solver', task_id)
+            self.__count('claimed_by_other')
+            return False
+        if not self.ctioperator.can_accept_task(task_id):
+            self.claims.release(
+                self.operator_address, task_id, self.account_id)
+            self.__count('precheck_failed')
+            return False
         try:
             self.ctioperator.accept_task(task_id)
+            self.__count('accepted')
             return True
-        except (HTTPError, ValueError, ValidationError) as err:
+        except (HTTPError, ValueError, ValidationError,
+                TransactionFailed) as err:
             # another solver may accept faster than me.
             LOGGER.error(err)
+            self.claims.release(
+                self.operator_address, task_id, self.account_id)
+            self.__count('reverted')
             return False
 
+    def __count(self, key):
+        self.__stats_lock.acquire()
+        self.accept_stats[key] += 1
+        self.__stats_lock.release()
+
     def finish_task(self, task_id, data=''):
         self.ctioperator.finish_task(task_id, data)
 
@@ -153,12 +256,15 @@ class BaseSolver:
         # 5. finish_task.
 
     @staticmethod
-    def webhook(url, download_url, token_address):
+    def webhook(url, download_url, token_address, task_id=None):
         headers = {"Content-Type" : "application/json"}
         data_obj = {
             "download_url": download_url,
             "token_address": token_address
             }
+        if task_id is not None:
+            # identifies the delivery. retries of it are deduplicated.
+            data_obj["task_id"] = task_id
         data = json.dumps(data_obj).encode("utf-8")
         # Note: this data is parsed at Controller.webhook_callback().
 
@@ -162,3 +162,12 @@ class SolverWrapper():
 
     def reemit_pending_tasks(self, tokens):
         self._passthrough(tokens)
+
+    def set_token_priority(self, token_address, priority):
+        self._passthrough(token_address, priority)
+
+    def cancel_task(self, task_id):
+        return self._passthrough(task_id)
+
+    def task_stats(self):
+        return self._passthrough()
@@ -0,0 +1,265 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+LOGGER = logging.getLogger('common')
+
+TASK_INDEX_DB = './workspace/task_index.db'
+## range of blocks to query logs at once.
+TASK_INDEX_CHUNK_BLOCKS = int(os.getenv('TASK_INDEX_CHUNK_BLOCKS', '5000'))
+## number of threads resolving solvers of accepted tasks.
+TASK_INDEX_WORKERS = int(os.getenv('TASK_INDEX_WORKERS', '8'))
+## tasks got at once from CTIOperator.history on seeding.
+TASK_INDEX_HISTORY_PAGE = 16
+SCHEMA_VERSION = 2
+DB_TIMEOUT_SEC = 30
+
+# same order as TaskState of CTIOperator.sol.
+PENDING, ACCEPTED, FINISHED, CANCELLED = range(4)
+TASK_EVENTS = ('TokensReceivedCalled', 'TaskAccepted', 'TaskFinished')
+
+
+class TaskIndex:
+    # Local index of the tasks of operators, built from the operator logs
+    # instead of paging CTIOperator.history, which scans all the tasks on
+    # every page.
+    # sync() reads the logs emitted since the last sync, and the index is
+    # persisted in SQLite with the block synced.
+    # A new index starts at the chain head instead of the genesis, and the
+    # tasks of each seeker before that are seeded from history() once.
+    # cancelTask() emits TaskFinished as same as finish(). the task is
+    # cancelled if it had not been accepted.
+
+    def __init__(self, dbpath=TASK_INDEX_DB):
+        self.dbpath = dbpath
+        dirpath = os.path.dirname(dbpath)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        self.__lock = Lock()
+        self.__sync_lock = Lock()
+        self.__conn = sqlite3.connect(
+            dbpath, timeout=DB_TIMEOUT_SEC, check_same_thread=False,
+            isolation_level=None)  # transactions are controlled explicitly
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__setup()
+
+    def close(self):
+        self.__lock.acquire()
+        self.__conn.close()
+        self.__lock.release()
+
+    def __setup(self):
+        self.__lock.acquire()
+        try:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                self.__conn.execute(
+                    'CREATE TABLE IF NOT EXISTS task ('
+                    ' operator TEXT, taskId INTEGER,'
+                    ' token TEXT, solver TEXT, seeker TEXT, state INTEGER,'
+                    ' PRIMARY KEY (operator, taskId))')
+                self.__conn.execute(
+                    'CREATE TABLE IF NOT EXISTS synced ('
+                    ' operator TEXT PRIMARY KEY, block INTEGER)')
+                self.__conn.execute(
+                    'CREATE TABLE IF NOT EXISTS seeded ('
+                    ' operator TEXT, seeker TEXT,'
+                    ' PRIMARY KEY (operator, seeker))')
+                self.__conn.execute(
+                    'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self.__conn.execute('COMMIT')
+        except Exception:
+            self.__conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.__lock.release()
+
+    def __query(self, sql, params=()):
+        self.__lock.acquire()
+        try:
+            return self.__conn.execute(sql, params).fetchall()
+        finally:
+            self.__lock.release()
+
+    def synced_block(self, operator_address):
+        rows = self.__query(
+            'SELECT block FROM synced WHERE operator = ?',
+            (operator_address,))
+        return rows[0][0] if rows else None
+
+    def sync(self, ctioperator, seeker=None):
+        # read the logs of the operator emitted since the last sync, and
+        # seed the tasks of seeker if not yet.
+        # returns number of logs and tasks applied.
+        self.__sync_lock.acquire()
+        try:
+            return self.__sync(ctioperator, seeker)
+        finally:
+            self.__sync_lock.release()
+
+    def __sync(self, ctioperator, seeker):
+        operator_address = ctioperator.contract_address
+        latest = ctioperator.contracts.web3.eth.blockNumber
+        synced = self.synced_block(operator_address)
+        applied = 0
+        if synced is not None:
+            applied += self.__sync_logs(ctioperator, synced + 1, latest)
+        if seeker and (synced is None or not self.__query(
+                'SELECT 1 FROM seeded WHERE operator = ? AND seeker = ?',
+                (operator_address, seeker))):
+            applied += self.__seed(ctioperator, seeker, latest)
+        elif synced is None:  # nothing to seed. start at the head.
+            self.__apply(operator_address, [], {}, latest)
+        return applied
+
+    def __seed(self, ctioperator, seeker, block):
+        # the tasks of seeker as of the block synced, by paging history.
+        operator_address = ctioperator.contract_address
+        tasks = []
+        while True:
+            page = ctioperator.history(
+                '0x{:040x}'.format(0), TASK_INDEX_HISTORY_PAGE, len(tasks),
+                block=block)
+            tasks.extend(page)
+            if len(page) < TASK_INDEX_HISTORY_PAGE:
+                break
+        self.__lock.acquire()
+        try:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            for (task_id, token, solver, task_seeker, state) in tasks:
+                self.__conn.execute(
+                    'INSERT OR REPLACE INTO task VALUES (?,?,?,?,?,?)',
+                    (operator_address, task_id, token,
+                     None if int(solver, 16) == 0 else solver,
+                     task_seeker, state))
+            self.__conn.execute(
+                'INSERT OR IGNORE INTO seeded VALUES (?, ?)',
+                (operator_address, seeker))
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO synced VALUES (?, ?)',
+                (operator_address, block))
+            self.__conn.execute('COMMIT')
+        except Exception:
+            self.__conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.__lock.release()
+        LOGGER.info(
+            'task index: seeded %d tasks of %s on %s at block %d',
+            len(tasks), seeker, operator_address, block)
+        return len(tasks)
+
+    def __sync_logs(self, ctioperator, start, latest):
+        operator_address = ctioperator.contract_address
+        web3 = ctioperator.contracts.web3
+        events = ctioperator.contract.events
+        applied = 0
+        for chunk_start in range(start, latest + 1, TASK_INDEX_CHUNK_BLOCKS):
+            chunk_end = min(chunk_start + TASK_INDEX_CHUNK_BLOCKS - 1, latest)
+            logs = []
+            for name in TASK_EVENTS:
+                logs.extend(getattr(events, name).getLogs(
+                    fromBlock=chunk_start, toBlock=chunk_end))
+            logs.sort(key=lambda x: (x['blockNumber'], x['logIndex']))
+            solvers = self.__resolve_solvers(web3, [
+                log for log in logs if log['event'] == 'TaskAccepted'])
+            self.__apply(operator_address, logs, solvers, chunk_end)
+            applied += len(logs)
+        if applied:
+            LOGGER.info(
+                'task index: applied %d logs of %s up to block %d',
+                applied, operator_address, latest)
+        return applied
+
+    @staticmethod
+    def __resolve_solvers(web3, logs):
+        # TaskAccepted has no solver. it is the sender of the transaction.
+        # returns {transactionHash: solver}
+        tx_hashes = list({log['transactionHash'] for log in logs})
+        if not tx_hashes:
+            return dict()
+        with ThreadPoolExecutor(max_workers=TASK_INDEX_WORKERS) as executor:
+            senders = executor.map(
+                lambda tx_hash: web3.eth.getTransaction(tx_hash)['from'],
+                tx_hashes)
+            return dict(zip(tx_hashes, senders))
+
+    def __apply(self, operator_address, logs, solvers, block):
+        # apply the logs and move the synced block, atomically.
+        self.__lock.acquire()
+        try:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            for log in logs:
+                args = log['args']
+                if log['event'] == 'TokensReceivedCalled':
+                    # may be reemitted for pending tasks.
+                    self.__conn.execute(
+                        'INSERT OR IGNORE INTO task VALUES (?,?,?,?,?,?)',
+                        (operator_address, args['taskId'], args['token'],
+                         None, args['from'], PENDING))
+                elif log['event'] == 'TaskAccepted':
+                    self.__conn.execute(
+                        'UPDATE task SET state = ?, solver = ?'
+                        ' WHERE operator = ? AND taskId = ?',
+                        (ACCEPTED, solvers.get(log['transactionHash']),
+                         operator_address, args['taskId']))
+                else:  # TaskFinished
+                    self.__conn.execute(
+                        'UPDATE task SET state = CASE state'
+                        ' WHEN ? THEN ? WHEN ? THEN ? ELSE state END'
+                        ' WHERE operator = ? AND taskId = ?',
+                        (PENDING, CANCELLED, ACCEPTED, FINISHED,
+                         operator_address, args['taskId']))
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO synced VALUES (?, ?)',
+                (operator_address, block))
+            self.__conn.execute('COMMIT')
+        except Exception:
+            self.__conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.__lock.release()
+
+    def tasks(self, operator_address, token_address=None, states=None,
+              seeker=None):
+        # list of (task_id, token, solver, seeker, state), in order of id.
+        sql = 'SELECT taskId, token, solver, seeker, state FROM task' \
+            ' WHERE operator = ?'
+        params = [operator_address]
+        if seeker:
+            sql += ' AND seeker = ?'
+            params.append(seeker)
+        if token_address:
+            sql += ' AND token = ?'
+            params.append(token_address)
+        if states:
+            sql += ' AND state IN ({})'.format(', '.join('?' * len(states)))
+            params.extend(states)
+        return [tuple(row) for row in self.__query(
+            sql + ' ORDER BY taskId', params)]
+
+    def get(self, operator_address, task_id):
+        rows = self.__query(
+            'SELECT taskId, token, solver, seeker, state FROM task'
+            ' WHERE operator = ? AND taskId = ?',
+            (operator_address, task_id))
+        return tuple(rows[0]) if rows else None
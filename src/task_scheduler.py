@@ -0,0 +1,320 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import heapq
+import logging
+import os
+import time
+from itertools import count
+from threading import Thread, Condition, local
+from urllib.error import HTTPError
+from requests.exceptions import (
+    ChunkedEncodingError, ConnectionError as ConnError, HTTPError as ReqError,
+    RequestException, Timeout)
+
+LOGGER = logging.getLogger('common')
+
+## number of challenges processed at once, per solver.
+SOLVER_WORKERS = int(os.getenv('SOLVER_WORKERS', '4'))
+## a task not finished in this period is given up.
+SOLVER_TASK_TIMEOUT_SEC = float(os.getenv('SOLVER_TASK_TIMEOUT_SEC', '600'))
+## retry of transient failures (upload, webhook, etc).
+SOLVER_RETRY_MAX = int(os.getenv('SOLVER_RETRY_MAX', '3'))
+SOLVER_RETRY_BACKOFF_SEC = float(os.getenv('SOLVER_RETRY_BACKOFF_SEC', '1'))
+SOLVER_RETRY_BACKOFF_MAX_SEC = 30
+SCHEDULER_JOIN_TIMEOUT_SEC = 30
+
+TASK_CONTEXT = local()  # task processed on the worker thread
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskExpired(Exception):
+    pass
+
+
+class SolverTask:
+    # A challenge queued in TaskScheduler.
+    # state: queued -> running -> done|failed, or cancelled|expired.
+
+    def __init__(self, task_id, token_address, event, priority, deadline):
+        self.task_id = task_id
+        self.token_address = token_address
+        self.event = event
+        self.priority = priority
+        self.deadline = deadline
+        self.state = 'queued'
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def cancel(self):
+        # queued task never starts. running task stops at next check().
+        if self.state in {'queued', 'running'}:
+            self.state = 'cancelled'
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def check(self):
+        # raises if the task should not go on.
+        if self.state == 'cancelled':
+            raise TaskCancelled('task {} cancelled'.format(self.task_id))
+        if self.expired():
+            raise TaskExpired('task {} expired'.format(self.task_id))
+
+    def summary(self):
+        return {
+            'task_id': self.task_id,
+            'token_address': self.token_address,
+            'priority': self.priority,
+            'state': self.state,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'deadline': self.deadline,
+            }
+
+
+def current_task():
+    # the task processed on this thread, if any.
+    return getattr(TASK_CONTEXT, 'task', None)
+
+
+def is_transient(err):
+    # errors worth to retry: network errors and 5xx.
+    # exceptions of requests are OSError, including 4xx and invalid URL.
+    if isinstance(err, HTTPError):
+        return err.code >= 500
+    if isinstance(err, ReqError):
+        return err.response is None or err.response.status_code >= 500
+    if isinstance(err, RequestException):
+        return isinstance(err, (ConnError, Timeout, ChunkedEncodingError))
+    return isinstance(err, (OSError, TimeoutError))
+
+
+def retry_call(func, *args, **kwargs):
+    # call func with retry and exponential backoff for transient errors,
+    # within the deadline of the current task.
+    task = current_task()
+    backoff = SOLVER_RETRY_BACKOFF_SEC
+    for trial in range(SOLVER_RETRY_MAX + 1):
+        if task:
+            task.check()
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            if trial >= SOLVER_RETRY_MAX or not is_transient(err):
+                raise
+            if task and task.deadline is not None and \
+                    time.time() + backoff > task.deadline:
+                raise
+            LOGGER.warning(
+                'retry %s in %.1f sec (%d/%d): %s', func.__name__,
+                backoff, trial + 1, SOLVER_RETRY_MAX, err)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, SOLVER_RETRY_BACKOFF_MAX_SEC)
+    return None  # not reached
+
+
+class TaskScheduler:
+    # Priority queue of challenges with a bounded worker pool.
+    # Tasks of higher priority token go first, FIFO in the same priority.
+    # A task not started by its deadline is dropped without accepting, so
+    # that other solvers can take it.
+
+    def __init__(
+            self, handler, identity, num_workers=SOLVER_WORKERS,
+            timeout=SOLVER_TASK_TIMEOUT_SEC):
+        self.handler = handler  # called with (token_address, event)
+        self.identity = identity
+        self.timeout = timeout
+        self.priorities = dict()  # {token_address: priority}
+        self.tasks = dict()  # {task_id: task} queued or running
+        self.__queue = []  # heap of (-priority, seq, task)
+        self.__seq = count()
+        self.__cond = Condition()
+        self.__stopping = False
+        self.__stats = {
+            'submitted': 0,
+            'started': 0,
+            'finished': 0,
+            'done': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'expired': 0,
+            'wait_sec': 0.0,
+            'max_wait_sec': 0.0,
+            'run_sec': 0.0,
+            'max_run_sec': 0.0,
+            }
+        self.__workers = [
+            Thread(target=self.__work, daemon=True,
+                   name='solver_task_{}'.format(idx))
+            for idx in range(num_workers)]
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self):
+        self.__cond.acquire()
+        self.__stopping = True
+        for _, _, task in self.__queue:
+            task.cancel()
+        for task in self.tasks.values():
+            task.cancel()  # running tasks stop at next check
+        self.__queue.clear()
+        self.__cond.notify_all()
+        self.__cond.release()
+        for worker in self.__workers:
+            worker.join(timeout=SCHEDULER_JOIN_TIMEOUT_SEC)
+            if worker.is_alive():
+                LOGGER.error(
+                    'failed stopping %s: %s', worker.name, self.identity)
+        self.__workers = []
+
+    def submit(self, token_address, event, timeout=None):
+        task_id = event['args']['taskId']
+        timeout = self.timeout if timeout is None else timeout
+        self.__cond.acquire()
+        try:
+            if self.__stopping:
+                return None
+            if task_id in self.tasks:  # replayed
+                return self.tasks[task_id]
+            task = SolverTask(
+                task_id, token_address, event,
+                self.priorities.get(token_address, 0),
+                time.time() + timeout if timeout else None)
+            self.tasks[task_id] = task
+            heapq.heappush(
+                self.__queue, (-task.priority, next(self.__seq), task))
+            self.__stats['submitted'] += 1
+            self.__cond.notify()
+            return task
+        finally:
+            self.__cond.release()
+
+    def set_priority(self, token_address, priority):
+        # affects tasks queued later.
+        self.__cond.acquire()
+        self.priorities[token_address] = priority
+        self.__cond.release()
+
+    def cancel(self, task_id):
+        self.__cond.acquire()
+        try:
+            task = self.tasks.get(task_id)
+            if not task:
+                return False
+            task.cancel()
+            return True
+        finally:
+            self.__cond.release()
+
+    def cancel_tokens(self, token_addresses):
+        self.__cond.acquire()
+        try:
+            targets = [
+                task for task in self.tasks.values()
+                if task.token_address in token_addresses]
+            for task in targets:
+                task.cancel()
+            return [task.task_id for task in targets]
+        finally:
+            self.__cond.release()
+
+    def stats(self):
+        self.__cond.acquire()
+        try:
+            stats = dict(self.__stats)
+            states = [task.state for task in self.tasks.values()]
+            stats['queue_depth'] = states.count('queued')
+            stats['running'] = states.count('running')
+            stats['workers'] = len(self.__workers)
+            stats['avg_wait_sec'] = stats['wait_sec'] / stats['started'] \
+                if stats['started'] else 0.0
+            stats['avg_run_sec'] = stats['run_sec'] / stats['finished'] \
+                if stats['finished'] else 0.0
+            stats['tasks'] = [
+                task.summary() for task in self.tasks.values()]
+            return stats
+        finally:
+            self.__cond.release()
+
+    def __next(self):
+        # pop next task to run, dropping cancelled and expired ones.
+        self.__cond.acquire()
+        try:
+            while True:
+                while not self.__queue and not self.__stopping:
+                    self.__cond.wait()
+                if self.__stopping:
+                    return None
+                _, _, task = heapq.heappop(self.__queue)
+                if task.state == 'queued' and task.expired():
+                    task.state = 'expired'
+                if task.state != 'queued':
+                    self.__stats[task.state] += 1
+                    del self.tasks[task.task_id]
+                    LOGGER.warning(
+                        'dropped task %s: %s', task.task_id, task.state)
+                    continue
+                task.state = 'running'
+                task.started_at = time.time()
+                self.__stats['started'] += 1
+                wait = task.started_at - task.queued_at
+                self.__stats['wait_sec'] += wait
+                self.__stats['max_wait_sec'] = max(
+                    self.__stats['max_wait_sec'], wait)
+                return task
+        finally:
+            self.__cond.release()
+
+    def __work(self):
+        while True:
+            task = self.__next()
+            if not task:
+                break
+            TASK_CONTEXT.task = task
+            try:
+                self.handler(task.token_address, task.event)
+                state = 'done'
+            except TaskCancelled as err:
+                LOGGER.warning(err)
+                state = 'cancelled'
+            except TaskExpired as err:
+                LOGGER.warning(err)
+                state = 'expired'
+            except Exception as err:
+                LOGGER.exception(err)
+                state = 'failed'
+            finally:
+                TASK_CONTEXT.task = None
+            self.__finish(task, state)
+
+    def __finish(self, task, state):
+        self.__cond.acquire()
+        task.finished_at = time.time()
+        task.state = state
+        elapsed = task.finished_at - task.started_at
+        self.__stats[state] += 1
+        self.__stats['finished'] += 1
+        self.__stats['run_sec'] += elapsed
+        self.__stats['max_run_sec'] = max(
+            self.__stats['max_run_sec'], elapsed)
+        del self.tasks[task.task_id]
+        self.__cond.release()
@@ -0,0 +1,170 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import csv
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+LOGGER = logging.getLogger('common')
+
+REGISTERED_TOKEN_DB = './workspace/registered_token.db'
+## legacy registry, migrated into REGISTERED_TOKEN_DB on first open.
+REGISTERED_TOKEN_TSV = './workspace/registered_token.tsv'
+
+FIELDNAMES = ['uuid', 'tokenAddress', 'title', 'price', 'operator', 'quantity']
+SCHEMA_VERSION = 2
+DB_TIMEOUT_SEC = 30
+
+
+class TokenRegistry:
+    # Local registry of the tokens disseminated by this client, indexed by
+    # uuid and token address.
+    # Backed by SQLite in WAL mode, so that readers in other processes
+    # (e.g. metemctl publish) are not blocked by a writer, and every write
+    # is committed atomically.
+    # A token still being disseminated has the last stage it passed (e.g.
+    # 'deploy'), so that a crashed run resumes it from the next stage.
+    # The stage of a completed token is NULL.
+
+    def __init__(
+            self, dbpath=REGISTERED_TOKEN_DB, tsvpath=REGISTERED_TOKEN_TSV):
+        self.dbpath = dbpath
+        dirpath = os.path.dirname(dbpath)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        self.__lock = Lock()
+        self.__conn = sqlite3.connect(
+            dbpath, timeout=DB_TIMEOUT_SEC, check_same_thread=False,
+            isolation_level=None)  # transactions are controlled explicitly
+        self.__conn.row_factory = sqlite3.Row
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__setup(tsvpath)
+
+    def close(self):
+        self.__lock.acquire()
+        self.__conn.close()
+        self.__lock.release()
+
+    def __setup(self, tsvpath):
+        self.__lock.acquire()
+        try:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            version = self.__conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                self.__conn.execute(
+                    'CREATE TABLE IF NOT EXISTS registered_token ('
+                    ' uuid TEXT PRIMARY KEY,'
+                    ' tokenAddress TEXT,'
+                    ' title TEXT, price TEXT, operator TEXT, quantity TEXT)')
+                self.__conn.execute(
+                    'CREATE INDEX IF NOT EXISTS registered_token_address'
+                    ' ON registered_token (tokenAddress)')
+                migrated = self.__migrate(tsvpath)
+                if migrated:
+                    LOGGER.info(
+                        'migrated %d tokens from %s to %s',
+                        migrated, tsvpath, self.dbpath)
+            if version < 2:
+                self.__conn.execute(
+                    'ALTER TABLE registered_token ADD COLUMN stage TEXT')
+            if version < SCHEMA_VERSION:
+                self.__conn.execute(
+                    'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self.__conn.execute('COMMIT')
+        except Exception:
+            self.__conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.__lock.release()
+
+    def __migrate(self, tsvpath):
+        # import the legacy TSV. the TSV itself is left as is.
+        if not tsvpath or not os.path.isfile(tsvpath):
+            return 0
+        with open(tsvpath, newline='') as tsvfile:
+            rows = [
+                [row.get(key) for key in FIELDNAMES]
+                for row in csv.DictReader(tsvfile, delimiter='\t')
+                if row.get('uuid')]
+        # the later row wins, as same as appended TSV.
+        self.__conn.executemany(
+            'INSERT OR REPLACE INTO registered_token ({}) VALUES ({})'.format(
+                ', '.join(FIELDNAMES), ', '.join('?' * len(FIELDNAMES))),
+            rows)
+        return len(rows)
+
+    def __query(self, sql, params=()):
+        self.__lock.acquire()
+        try:
+            return [dict(row) for row in self.__conn.execute(sql, params)]
+        finally:
+            self.__lock.release()
+
+    def add(self, cti_metadata, stage=None):
+        # register (or overwrite) metadata of the token.
+        # stage is the last stage passed, or None if completed.
+        row = [
+            None if cti_metadata.get(key) is None else str(cti_metadata[key])
+            for key in FIELDNAMES] + [stage]
+        self.__lock.acquire()
+        try:
+            # a statement in autocommit mode is committed atomically.
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO registered_token ({}, stage) '
+                'VALUES ({})'.format(
+                    ', '.join(FIELDNAMES),
+                    ', '.join('?' * (len(FIELDNAMES) + 1))),
+                row)
+        finally:
+            self.__lock.release()
+
+    def contains(self, uuid):
+        # True also for a token being disseminated, not to deploy it twice.
+        return bool(self.__query(
+            'SELECT 1 FROM registered_token WHERE uuid = ?', (uuid,)))
+
+    def get(self, uuid):
+        rows = self.__query(
+            'SELECT * FROM registered_token WHERE uuid = ?', (uuid,))
+        return rows[0] if rows else None
+
+    def get_by_token(self, token_address):
+        rows = self.__query(
+            'SELECT * FROM registered_token WHERE tokenAddress = ?',
+            (token_address,))
+        return rows[0] if rows else None
+
+    def uuids(self):
+        return {
+            row['uuid'] for row in
+            self.__query('SELECT uuid FROM registered_token')}
+
+    def pending(self):
+        # tokens being disseminated, with the last stage passed.
+        return self.__query(
+            'SELECT {}, stage FROM registered_token'
+            ' WHERE stage IS NOT NULL ORDER BY rowid'.format(
+                ', '.join(FIELDNAMES)))
+
+    def list(self):
+        # same format as rows of the legacy TSV, in order of registration.
+        # tokens being disseminated are not listed.
+        return self.__query(
+            'SELECT {} FROM registered_token'
+            ' WHERE stage IS NULL ORDER BY rowid'.format(
+                ', '.join(FIELDNAMES)))
@@ -0,0 +1,165 @@
+#
+#    Copyright 2021, NTT Communications Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+LOGGER = logging.getLogger('common')
+
+## number of threads waiting for transaction receipts, per account.
+TX_RECEIPT_WORKERS = int(os.getenv('TX_RECEIPT_WORKERS', '8'))
+TX_RECEIPT_TIMEOUT_SEC = 120
+
+
+class TransactionHandle:
+    # Result of a submitted transaction.
+    # result() blocks until mined, and the handle is awaitable in asyncio.
+
+    def __init__(self, tx_hash, future):
+        self.tx_hash = tx_hash
+        self.future = future
+
+    def result(self, timeout=None):
+        # returns the receipt, or raises if the transaction failed.
+        return self.future.result(timeout=timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def add_done_callback(self, callback):
+        self.future.add_done_callback(lambda _: callback(self))
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+
+def gather(handles):
+    # wait for all the handles. results are receipts, or exceptions raised.
+    results = []
+    for handle in handles:
+        try:
+            results.append(handle.result())
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+class TransactionPipeline:
+    # Sends transactions of an account back-to-back, with nonces assigned
+    # locally, and resolves the receipts concurrently.
+    # Use TransactionPipeline.of(web3) to share one pipeline per account,
+    # and TransactionPipeline.close_of(web3) on teardown.
+
+    __pipelines = WeakKeyDictionary()  # {web3: {account: pipeline}}
+    __pipelines_lock = Lock()
+
+    @classmethod
+    def of(cls, web3):
+        account = web3.eth.defaultAccount
+        cls.__pipelines_lock.acquire()
+        try:
+            pipelines = cls.__pipelines.setdefault(web3, dict())
+            if account not in pipelines:
+                pipelines[account] = cls(web3, account)
+            return pipelines[account]
+        finally:
+            cls.__pipelines_lock.release()
+
+    @classmethod
+    def close_of(cls, web3):
+        # close the pipelines of the web3. of() opens new ones after this.
+        cls.__pipelines_lock.acquire()
+        try:
+            pipelines = cls.__pipelines.pop(web3, dict())
+        finally:
+            cls.__pipelines_lock.release()
+        for pipeline in pipelines.values():
+            pipeline.close()
+
+    def __init__(self, web3, account, num_workers=TX_RECEIPT_WORKERS):
+        self.web3 = web3
+        self.account = account
+        self.__nonce = None  # next nonce to use
+        self.__closed = False
+        self.__lock = Lock()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='tx_receipt')
+
+    def submit(self, func, tx_params=None, check=None):
+        # func: bound ContractFunction or ContractConstructor.
+        # check: called with the receipt in the worker, and may raise.
+        self.__lock.acquire()
+        try:
+            if self.__closed:
+                raise RuntimeError('transaction pipeline is closed')
+            tx_hash = self.__send(func, tx_params)
+            future = self.__executor.submit(self.__wait, tx_hash, check)
+        finally:
+            self.__lock.release()
+        return TransactionHandle(tx_hash, future)
+
+    def close(self, wait=True):
+        # stop the receipt workers, after resolving the receipts submitted
+        # if wait.
+        self.__lock.acquire()
+        self.__closed = True
+        self.__lock.release()
+        self.__executor.shutdown(wait=wait)
+
+    def resync(self):
+        # forget local nonce. call if the account is used out of pipeline.
+        self.__lock.acquire()
+        self.__nonce = None
+        self.__lock.release()
+
+    def __send(self, func, tx_params, retry=True):
+        if self.__nonce is None:
+            self.__nonce = self.web3.eth.getTransactionCount(
+                self.account, 'pending')
+        params = dict(tx_params or {})
+        params['nonce'] = self.__nonce
+        try:
+            tx_hash = func.transact(params)
+        except ValueError as err:
+            # nonce was not consumed, or is out of sync with the node.
+            # the account may be shared with another process (e.g. solver
+            # daemon), whose errors say 'already known' or 'replacement
+            # transaction underpriced' instead of 'nonce'. retry if the
+            # nonce of the node moved, whatever the error says.
+            used, self.__nonce = self.__nonce, None
+            if not retry:
+                raise
+            pending = self.web3.eth.getTransactionCount(
+                self.account, 'pending')
+            if pending == used and 'nonce' not in str(err).lower():
+                raise
+            LOGGER.warning(
+                'resync nonce %d -> %d and retry: %s', used, pending, err)
+            self.__nonce = pending
+            return self.__send(func, tx_params, retry=False)
+        self.__nonce += 1
+        return tx_hash
+
+    def __wait(self, tx_hash, check):
+        tx_receipt = self.web3.eth.waitForTransactionReceipt(
+            tx_hash, timeout=TX_RECEIPT_TIMEOUT_SEC)
+        if check:
+            check(tx_receipt)
+        return tx_receipt
@@ -14,34 +14,142 @@
 #    limitations under the License.
 #
 
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from threading import Thread
+from threading import Thread, Lock
 from flask import Flask, request
 
 LOGGER = logging.getLogger('common')
 
+## 'flask' (development server) or 'async' (aiohttp).
+WEBHOOK_SERVER_TYPE = os.getenv('WEBHOOK_SERVER_TYPE', 'flask')
+## number of callbacks processed at once.
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+MAX_SEEN_NOTIFICATIONS = 10000
+## notification without task_id is deduplicated in this period, to drop
+## retries only. the same answer may come again for another challenge.
+WEBHOOK_DEDUP_TTL_SEC = int(os.getenv('WEBHOOK_DEDUP_TTL_SEC', '60'))
 
+
+class WebhookDispatcher():
+    # Routes notifications to the callback for the token or task, or to
+    # the default callback, and runs it on a thread pool off the request
+    # path. Replayed notifications are dropped. The solver adds task_id,
+    # which is unique per challenge, and others are kept for a short time.
+
+    def __init__(self, max_workers=WEBHOOK_WORKERS):
+        self.callback = None  # default
+        self.routes = dict()  # {('token'|'task', key): callback}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='webhook')
+        self.__seen = OrderedDict()  # {digest: expires at, or None}
+        self.__lock = Lock()
+
+    def route(self, kind, key, callback):
+        self.__lock.acquire()
+        if callback:
+            self.routes[(kind, str(key))] = callback
+        else:
+            self.routes.pop((kind, str(key)), None)
+        self.__lock.release()
+
+    def dispatch(self, data, kind=None, key=None):
+        # returns (status, message) to respond.
+        if not isinstance(data, dict):
+            return 400, 'invalid data'
+        if kind == 'token':
+            data.setdefault('token_address', key)
+        digest = hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode()).hexdigest()
+        self.__lock.acquire()
+        try:
+            callback = self.routes.get((kind, key)) or \
+                self.routes.get(('token', data.get('token_address'))) or \
+                self.callback
+            if not callback:
+                return 200, 'There are no waiting process'
+            now = time.time()
+            expires = self.__seen.get(digest, now)
+            if expires is None or expires > now:
+                return 200, 'duplicated webhook ignored.'
+            self.__seen.pop(digest, None)
+            self.__seen[digest] = None if 'task_id' in data \
+                else now + WEBHOOK_DEDUP_TTL_SEC
+            while len(self.__seen) > MAX_SEEN_NOTIFICATIONS:
+                self.__seen.popitem(last=False)
+        finally:
+            self.__lock.release()
+        self.executor.submit(self.__run, callback, data)
+        return 202, 'webhook accepted.'
+
+    @staticmethod
+    def __run(callback, data):
+        try:
+            callback(data)
+        except Exception as err:
+            LOGGER.exception(err)
+
+
+DISPATCHER = WebhookDispatcher()
 APP = Flask(__name__)
 
 @APP.route('/', methods=['POST'])
-def webhook_receiver():
+@APP.route('/<kind>/<key>', methods=['POST'])
+def webhook_receiver(kind=None, key=None):
     # curl -X POST -H "Content-Type: application/json" \
     #      -d '{"result":"this_answer_output_by_solver"}' 127.0.0.1:12345/
-    # resultキーがあれば表示
-    data = request.get_json()
+    if kind not in {None, 'token', 'task'}:
+        return 'not found', 404
+    data = request.get_json(silent=True)
+    status, msg = DISPATCHER.dispatch(data, kind, key)
+    return msg, status
+
+
+class AsyncWebhookServer():
+    # aiohttp version of the receiver, running its own event loop.
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def run(self):
+        asyncio.run(self.__serve())
+
+    async def __serve(self):
+        from aiohttp import web  # only for this server type
+        app = web.Application()
+        app.router.add_post('/', self.__receive)
+        app.router.add_post('/{kind:token|task}/{key}', self.__receive)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        await site.start()
+        try:
+            await asyncio.Event().wait()  # forever, as daemon thread
+        finally:
+            await runner.cleanup()
 
-    # callbackの通知
-    if WebhookReceiver.callback:
-        WebhookReceiver.callback(data)
-        return 'webhook received.'
-    return 'There are no waiting process'
+    @staticmethod
+    async def __receive(req):
+        from aiohttp import web
+        try:
+            data = await req.json()
+        except ValueError:
+            data = None
+        status, msg = DISPATCHER.dispatch(
+            data, req.match_info.get('kind'), req.match_info.get('key'))
+        return web.Response(status=status, text=msg)
 
 
 class WebhookReceiver():
     thread = None
-    callback = None
     baseurl = None
 
     def __new__(cls, *_args, **_kargs):
@@ -53,28 +161,38 @@ class WebhookReceiver():
         pass
 
     @classmethod
-    def start(cls, url):
+    def start(cls, url, server_type=WEBHOOK_SERVER_TYPE):
         if WebhookReceiver.thread:
             return
-        logging.getLogger('werkzeug').disabled = True
-        os.environ['WERKZEUG_RUN_MAIN'] = 'true'
-        LOGGER.info('Running on %s', url)
-        cls.baseurl = url
+        LOGGER.info('Running on %s (%s)', url, server_type)
+        cls.baseurl = url.rstrip('/')
 
         obj = urlparse(url)
+        if server_type == 'async':
+            target = AsyncWebhookServer(obj.hostname, obj.port).run
+            kwargs = {}
+        else:
+            logging.getLogger('werkzeug').disabled = True
+            os.environ['WERKZEUG_RUN_MAIN'] = 'true'
+            target = APP.run
+            kwargs = {'host': obj.hostname, 'port': obj.port,
+                      'threaded': True}
         WebhookReceiver.thread = Thread(
-            target=APP.run,
-            kwargs={'host':obj.hostname, 'port':obj.port},
-            daemon=True)
+            target=target, kwargs=kwargs, daemon=True)
         WebhookReceiver.thread.start()
 
     @classmethod
-    def set_callback(cls, callback):
-        cls.callback = callback
+    def set_callback(cls, callback, token_address=None, task_id=None):
+        # callback for the token or the task, or default if none given.
+        if token_address:
+            DISPATCHER.route('token', token_address, callback)
+        elif task_id is not None:
+            DISPATCHER.route('task', task_id, callback)
+        else:
+            DISPATCHER.callback = callback
 
     @classmethod
     def get_url(cls, token_address):
         assert cls.baseurl
         assert token_address
-        # TODO should generate individual url for each token?
-        return cls.baseurl
+        return '{}/token/{}'.format(cls.baseurl, token_address)